@@ -0,0 +1,217 @@
+# Version 1.1
+# Keeping a set of long-lived "adb shell" sessions, commands are written to the stdin of the session and the output is
+# split by a random delimiter, which avoids spawning a new adb process (and usb handshake) for every command.
+#
+# CHANGELOG
+# 1.1: turning off the echo and prompts of legacy adbd (interactive shell under a pty), falling back to one adb
+#      process per command if the session can not be made quiet, adding the read timeout of commands
+import re
+import subprocess
+import threading
+import uuid
+import queue
+from typing import *
+from util import spawn_process
+
+
+class AdbShellSessionClosedException(RuntimeError):
+    pass
+
+
+class AdbShellTimeoutException(RuntimeError):
+    pass
+
+
+class AdbShellUnsupportedException(RuntimeError):
+    pass
+
+
+class AdbShellSession:
+    """
+    A single "adb shell" process, accepting one command at a time
+    """
+    def __init__(self, adb_args: Optional[List[str]] = None, encoding: str = 'utf8', timeout: Optional[float] = None):
+        self._encoding = encoding
+        self._timeout = timeout
+        self._marker = '__ADB_SHELL_EOF_%s__' % uuid.uuid4().hex
+        self._err_marker = '__ADB_SHELL_ERR_EOF_%s__' % uuid.uuid4().hex
+        self._marker_pattern = re.compile('^%s (\\d+)$' % self._marker)
+        # some old devices (without shell protocol) merge stderr into stdout
+        self._stderr_merged = False
+        self._process = subprocess.Popen((adb_args or ['adb']) + ['shell'], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._stdout_lines = queue.Queue()
+        self._stderr_lines = queue.Queue()
+        for stream, lines in ((self._process.stdout, self._stdout_lines), (self._process.stderr, self._stderr_lines)):
+            thd = threading.Thread(target=self._read_lines, args=(stream, lines), daemon=True)
+            thd.start()
+        try:
+            self._init_session()
+        except BaseException:
+            self.close()
+            raise
+
+    def _read_lines(self, stream, lines: queue.Queue):
+        for line in iter(stream.readline, b''):
+            lines.put(line.decode(self._encoding, errors='replace'))
+        lines.put(None)
+
+    def _init_session(self):
+        # legacy adbd runs the interactive shell under a pty, which echoes the input back and prints prompts to
+        # stdout. The input written before "stty -echo" takes effect is still echoed, so it is drained by the first
+        # command, a session still echoing a no-op command after that can not be used
+        self._write('stty -echo 2>/dev/null; PS1=; PS2=\n')
+        self.run('true')
+        stdout, _, _ = self.run('true')
+        if len(stdout) > 0:
+            raise AdbShellUnsupportedException('adb shell session echoes the input: %s' % stdout.strip())
+
+    def _write(self, script: str):
+        try:
+            self._process.stdin.write(script.encode(self._encoding))
+            self._process.stdin.flush()
+        except OSError as ex:
+            raise AdbShellSessionClosedException(str(ex))
+
+    @staticmethod
+    def _quote_marker(marker: str) -> str:
+        # the marker written to the shell is split by an empty quoted string, so the echoed input never matches it
+        return '%s""%s' % (marker[:8], marker[8:])
+
+    def _get_line(self, lines: queue.Queue) -> str:
+        try:
+            line = lines.get(timeout=self._timeout)
+        except queue.Empty:
+            self._process.kill()
+            raise AdbShellTimeoutException('adb shell command did not finish in %s seconds' % self._timeout)
+        if line is None:
+            raise AdbShellSessionClosedException('adb shell session closed unexpectedly')
+        return line
+
+    @property
+    def is_alive(self) -> bool:
+        return self._process.poll() is None
+
+    def run(self, cmd: str) -> Tuple[str, str, int]:
+        """
+        Execute the command in the shell session
+        :param cmd: shell command line, arguments should be escaped by caller
+        :return: stdout, stderr and the exit code of the command
+        :exception AdbShellSessionClosedException: the session is terminated (e.g. device disconnected)
+        """
+        if not self.is_alive:
+            raise AdbShellSessionClosedException('adb shell session exited with code %s' % self._process.returncode)
+        # a line break is printed before the markers, so they always start a line and the extra line break is
+        # removed from the output afterwards
+        script = '{ %s\n} </dev/null\n__adb_rc=$?; echo; echo %s >&2; echo "%s $__adb_rc"\n' % \
+                 (cmd, self._quote_marker(self._err_marker), self._quote_marker(self._marker))
+        self._write(script)
+        stdout_lines = []
+        stderr_lines = []
+        return_code = None
+        while True:
+            line = self._get_line(self._stdout_lines).rstrip('\r\n')
+            if line == self._err_marker:
+                self._stderr_merged = True
+                continue
+            match = self._marker_pattern.match(line)
+            if match is not None:
+                return_code = int(match.group(1))
+                break
+            stdout_lines.append(line + '\n')
+        if len(stdout_lines) > 0:
+            stdout_lines[-1] = stdout_lines[-1][:-1]
+        if not self._stderr_merged:
+            while True:
+                line = self._get_line(self._stderr_lines).rstrip('\r\n')
+                if line.endswith(self._err_marker):
+                    if len(line) > len(self._err_marker):
+                        stderr_lines.append(line[:-len(self._err_marker)])
+                    break
+                stderr_lines.append(line + '\n')
+        return ''.join(stdout_lines), ''.join(stderr_lines), return_code
+
+    def close(self):
+        try:
+            self._process.stdin.write(b'exit\n')
+            self._process.stdin.close()
+            self._process.wait(5)
+        except (OSError, subprocess.TimeoutExpired):
+            self._process.kill()
+
+
+class AdbShellPool:
+    """
+    A pool of at most pool_size shell sessions, sessions are created lazily and re-created after disconnection.
+    Commands are run by a new adb process each if the device does not support quiet shell sessions
+    """
+    def __init__(self, pool_size: int, adb_args: Optional[List[str]] = None, encoding: str = 'utf8',
+                 timeout: Optional[float] = 600):
+        assert pool_size > 0, 'pool_size must be positive'
+        self._adb_args = adb_args
+        self._encoding = encoding
+        self._timeout = timeout
+        self._unsupported = False
+        self._sem = threading.Semaphore(pool_size)
+        self._lock = threading.Lock()
+        self._idle_sessions = []  # type: List[AdbShellSession]
+        self._closed = False
+
+    def _acquire(self) -> AdbShellSession:
+        self._sem.acquire()
+        with self._lock:
+            while len(self._idle_sessions) > 0:
+                session = self._idle_sessions.pop()
+                if session.is_alive:
+                    return session
+        try:
+            return AdbShellSession(self._adb_args, self._encoding, self._timeout)
+        except Exception:
+            self._sem.release()
+            raise
+
+    def _release(self, session: AdbShellSession, reusable: bool):
+        with self._lock:
+            if reusable and not self._closed and session.is_alive:
+                self._idle_sessions.append(session)
+            else:
+                session.close()
+        self._sem.release()
+
+    def run(self, cmd: str, retry_count: int = 1) -> Tuple[str, str]:
+        """
+        Execute the command in one of the idle sessions, same return value as util.spawn_process
+        :param cmd: shell command line, arguments should be escaped by caller
+        :param retry_count: retries with a new session if the session is closed unexpectedly
+        :return: stdout and stderr
+        :exception AdbShellTimeoutException: the command does not finish in timeout seconds
+        """
+        if self._unsupported:
+            return spawn_process((self._adb_args or ['adb']) + ['shell', cmd], self._encoding)
+        try:
+            session = self._acquire()
+        except AdbShellUnsupportedException as ex:
+            from warnings import warn
+            warn('%s, falling back to one adb process per command' % ex)
+            self._unsupported = True
+            return self.run(cmd, retry_count)
+        try:
+            stdout, stderr, _ = session.run(cmd)
+        except AdbShellSessionClosedException:
+            self._release(session, False)
+            if retry_count > 0:
+                return self.run(cmd, retry_count - 1)
+            raise
+        except BaseException:
+            self._release(session, False)
+            raise
+        self._release(session, True)
+        return stdout, stderr
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            sessions = self._idle_sessions
+            self._idle_sessions = []
+        for session in sessions:
+            session.close()
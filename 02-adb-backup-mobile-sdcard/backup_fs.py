@@ -0,0 +1,150 @@
+# Version 1.0
+# Read-only file system view of the backup database, directory listings are queried from the database (kept in a LRU
+# cache) and file contents are read from the stored objects via mmap (or via the object store for the objects stored in
+# chunks). The view can be mounted via fusepy (optional dependency), or driven directly by calling the operations.
+import errno
+import mmap
+import os
+import posixpath
+import stat
+import threading
+from collections import OrderedDict
+from typing import *
+from backup_manager import BackupManager
+from entity import FileMeta
+from exceptions import PathNotFoundException
+from util import get_datetime_timestamp
+
+
+def _os_error(code: int, path: str) -> OSError:
+    return OSError(code, os.strerror(code), path)
+
+
+class BackupFileSystem:
+    """
+    Operations of the view, following the signatures of fusepy, paths are absolute paths relative to the root
+    """
+    # operations exposed to fuse
+    _FUSE_OPERATIONS = ['getattr', 'readdir', 'open', 'read', 'release']
+
+    def __init__(self, manager: BackupManager, root: str = '/', snapshot_id: Optional[int] = None,
+                 cache_size: int = 1024):
+        """
+        :param manager: the backup manager to read database and objects from
+        :param root: directory in database shown as the root of the view
+        :param snapshot_id: snapshot to read, None for the current database
+        :param cache_size: max count of directory listings cached
+        """
+        assert cache_size > 0, 'cache_size must be positive'
+        self._manager = manager
+        self._root = posixpath.normpath(posixpath.join('/', root))
+        self._snapshot_id = snapshot_id
+        self._cache_size = cache_size
+        self._dir_cache = OrderedDict()  # type: OrderedDict[str, Dict[str, FileMeta]]
+        # file objects are only used with the lock held if not mapped
+        self._handles = {}  # type: Dict[int, Tuple[BinaryIO, Optional[mmap.mmap], threading.Lock]]
+        self._next_handle = 1
+        self._lock = threading.Lock()
+
+    def _db_path(self, path: str) -> str:
+        return posixpath.normpath(posixpath.join(self._root, path.lstrip('/')))
+
+    def _list_dir(self, db_path: str) -> Dict[str, FileMeta]:
+        with self._lock:
+            files = self._dir_cache.get(db_path)
+            if files is not None:
+                self._dir_cache.move_to_end(db_path)
+                return files
+        try:
+            files = dict([(x.file_name, x) for x in self._manager.list_database(db_path, self._snapshot_id)])
+        except PathNotFoundException:
+            raise _os_error(errno.ENOENT, db_path)
+        with self._lock:
+            self._dir_cache[db_path] = files
+            while len(self._dir_cache) > self._cache_size:
+                self._dir_cache.popitem(last=False)
+        return files
+
+    def _lookup(self, path: str) -> Optional[FileMeta]:
+        # None for the root
+        db_path = self._db_path(path)
+        if db_path == self._root:
+            return None
+        parent_path, file_name = posixpath.split(db_path)
+        meta = self._list_dir(parent_path).get(file_name)
+        if meta is None:
+            raise _os_error(errno.ENOENT, path)
+        return meta
+
+    def getattr(self, path: str, fh: Optional[int] = None) -> Dict[str, Any]:
+        meta = self._lookup(path)
+        if meta is None or meta.is_dir:
+            if meta is None:
+                # the root should be a directory
+                self._list_dir(self._root)
+            attr = {'st_mode': stat.S_IFDIR | 0o555, 'st_nlink': 2, 'st_size': 0}
+        else:
+            attr = {'st_mode': stat.S_IFREG | 0o444, 'st_nlink': 1, 'st_size': meta.file_size}
+        if meta is not None:
+            attr['st_atime'] = get_datetime_timestamp(meta.access_time)
+            attr['st_mtime'] = get_datetime_timestamp(meta.mod_time)
+            attr['st_ctime'] = get_datetime_timestamp(meta.create_time)
+        return attr
+
+    def readdir(self, path: str, fh: Optional[int] = None) -> List[str]:
+        meta = self._lookup(path)
+        if meta is not None and not meta.is_dir:
+            raise _os_error(errno.ENOTDIR, path)
+        return ['.', '..'] + sorted(self._list_dir(self._db_path(path)).keys())
+
+    def open(self, path: str, flags: int) -> int:
+        if flags & (os.O_WRONLY | os.O_RDWR | os.O_APPEND | os.O_TRUNC):
+            raise _os_error(errno.EROFS, path)
+        meta = self._lookup(path)
+        if meta is None or meta.is_dir:
+            raise _os_error(errno.EISDIR, path)
+        raw_path = self._manager.object_store.raw_path(meta.sha256)
+        fp = open(raw_path, 'rb') if raw_path is not None else self._manager.object_store.open(meta.sha256)
+        try:
+            # empty file can't be mapped
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if raw_path is not None and meta.file_size > 0 \
+                else None
+        except BaseException:
+            fp.close()
+            raise
+        with self._lock:
+            fh = self._next_handle
+            self._next_handle += 1
+            self._handles[fh] = (fp, mm, threading.Lock())
+        return fh
+
+    def read(self, path: str, size: int, offset: int, fh: int) -> bytes:
+        with self._lock:
+            handle = self._handles.get(fh)
+        if handle is None:
+            raise _os_error(errno.EBADF, path)
+        fp, mm, lock = handle
+        if mm is not None:
+            return mm[offset:offset + size]
+        with lock:
+            fp.seek(offset)
+            return fp.read(size)
+
+    def release(self, path: str, fh: int) -> int:
+        with self._lock:
+            handle = self._handles.pop(fh, None)
+        if handle is not None:
+            fp, mm, _ = handle
+            if mm is not None:
+                mm.close()
+            fp.close()
+        return 0
+
+    def mount(self, mount_point: str):
+        """
+        Mount the view via fusepy (pip install fusepy), blocks until unmounted
+        """
+        import fuse
+        operations = type('BackupFileSystemOperations', (fuse.Operations,),
+                          dict([(x, staticmethod(getattr(self, x))) for x in self._FUSE_OPERATIONS]))
+        fuse.FUSE(operations(), mount_point, foreground=True, ro=True)
@@ -2,15 +2,25 @@ import os
 from sql_accessor import SqliteAccessor
 from entity import *
 from exceptions import *
-from util import spawn_process, get_datetime_timestamp
+from util import spawn_process, iter_process_lines, get_datetime_timestamp
+from adb_shell_pool import AdbShellPool, AdbShellTimeoutException
+from object_store import ObjectStore, RawObjectStore, ChunkedObjectStore, PackedObjectStore
 import re
 import datetime
 import shutil
 import hashlib
 # from time import time
 import threading
+import functools
+import itertools
 from thread_safe_buffer_queue import ThreadSafeBufferQueue, QueueClosedException
 import traceback
+import subprocess
+import tarfile
+import heapq
+import sqlite3
+import mmap
+import time
 from warnings import warn
 
 
@@ -23,6 +33,11 @@ ls_al_pattern = re.compile(r'^(?P<permission>[dcbl-]([r-][w-][x-]){3}\+?)\s+'
                            r'((?P<file_size>\d+)\s+)?'
                            r'(?P<last_modification>\d+-\d+-\d+\s\d+:\d+)\s'
                            r'(?P<name>.+?)\s*$')
+# errors of find and stat reported on a path, e.g. "find: '/sdcard/x': Permission denied" (GNU) or
+# "find: /sdcard/x: Permission denied" (toybox)
+scan_error_pattern = re.compile(r"^(find|stat): (cannot \w+ )?'?(?P<path>/.*?)'?: [^:]+$")
+# printed after find exits, so a scan without it is cut off
+_SCAN_END_MARKER = '--scan-end--'
 
 
 class _StatusStatistics:
@@ -31,9 +46,54 @@ class _StatusStatistics:
         self.current_files = 0
         self.total_dirs = 1
         self.current_dirs = 0
+        # directories being processed by workers, queues can't be closed until they are finished
+        self.active_dirs = 0
         self.adb_sem = threading.Semaphore(thread_count)
         self.lock = threading.RLock()
-    __slots__ = ['total_files', 'current_files', 'total_dirs', 'current_dirs', 'lock', 'adb_sem']
+    __slots__ = ['total_files', 'current_files', 'total_dirs', 'current_dirs', 'active_dirs', 'lock', 'adb_sem']
+
+
+class _DirectoryBatch:
+    # collecting the files of a directory, so that they can be pulled in one tar stream, and the synced files are
+    # written to database in one batch, the meta of the directory is written after all of its files are synced
+    def __init__(self, file_count: int, max_pull_size: int, max_write_size: int,
+                 dir_meta: Optional[FileMeta] = None):
+        self.pull_remaining = file_count
+        self.write_remaining = file_count
+        self.max_pull_size = max_pull_size
+        self.max_write_size = max_write_size
+        self.pull_files = []
+        self.synced_files = []
+        self.dir_meta = dir_meta
+        self.lock = threading.Lock()
+    __slots__ = ['pull_remaining', 'write_remaining', 'max_pull_size', 'max_write_size', 'pull_files', 'synced_files',
+                 'dir_meta', 'lock']
+
+    def finish_stat(self, files: List[Tuple[str, FileMeta]]) -> List[Tuple[str, FileMeta]]:
+        # called once for each file in the directory, returns the batch to pull when it is full or all files finished
+        with self.lock:
+            self.pull_files.extend(files)
+            self.pull_remaining -= 1
+            if self.pull_remaining > 0 and len(self.pull_files) < self.max_pull_size:
+                return []
+            files = self.pull_files
+            self.pull_files = []
+            return files
+
+    def finish_pull(self, file_count: int, synced_files: List[Tuple[str, Optional[FileMeta]]], failed_count: int = 0) \
+            -> Tuple[List[Tuple[str, Optional[FileMeta]]], Optional[FileMeta]]:
+        # called after file_count files are pulled, skipped or failed, returns the files to write when the batch is full
+        # or all files finished, and the directory meta to write after them once all files finished without failure
+        with self.lock:
+            self.synced_files.extend(synced_files)
+            self.write_remaining -= file_count
+            if failed_count > 0:
+                self.dir_meta = None
+            if self.write_remaining > 0 and len(self.synced_files) < self.max_write_size:
+                return [], None
+            synced_files = self.synced_files
+            self.synced_files = []
+            return synced_files, self.dir_meta if self.write_remaining == 0 else None
 
 
 # noinspection PyUnresolvedReferences
@@ -41,24 +101,132 @@ class BackupManager:
     _ST_FILE = 1
     _ST_DIR = 0
     _ST_NOT_FOUND = -1
+    # limitations for pulling small files in a single tar stream
+    _BATCH_PULL_MAX_FILE_SIZE = 1048576
+    _BATCH_PULL_MAX_FILES = 256
+    _BATCH_PULL_MAX_CMD_LENGTH = 32768
+    # max count of synced files written to database in one batch
+    _SYNC_WRITE_BATCH_SIZE = 256
+    # database is committed once the count of written rows reaches this value
+    _GROUP_COMMIT_SIZE = 8192
+    # max count of values in an "in" condition of a single statement
+    _IN_BATCH_SIZE = 500
+    # recording the state at the last snapshot of the files changed after it, path is kept as text since path_id of a
+    # directory changes once it is removed and created again
+    _SNAPSHOT_TRIGGERS = [
+        "create trigger if not exists file_meta_history_insert after insert on file_meta "
+        "when exists (select 1 from snapshot) "
+        "begin insert into file_meta_history(snapshot_id, path, file_name) "
+        "select (select max(snapshot_id) from snapshot), path, new.file_name from directory_meta "
+        "where path_id = new.path_id on conflict(path, file_name, snapshot_id) do nothing; end",
+        "create trigger if not exists file_meta_history_delete after delete on file_meta "
+        "when exists (select 1 from snapshot) "
+        "begin insert into file_meta_history(snapshot_id, path, file_name, file_size, access_time, mod_time, "
+        "create_time, md5, sha256, is_dir) "
+        "select (select max(snapshot_id) from snapshot), path, old.file_name, old.file_size, old.access_time, "
+        "old.mod_time, old.create_time, old.md5, old.sha256, old.is_dir from directory_meta "
+        "where path_id = old.path_id on conflict(path, file_name, snapshot_id) do nothing; end",
+        "create trigger if not exists file_meta_history_update after update of file_size, mod_time, sha256, is_dir "
+        "on file_meta when exists (select 1 from snapshot) and (old.file_size is not new.file_size or "
+        "old.mod_time is not new.mod_time or old.sha256 is not new.sha256 or old.is_dir is not new.is_dir) "
+        "begin insert into file_meta_history(snapshot_id, path, file_name, file_size, access_time, mod_time, "
+        "create_time, md5, sha256, is_dir) "
+        "select (select max(snapshot_id) from snapshot), path, old.file_name, old.file_size, old.access_time, "
+        "old.mod_time, old.create_time, old.md5, old.sha256, old.is_dir from directory_meta "
+        "where path_id = old.path_id on conflict(path, file_name, snapshot_id) do nothing; end"
+    ]
+    # keeping object_refs up to date with file_meta and file_meta_history, references from the backups created before
+    # snapshots are introduced are counted by _add_backup_refs
+    _OBJECT_REFS_TRIGGERS = [
+        "create trigger if not exists file_meta_ref_insert after insert on file_meta when new.sha256 is not null "
+        "begin insert into object_refs(sha256, refcount, size) values (new.sha256, 1, new.file_size) "
+        "on conflict(sha256) do update set refcount = refcount + 1; end",
+        "create trigger if not exists file_meta_ref_delete after delete on file_meta when old.sha256 is not null "
+        "begin update object_refs set refcount = refcount - 1 where sha256 = old.sha256; end",
+        "create trigger if not exists file_meta_ref_update after update of sha256 on file_meta "
+        "when old.sha256 is not new.sha256 "
+        "begin update object_refs set refcount = refcount - 1 where sha256 = old.sha256; "
+        "insert into object_refs(sha256, refcount, size) select new.sha256, 1, new.file_size "
+        "where new.sha256 is not null on conflict(sha256) do update set refcount = refcount + 1; end",
+        "create trigger if not exists file_meta_history_ref_insert after insert on file_meta_history "
+        "when new.sha256 is not null "
+        "begin insert into object_refs(sha256, refcount, size) values (new.sha256, 1, new.file_size) "
+        "on conflict(sha256) do update set refcount = refcount + 1; end",
+        "create trigger if not exists file_meta_history_ref_delete after delete on file_meta_history "
+        "when old.sha256 is not null "
+        "begin update object_refs set refcount = refcount - 1 where sha256 = old.sha256; end"
+    ]
+    # keeping directory_closure up to date with directory_meta, a directory is inserted after its parent and removed
+    # together with its subtree
+    _DIRECTORY_CLOSURE_TRIGGERS = [
+        "create trigger if not exists directory_closure_insert after insert on directory_meta "
+        "begin insert into directory_closure(ancestor_id, descendant_id, depth) "
+        "select ancestor_id, new.path_id, depth + 1 from directory_closure where descendant_id = new.parent_id "
+        "union all select new.path_id, new.path_id, 0; end",
+        "create trigger if not exists directory_closure_delete after delete on directory_meta "
+        "begin delete from directory_closure where descendant_id = old.path_id or ancestor_id = old.path_id; end"
+    ]
+    _OBJECT_STORES = ['raw', 'chunked']
+    # algorithms of the content hash naming the objects (stored in sha256 columns), all of them produce 32 bytes
+    _HASH_ALGORITHMS = ['sha256', 'blake2b', 'blake3']
+    # ways to materialize the objects when mapping database to file system
+    _LINK_MODES = ['copy', 'hardlink', 'reflink', 'symlink']
+    # ioctl request of cloning a file on linux (btrfs, xfs)
+    _FICLONE = 0x40049409
+    # job types of sync journal
+    _JOB_DIR = 0
+    _JOB_FILE = 1
 
-    def __init__(self, path: str, thread_count: int = 4, max_history_backup: int = 30):
+    def __init__(self, path: str, thread_count: int = 4, max_history_backup: int = 30,
+                 io_buffer_size: int = 1048576, device_hash: bool = False, wal_mode: bool = False,
+                 sqlite_pragmas: Optional[Dict[str, Any]] = None, object_store: Optional[str] = None,
+                 compression: Optional[str] = None, pack_threshold: Optional[int] = None):
         if not os.path.exists(path):
             os.makedirs(path, exist_ok=True)
         assert os.path.isdir(path), 'path must be a directory'
         assert thread_count > 0, 'thread_count must be positive'
         assert max_history_backup > 0, 'max_history_backup must be positive'
+        assert io_buffer_size > 0, 'io_buffer_size must be positive'
         self._path = path
         self._sql_file = os.path.join(self._path, 'entries.db')
         if not os.path.isfile(self._sql_file):
             open(self._sql_file, 'wb').close()
-        self._sql_conn = SqliteAccessor(self._sql_file)
-        # creating repository directory
-        for i in range(256):
-            os.makedirs(os.path.join(self._path, 'objects', '%02x' % i), exist_ok=True)
-        spawn_process('adb start-server', 'utf8')
+        self._sql_conn = SqliteAccessor(self._sql_file, wal_mode=wal_mode, pragmas=sqlite_pragmas,
+                                        group_commit_size=self._GROUP_COMMIT_SIZE)
+        # the object store of the repository is kept unless specified
+        stored_object_store = self._sql_conn.get_variable('object_store', 'raw')
+        object_store = object_store or stored_object_store
+        compression = compression or self._sql_conn.get_variable('object_compression', 'zlib')
+        assert object_store in self._OBJECT_STORES, 'Invalid object store %s' % object_store
+        assert object_store == stored_object_store or stored_object_store == 'raw', \
+            'Objects stored in chunks can not be read by %s object store' % object_store
+        if object_store == 'chunked':
+            self._objects = ChunkedObjectStore(self._path, compression, io_buffer_size)  # type: ObjectStore
+        else:
+            self._objects = RawObjectStore(self._path)  # type: ObjectStore
+        # objects smaller than pack_threshold bytes are appended to pack files, packed objects are readable even if
+        # packing is turned off (0) later
+        if pack_threshold is None:
+            pack_threshold = int(self._sql_conn.get_variable('pack_threshold', '0'))
+        self._objects = PackedObjectStore(self._objects, self._path, self._sql_conn, pack_threshold)
+        self._sql_conn.set_variable('object_store', object_store)
+        self._sql_conn.set_variable('object_compression', compression)
+        self._sql_conn.set_variable('pack_threshold', str(pack_threshold))
+        self._sql_conn.commit()
+        spawn_process(['adb', 'start-server'], 'utf8')
+        # long-lived "adb shell" sessions for ls, stat, mkdir and rm commands
+        self._shell = AdbShellPool(thread_count)
         self._thread_count = thread_count
         self._max_history_backup = max_history_backup
+        self._io_buffer_size = io_buffer_size
+        self._push_locks = [threading.Lock() for _ in range(64)]
+        # falling back to copy when linking objects is warned once per map_database_to_fs
+        self._link_fallback_warned = False
+        # hash files on the device before pulling, skipping the files whose content is already stored
+        self._device_hash = device_hash
+        self._init_directory_closure()
+        self._init_object_refs()
+        self._init_hash()
 
     def _list_backup_db_file(self):
         candidate_db_files = []
@@ -71,31 +239,225 @@ class BackupManager:
         candidate_db_files.sort(key=lambda x: x[1], reverse=True)
         return [os.path.join(self._path, x[0]) for x in candidate_db_files]
     
-    def _backup_db(self):
-        print('Backing up database file.')
-        today = datetime.datetime.now()
-        today_backup_file_name = 'entries.db.%d.%d.%d.bak' % (today.year, today.month, today.day)
-        today_backup_file = os.path.join(self._path, today_backup_file_name)
-        with open(today_backup_file, 'wb') as f_out:
-            with open(self._sql_file, 'rb') as f_in:
-                while True:
-                    buffer = f_in.read(4096)
-                    f_out.write(buffer)
-                    if len(buffer) == 0:
-                        break
-        candidate_db_files = self._list_backup_db_file()
-        for file in candidate_db_files[self._max_history_backup:]:
-            os.remove(os.path.join(self._path, file))
+    def _init_directory_closure(self):
+        self._sql_conn.ensure_table(DirectoryMeta)
+        self._sql_conn.ensure_table(DirectoryClosure)
+        if self._sql_conn.get_variable('directory_closure_built', '0') != '1':
+            self._rebuild_directory_closure()
+            self._sql_conn.set_variable('directory_closure_built', '1')
+        for sql in self._DIRECTORY_CLOSURE_TRIGGERS:
+            self._sql_conn.execute(sql)
+        self._sql_conn.commit()
+
+    def _rebuild_directory_closure(self):
+        # filling parent_id and directory_closure from the paths, for the repository created before they are introduced
+        if 'parent_id' not in [x[1] for x in self._sql_conn.execute('pragma table_info(directory_meta)')]:
+            self._sql_conn.execute('alter table directory_meta add column parent_id integer')
+        path_ids = dict([(x[1], x[0]) for x in self._sql_conn.execute('select path_id, path from directory_meta')])
+        if len(path_ids) == 0:
+            return
+        print('Building directory tree.')
+        self._sql_conn.execute_many('update directory_meta set parent_id = ? where path_id = ?',
+                                    [(path_ids.get(self._abs_path(path + '/..')), path_id)
+                                     for path, path_id in path_ids.items() if path != '/'])
+        self._sql_conn.delete(DirectoryClosure)
+        self._sql_conn.execute('insert into directory_closure(ancestor_id, descendant_id, depth) '
+                               'with recursive closure(ancestor_id, descendant_id, depth) as '
+                               '(select path_id, path_id, 0 from directory_meta union all '
+                               'select d.parent_id, c.descendant_id, c.depth + 1 from closure c '
+                               'join directory_meta d on d.path_id = c.ancestor_id where d.parent_id is not null) '
+                               'select ancestor_id, descendant_id, depth from closure')
+
+    def _init_object_refs(self):
+        self._sql_conn.ensure_table(FileMeta)
+        self._sql_conn.ensure_table(ObjectRefs)
+        self._sql_conn.ensure_table(Snapshot)
+        self._sql_conn.ensure_table(FileMetaHistory)
+        self._sql_conn.ensure_table(ObjectVerification)
+        for sql in self._SNAPSHOT_TRIGGERS + self._OBJECT_REFS_TRIGGERS:
+            self._sql_conn.execute(sql)
+        if self._sql_conn.get_variable('object_refs_built', '0') != '1':
+            self._rebuild_object_refs()
+            self._sql_conn.set_variable('object_refs_built', '1')
+        self._sql_conn.commit()
+
+    def _init_hash(self):
+        # the hash algorithm is kept by the repository, and only changed by migrate_hash()
+        self._hash_algorithm = self._sql_conn.get_variable('hash_algorithm', 'sha256')
+        self._hash_md5 = self._sql_conn.get_variable('hash_md5', '0') == '1'
+        assert self._hash_algorithm in self._HASH_ALGORITHMS, 'Invalid hash algorithm %s' % self._hash_algorithm
+        self._new_hash()
+        if self._device_hash and self._hash_algorithm != 'sha256':
+            warn('Device-side hash check only supports sha256, it is disabled for %s' % self._hash_algorithm)
+            self._device_hash = False
+        # md5 is not used for looking up files, its index is only kept while md5 is computed
+        if self._hash_md5:
+            self._sql_conn.execute('create index if not exists index_md5 on file_meta(md5)')
+        else:
+            self._sql_conn.execute('drop index if exists index_md5')
+        self._sql_conn.commit()
+        if self._sql_conn.get_variable('hash_migration_pending', '0') == '1':
+            self._finish_hash_migration()
+
+    def _new_hash(self, algorithm: Optional[str] = None) -> Any:
+        algorithm = algorithm or self._hash_algorithm
+        if algorithm == 'blake2b':
+            return hashlib.blake2b(digest_size=32)
+        elif algorithm == 'blake3':
+            # blake3 package is only required for blake3
+            import blake3
+            return blake3.blake3()
+        return hashlib.sha256()
+
+    def _rebuild_object_refs(self):
+        # counting the references from scratch, for the repository created before object_refs is introduced
+        print('Building object references.')
+        self._sql_conn.delete(ObjectRefs)
+        self._sql_conn.execute('insert into object_refs(sha256, refcount, size) select sha256, count(1), '
+                               'max(file_size) from (select sha256, file_size from file_meta union all '
+                               'select sha256, file_size from file_meta_history) where sha256 is not null '
+                               'group by sha256')
+        for db_file in self._list_backup_db_file():
+            self._add_backup_refs(db_file, 1)
+        # objects not referenced by any database are garbage
+        for shard in range(256):
+            objects = [(x, self._objects.size(x)) for x in self._objects.list_shard(shard)]
+            self._sql_conn.execute_many('insert into object_refs(sha256, refcount, size) values (?, 0, ?) '
+                                        'on conflict(sha256) do nothing', objects)
+
+    def _add_backup_refs(self, db_file: str, sign: int):
+        # add (sign = 1) or remove (sign = -1) the references from a backup database
+        conn = sqlite3.connect(db_file)
+        try:
+            if conn.execute("select count(1) from sqlite_master where type = 'table' and name = 'file_meta'") \
+                    .fetchone()[0] == 0:
+                return
+            cursor = conn.execute('select sha256, count(1), max(file_size) from file_meta where sha256 is not null '
+                                  'group by sha256')
+            self._sql_conn.execute_many('insert into object_refs(sha256, refcount, size) values (?, ?, ?) '
+                                        'on conflict(sha256) do update set refcount = refcount + excluded.refcount',
+                                        ((x[0], sign * x[1], x[2]) for x in cursor))
+        finally:
+            conn.close()
+
+    def _take_snapshot(self):
+        # a snapshot is a marker, the files changed after it are recorded to file_meta_history by triggers, so that
+        # the cost depends on the change set instead of the size of the database
+        print('Taking snapshot of database.')
+        now = datetime.datetime.now()
+        last_snapshot_id = self._sql_conn.execute('select max(snapshot_id) from snapshot')[0][0]
+        if last_snapshot_id is not None:
+            last_snapshot = self._sql_conn.select(Snapshot, 1, snapshot_id=last_snapshot_id)
+            if last_snapshot.create_time.date() == now.date():
+                # the snapshot of today is replaced
+                self._drop_snapshot(last_snapshot_id)
+        self._sql_conn.insert(Snapshot(create_time=now))
+        # the backups created before snapshots are introduced are older than any snapshot, so they are removed first
+        backup_db_files = self._list_backup_db_file()
+        snapshot_ids = [x[0] for x in self._sql_conn.execute('select snapshot_id from snapshot order by snapshot_id')]
+        excess_count = len(backup_db_files) + len(snapshot_ids) - self._max_history_backup
+        for file in backup_db_files[::-1][:max(excess_count, 0)]:
+            self._add_backup_refs(file, -1)
+            os.remove(file)
+        for snapshot_id in snapshot_ids[:max(excess_count - len(backup_db_files), 0)]:
+            self._drop_snapshot(snapshot_id)
+        self._sql_conn.commit()
+        print('Done.')
+
+    def _drop_snapshot(self, snapshot_id: int):
+        # the state recorded at the dropped snapshot is also the state at the previous one, unless the file is recorded
+        # at the previous one already
+        prev_snapshot_id = self._sql_conn.execute('select max(snapshot_id) from snapshot where snapshot_id < ?',
+                                                  (snapshot_id,))[0][0]
+        if prev_snapshot_id is not None:
+            self._sql_conn.execute('update file_meta_history set snapshot_id = ? where snapshot_id = ? and not exists '
+                                   '(select 1 from file_meta_history h where h.path = file_meta_history.path and '
+                                   'h.file_name = file_meta_history.file_name and h.snapshot_id = ?)',
+                                   (prev_snapshot_id, snapshot_id, prev_snapshot_id))
+        self._sql_conn.delete(FileMetaHistory, snapshot_id=snapshot_id)
+        self._sql_conn.delete(Snapshot, snapshot_id=snapshot_id)
+
+    def export_database(self, dst_path: str):
+        # a full copy of the database (with all snapshots) via sqlite online backup api
+        assert not os.path.exists(dst_path), 'Destination %s already exists' % dst_path
+        print('Exporting database to %s' % dst_path)
+        self._sql_conn.backup(dst_path)
         print('Done.')
 
-    def list_database(self, path: str) -> List[FileMeta]:
+    def find_snapshot(self, date: datetime.date) -> int:
+        # the last snapshot taken on or before the date
+        end_time = datetime.datetime(date.year, date.month, date.day) + datetime.timedelta(days=1)
+        snapshot_id = self._sql_conn.execute('select max(snapshot_id) from snapshot where create_time < ?',
+                                             (end_time,))[0][0]
+        if snapshot_id is None:
+            raise ValueError('No snapshot is taken on or before %s' % date)
+        return snapshot_id
+
+    def _list_snapshot_dir(self, path: str, snapshot_id: int) -> Dict[str, FileMeta]:
+        # the files in database overlaid by their earliest recorded state not before the snapshot, path_id of the
+        # recorded files is None
+        dir_meta = self._sql_conn.select(DirectoryMeta, 1, path=path)
+        files = {}
+        if dir_meta is not None:
+            files = dict([(x.file_name, x) for x in self._sql_conn.select(FileMeta, 0, path_id=dir_meta.path_id)])
+        rows = self._sql_conn.execute('select file_name, min(snapshot_id), file_size, access_time, mod_time, '
+                                      'create_time, md5, sha256, is_dir from file_meta_history '
+                                      'where path = ? and snapshot_id >= ? group by file_name', (path, snapshot_id))
+        for file_name, _, file_size, access_time, mod_time, create_time, md5, sha256, is_dir in rows:
+            if file_size is None:
+                files.pop(file_name, None)
+            else:
+                files[file_name] = FileMeta(path_id=None, file_name=file_name, file_size=file_size,
+                                            access_time=access_time, mod_time=mod_time, create_time=create_time,
+                                            md5=md5, sha256=sha256, is_dir=is_dir)
+        return files
+
+    def list_database(self, path: str, snapshot_id: Optional[int] = None) -> List[FileMeta]:
         path = self._abs_path(path)
+        if snapshot_id is not None:
+            if self._stat_snapshot_path(path, snapshot_id)[0] != self._ST_DIR:
+                raise PathNotFoundException()
+            return list(self._list_snapshot_dir(path, snapshot_id).values())
         dir_info = self._sql_conn.select(DirectoryMeta, 1, path=path)
         if dir_info is None:
             raise PathNotFoundException()
         else:
             return self._sql_conn.select(FileMeta, 0, path_id=dir_info.path_id)
 
+    def database_usage(self, path: str) -> Tuple[int, int, int]:
+        """
+        Count the directories, files and total file size under a path in database
+        :param path: file or directory in database
+        :return: (directory count, file count, file size in bytes), the directory itself is not counted
+        """
+        path = self._abs_path(path)
+        dir_meta = self._sql_conn.select(DirectoryMeta, 1, path=path)
+        if dir_meta is None:
+            parent_dir = self._sql_conn.select(DirectoryMeta, 1, path=self._abs_path(path + '/..')) \
+                if path != '/' else None
+            meta = self._sql_conn.select(FileMeta, 1, path_id=parent_dir.path_id, file_name=self._file_name(path)) \
+                if parent_dir is not None else None
+            if meta is None:
+                raise PathNotFoundException()
+            # a directory without directory_meta is empty
+            return (0, 0, 0) if meta.is_dir else (0, 1, meta.file_size)
+        # the files of the whole subtree are joined via directory_closure in a single query
+        dir_count, file_count, file_size = self._sql_conn.execute(
+            'select coalesce(sum(f.is_dir), 0), coalesce(sum(1 - f.is_dir), 0), '
+            'coalesce(sum(f.file_size * (1 - f.is_dir)), 0) from directory_closure c '
+            'join file_meta f on f.path_id = c.descendant_id where c.ancestor_id = ?', (dir_meta.path_id,))[0]
+        return dir_count, file_count, file_size
+
+    def _stat_snapshot_path(self, path: str, snapshot_id: int) -> Tuple[int, Optional[FileMeta]]:
+        # the directory which does not exist at the snapshot has nothing listed, since its files are all recorded as
+        # not existing
+        if path == '/':
+            return self._ST_DIR, None
+        meta = self._list_snapshot_dir(self._abs_path(path + '/..'), snapshot_id).get(self._file_name(path))
+        if meta is None:
+            return self._ST_NOT_FOUND, None
+        return self._ST_DIR if meta.is_dir else self._ST_FILE, meta
+
     def _stat_path(self, path: str) -> Tuple[int, int]:
         dir_meta = self._sql_conn.select(DirectoryMeta, 1, path=path)
         if dir_meta is None:
@@ -138,19 +500,18 @@ class BackupManager:
         part = path.split('.')
         return '.'.join(part[:-1]), part[-1]
 
-    @staticmethod
-    def _adb_ls(path: str, retry_count: int = 5) -> Tuple[List[str], List[str]]:
+    def _adb_ls(self, path: str, retry_count: int = 5) -> Tuple[List[str], List[str]]:
         if retry_count == 0:
             raise RuntimeError('Adb repeatedly returned empty ls result for path %s' % path)
         if not path.endswith('/'):
             path = path + '/'
         # escape char (') in linux shell
-        path = path.replace("'", "'\"'\"'")
-        stdout, stderr = spawn_process(['adb', 'shell', 'ls', '-al', "'%s'" % path], 'utf8')
+        path_escaped = path.replace("'", "'\"'\"'")
+        stdout, stderr = self._shell.run("ls -al '%s'" % path_escaped)
         if len(stderr) > 0:
             raise RuntimeError(stderr)
         if len(stdout) == 0:
-            return BackupManager._adb_ls(path, retry_count - 1)
+            return self._adb_ls(path, retry_count - 1)
         dirs = []
         files = []
         for line in stdout.split('\n'):
@@ -177,28 +538,83 @@ class BackupManager:
             raise RuntimeError('Adb repeatedly returned empty stat result for path %s' % path)
         # escape char (') in linux shell
         path_escaped = path.replace("'", "'\"'\"'")
-        stdout, stderr = spawn_process(['adb', 'shell', 'stat', '-L', '-c', "'%A/%s/%X/%Y/%W/%n'",
-                                        "'%s'" % path_escaped], 'utf8')
+        stdout, stderr = self._shell.run("stat -L -c '%%A/%%s/%%X/%%Y/%%W/%%n' '%s'" % path_escaped)
         if len(stderr) > 0:
             raise RuntimeError(stderr)
         if len(stdout) == 0:  # unknown reason for stat returns nothing
             return self._adb_stat(path, retry_count - 1)
         parts = stdout.rstrip('\r\n').split('/')
-
-        def _cvt_ts(x):
-            return 0 if x == '?' else int(x)
         # debug
         try:
-            return FileMeta(path_id=0, file_name=parts[-1], file_size=int(parts[1]),
-                            access_time=datetime.datetime.fromtimestamp(_cvt_ts(parts[2])),
-                            mod_time=datetime.datetime.fromtimestamp(_cvt_ts(parts[3])),
-                            create_time=datetime.datetime.fromtimestamp(_cvt_ts(parts[4])),
-                            is_dir=int(parts[0][0] == 'd'))
+            return self._parse_stat_result(parts[:5] + [parts[-1]])
         except IndexError:
             warn('Invalid scheme: "%s" for path "%s"' % (stdout, path))
             raise
 
-    def _pull_file(self, path: str, meta: FileMeta):
+    @staticmethod
+    def _parse_stat_result(parts: List[str]) -> FileMeta:
+        # parts: the output of stat -c '%A/%s/%X/%Y/%W/%n' split by '/', with file name as the last part
+        def _cvt_ts(x):
+            return 0 if x == '?' else int(x)
+        return FileMeta(path_id=0, file_name=parts[5], file_size=int(parts[1]),
+                        access_time=datetime.datetime.fromtimestamp(_cvt_ts(parts[2])),
+                        mod_time=datetime.datetime.fromtimestamp(_cvt_ts(parts[3])),
+                        create_time=datetime.datetime.fromtimestamp(_cvt_ts(parts[4])),
+                        is_dir=int(parts[0][0] == 'd'))
+
+    @staticmethod
+    def _adb_bulk_stat(path: str, error_paths: Set[Optional[str]]) -> Iterator[Tuple[str, FileMeta]]:
+        # stat the whole tree in one adb call, yielding (remote path, meta) in pre-order, symbolic links are skipped
+        # as what _adb_ls does, the paths failed to be listed or stat are added to error_paths (None if the path is not
+        # known), and IncompleteScanException is raised if the scan is cut off
+        path_escaped = path.replace("'", "'\"'\"'")
+        # errors are merged into stdout, so they come before leaving the directory in the scan order
+        cmd = "find -H '%s' \\( -type f -o -type d \\) -exec stat -c '%%A/%%s/%%X/%%Y/%%W/%%n' {} + 2>&1; echo '%s'" \
+              % (path_escaped, _SCAN_END_MARKER)
+        finished = False
+        try:
+            for line in iter_process_lines(['adb', 'shell', cmd], 'utf8'):
+                if not line.endswith('\n'):
+                    # the last line of a broken stream may be truncated
+                    break
+                line = line.rstrip('\r\n')
+                if line == _SCAN_END_MARKER:
+                    finished = True
+                    continue
+                parts = line.split('/', 5)
+                try:
+                    meta = BackupManager._parse_stat_result(parts)
+                except (IndexError, ValueError):
+                    warn('Invalid scheme: "%s" while scanning path "%s"' % (line, path))
+                    match = re.search(scan_error_pattern, line)
+                    error_paths.add(match.group('path') if match is not None else None)
+                    continue
+                remote_path = parts[5]
+                meta.file_name = BackupManager._file_name(remote_path)
+                yield remote_path, meta
+        except subprocess.CalledProcessError as ex:
+            raise IncompleteScanException('adb exited with status %d' % ex.returncode)
+        if not finished:
+            raise IncompleteScanException('scan output ended unexpectedly')
+
+    def _pull_file(self, path: str, meta: FileMeta) -> bool:
+        # stream the file via "adb exec-out cat" and hash it while receiving, so it is written to disk only once
+        cmd = "cat '%s' 2>/dev/null" % path.replace("'", "'\"'\"'")
+        p = subprocess.Popen(['adb', 'exec-out', cmd], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             bufsize=self._io_buffer_size)
+        try:
+            local_path, file_size = self._receive_object(p.stdout, meta)
+        finally:
+            p.stdout.close()
+            return_code = p.wait()
+        if return_code != 0 or file_size != meta.file_size:
+            # exec-out is unsupported by old devices, or the file is changed or unreadable, retry with adb pull
+            os.remove(local_path)
+            return self._pull_file_by_adb_pull(path, meta)
+        self._store_object(local_path, path, meta)
+        return True
+
+    def _pull_file_by_adb_pull(self, path: str, meta: FileMeta) -> bool:
         local_path = os.path.join(self._path, 'tmp_adb_pull_file_%d' % threading.get_ident())
         try:
             open(local_path, 'wb').close()
@@ -208,64 +624,169 @@ class BackupManager:
             if stdout.startswith("adb: error:"):
                 raise RuntimeError(stdout)
             with open(local_path, 'rb') as f:
-                md5_hash = hashlib.md5()
-                sha256_hash = hashlib.sha256()
-                while True:
-                    b = f.read(4096)
-                    if len(b) == 0:
-                        break
-                    md5_hash.update(b)
-                    sha256_hash.update(b)
-                meta.md5 = md5_hash.digest()
-                meta.sha256 = sha256_hash.digest()
-            dest_path = os.path.join(self._path, 'objects', '%02x' % meta.sha256[0], meta.sha256.hex())
-            if not os.path.exists(dest_path):
-                shutil.move(local_path, dest_path)
-            else:
-                st_dest = os.stat(dest_path)
-                st_src = os.stat(local_path)
-                if st_dest.st_size == st_src.st_size:
-                    os.remove(local_path)
-                else:
-                    raise RuntimeError('Hash conflict for object %s (path: %s)' % (meta.sha256.hex(), path))
-            db_meta = self._sql_conn.select(FileMeta, 1, path_id=meta.path_id, file_name=meta.file_name)
-            if db_meta is None:
-                self._sql_conn.insert(meta)
-            elif meta != db_meta:
-                self._sql_conn.update(meta)
+                self._hash_stream(f, meta)
+            self._store_object(local_path, path, meta)
+            return True
         except FileNotFoundError:
             warn('Could not pull file: %s' % path)
+            return False
 
-    def _reuse_index(self, path_id: int):
-        if path_id >= 0x40000000:
-            cursor = self._sql_conn.cursor()
-            cursor.execute("select path_id from directory_meta order by path_id")
-            path_ids = [x[0] for x in cursor.fetchall()]
-            i = 0
-            while i < len(path_ids):
-                i += 1
-                if i == path_ids[i - 1]:
-                    continue
-                last_path_id = path_ids.pop()
-                cursor.execute("insert into directory_meta(path_id, path) values (?, ?)", (i, 'tmp_path_id_non_used'))
-                cursor.execute("update file_meta set path_id = ? where path_id = ?", (i, last_path_id))
-                cursor.execute("select path from directory_meta where path_id = ?", (last_path_id,))
-                last_path = cursor.fetchone()[0]
-                cursor.execute("delete from directory_meta where path_id = ?", (last_path_id,))
-                cursor.execute("update directory_meta set path = ? where path_id = ?", (last_path, i))
-                path_ids.insert(i - 1, i)
-            cursor.execute("update sqlite_sequence set seq = ? where name = 'directory_meta'", (i,))
-            cursor.close()
-            self._sql_conn.commit()
+    def _store_object(self, local_path: str, path: str, meta: FileMeta):
+        # move the pulled file (with hash computed) to objects, its meta is written to database by the caller
+        try:
+            self._objects.store(local_path, meta.sha256)
+        except RuntimeError as ex:
+            raise RuntimeError('%s (path: %s)' % (str(ex), path))
+        # tracking the object before it is referenced, so it is collected as garbage if its meta is never written
+        self._sql_conn.execute('insert into object_refs(sha256, refcount, size) values (?, 0, ?) '
+                               'on conflict(sha256) do nothing', (meta.sha256, meta.file_size))
+
+    def _hash_stream(self, fp: BinaryIO, meta: FileMeta, out_fp: Optional[BinaryIO] = None) -> int:
+        # compute the hash of file object in a single pass (copying to out_fp if specified), returns the file size
+        content_hash = self._new_hash()
+        md5_hash = hashlib.md5() if self._hash_md5 else None
+        file_size = 0
+        while True:
+            b = fp.read(self._io_buffer_size)
+            if len(b) == 0:
+                break
+            content_hash.update(b)
+            if md5_hash is not None:
+                md5_hash.update(b)
+            if out_fp is not None:
+                out_fp.write(b)
+            file_size += len(b)
+        meta.md5 = md5_hash.digest() if md5_hash is not None else None
+        meta.sha256 = content_hash.digest()
+        return file_size
+
+    def _receive_object(self, fp: BinaryIO, meta: FileMeta) -> Tuple[str, int]:
+        # write the content of file object to a temporary file, computing hash while receiving
+        local_path = os.path.join(self._path, 'tmp_adb_pull_file_%d' % threading.get_ident())
+        with open(local_path, 'wb', buffering=self._io_buffer_size) as f:
+            file_size = self._hash_stream(fp, meta, f)
+        return local_path, file_size
+
+    def _pull_files_tar(self, files: List[Tuple[str, FileMeta]]) \
+            -> Tuple[List[Tuple[str, FileMeta]], List[Tuple[str, FileMeta]]]:
+        # pull files as a single tar stream via "adb exec-out", returns the files stored and the files not stored
+        # (missing from the stream or failed), which are to be pulled one by one
+        stored_files = []
+        pending = dict([(path.lstrip('/'), (path, meta)) for path, meta in files])
+        # stderr is discarded since exec-out may mix it into the stream
+        cmd = 'tar -cf - %s 2>/dev/null' % ' '.join(["'%s'" % x[0].replace("'", "'\"'\"'") for x in files])
+        p = subprocess.Popen(['adb', 'exec-out', cmd], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            with tarfile.open(fileobj=p.stdout, mode='r|') as tar:
+                for member in tar:
+                    item = pending.get(member.name.lstrip('/'))
+                    if item is None or not member.isfile():
+                        continue
+                    try:
+                        local_path, _ = self._receive_object(tar.extractfile(member), item[1])
+                        self._store_object(local_path, item[0], item[1])
+                    except RuntimeError as ex:
+                        warn('Could not pull file %s from tar stream: %s' % (item[0], str(ex)))
+                        continue
+                    # only removed once stored, a file broken in the middle of the stream is retried
+                    del pending[member.name.lstrip('/')]
+                    stored_files.append(item)
+        except (tarfile.TarError, OSError) as ex:
+            warn('Failed to read tar stream: %s' % str(ex))
+        finally:
+            p.stdout.close()
+            p.wait()
+        return stored_files, list(pending.values())
+
+    def _split_batches(self, files: List[Tuple[str, FileMeta]]) -> Iterator[List[Tuple[str, FileMeta]]]:
+        # split files into batches, each of them fits in a single shell command
+        files = list(files)
+        while len(files) > 0:
+            batch = []
+            cmd_length = 0
+            while len(files) > 0 and len(batch) < self._BATCH_PULL_MAX_FILES and \
+                    (len(batch) == 0 or cmd_length + len(files[-1][0]) < self._BATCH_PULL_MAX_CMD_LENGTH):
+                batch.append(files.pop())
+                cmd_length += len(batch[-1][0]) + 3
+            yield batch
+
+    def _reuse_stored_object(self, meta: FileMeta, sha256: bytes) -> bool:
+        # record the file without pulling it if an object with the same hash is already stored
+        if not self._objects.exists(sha256):
+            return False
+        stored_meta = self._sql_conn.select(FileMeta, 1, sha256=sha256)
+        if stored_meta is None:
+            return False
+        meta.sha256 = sha256
+        meta.md5 = stored_meta.md5
+        return True
+
+    def _reuse_stored_objects(self, files: List[Tuple[str, FileMeta]]) \
+            -> Tuple[List[Tuple[str, FileMeta]], List[Tuple[str, FileMeta]]]:
+        # hash the files on the device first, returns the files already stored and the files not stored yet
+        reused_files = []
+        remaining_files = []
+        for batch in self._split_batches(files):
+            if not self._device_hash:
+                remaining_files.extend(batch)
+                continue
+            cmd = 'sha256sum %s' % ' '.join(["'%s'" % x[0].replace("'", "'\"'\"'") for x in batch])
+            try:
+                stdout, stderr = self._shell.run(cmd)
+            except AdbShellTimeoutException as ex:
+                warn('%s, pulling the files without device-side hash check' % ex)
+                remaining_files.extend(batch)
+                continue
+            if len(stdout) == 0 and 'not found' in stderr:
+                warn('sha256sum is not supported by the device, device-side hash check is disabled')
+                self._device_hash = False
+            digests = {}
+            for line in stdout.split('\n'):
+                parts = line.rstrip('\r').split('  ', 1)
+                if len(parts) == 2 and len(parts[0]) == 64:
+                    digests[parts[1]] = parts[0]
+            for path, meta in batch:
+                digest = digests.get(path)
+                if digest is not None and self._reuse_stored_object(meta, bytes.fromhex(digest)):
+                    reused_files.append((path, meta))
+                else:
+                    remaining_files.append((path, meta))
+        return reused_files, remaining_files
+
+    def _pull_files(self, files: List[Tuple[str, FileMeta]]) -> List[Tuple[str, FileMeta]]:
+        # returns the files stored successfully, their metas should be written to database by _save_file_metas
+        stored_files = []
+        if self._device_hash:
+            stored_files, files = self._reuse_stored_objects(files)
+        # small files are pulled in batches of tar stream, others (and files failed in batch) are pulled one by one
+        small_files = [x for x in files if x[1].file_size <= self._BATCH_PULL_MAX_FILE_SIZE]
+        failed_files = [x for x in files if x[1].file_size > self._BATCH_PULL_MAX_FILE_SIZE]
+        if len(small_files) > 1:
+            for batch in self._split_batches(small_files):
+                batch_stored_files, batch_failed_files = self._pull_files_tar(batch)
+                stored_files.extend(batch_stored_files)
+                failed_files.extend(batch_failed_files)
+        else:
+            failed_files.extend(small_files)
+        for path, meta in failed_files:
+            try:
+                if self._pull_file(path, meta):
+                    stored_files.append((path, meta))
+            except (RuntimeError, OSError) as ex:
+                warn('Could not pull file %s: %s' % (path, str(ex)))
+        return stored_files
+
+    def _save_file_metas(self, metas: List[FileMeta]):
+        self._sql_conn.upsert_many(metas)
 
     def _create_db_path(self, path: str, exist_ok: bool = False) -> int:
+        # the created directories are committed, so that the workers (and the read connections of WAL mode) find them
         query_path = self._sql_conn.select(DirectoryMeta, 1, path=path)
         if query_path is None:
             if path != '/':
                 parent_id = self._create_db_path(self._abs_path(path + '/..'))
-                entity = DirectoryMeta(path=path)
+                entity = DirectoryMeta(path=path, parent_id=parent_id)
                 self._sql_conn.insert(entity)
-                self._reuse_index(entity.path_id)
                 file_name = self._file_name(path)
                 db_entry = self._sql_conn.select(FileMeta, 1, path_id=parent_id, file_name=file_name)
                 now = datetime.datetime.now()
@@ -278,15 +799,68 @@ class BackupManager:
                 if db_entry is None:
                     self._sql_conn.insert(FileMeta(path_id=parent_id, file_name=file_name, file_size=0, access_time=now,
                                                    mod_time=now, create_time=now, is_dir=1))
+                self._sql_conn.commit()
                 return entity.path_id
             else:
-                entity = DirectoryMeta(path=path)
+                entity = DirectoryMeta(path=path, parent_id=None)
                 self._sql_conn.insert(entity)
-                self._reuse_index(entity.path_id)
+                self._sql_conn.commit()
                 return entity.path_id
         else:
             return query_path.path_id
 
+    def _journal_add(self, job_type: int, path_id: Optional[int], paths: List[Tuple[str, str]]):
+        # paths are (remote_path, db_path) in database directory path_id, which is None for the root of the sync
+        self._sql_conn.upsert_many([SyncJournal(remote_path=remote_path, db_path=db_path, job_type=job_type,
+                                                path_id=path_id) for remote_path, db_path in paths])
+
+    def _journal_done(self, remote_paths: List[str]):
+        self._sql_conn.delete_many(SyncJournal, [{'remote_path': x} for x in remote_paths])
+
+    @staticmethod
+    def _is_file_modified(db_meta: FileMeta, meta: FileMeta) -> bool:
+        return abs(get_datetime_timestamp(db_meta.mod_time) - get_datetime_timestamp(meta.mod_time)) > 1 \
+               or db_meta.file_size != meta.file_size
+
+    @staticmethod
+    def _close_finished_queues(dir_queue: ThreadSafeBufferQueue, file_queue: ThreadSafeBufferQueue,
+                               stat: _StatusStatistics):
+        with stat.lock:
+            if not dir_queue.is_closed and stat.current_dirs == stat.total_dirs and stat.active_dirs == 0:
+                dir_queue.close()
+                file_queue.close()
+
+    # remote -> local (directory, sync meta)
+    def _sync_remote_dir_meta(self, dir_queue: ThreadSafeBufferQueue, file_queue: ThreadSafeBufferQueue,
+                              stat: _StatusStatistics, full_scan: bool, remote_path: str, db_path: str,
+                              meta: Optional[FileMeta], db_meta: Optional[FileMeta] = None):
+        if meta is None:
+            # failed to stat directory info, skipped (kept in journal)
+            with stat.lock:
+                stat.current_dirs += 1
+                print('\r[%d/%d] %s' % (stat.current_files + stat.current_dirs,
+                                        stat.total_dirs + stat.total_files, remote_path),
+                      end=' ', flush=True)
+            warn('Failed to fetch directory meta: %s, skipped' % remote_path, RuntimeWarning)
+            self._close_finished_queues(dir_queue, file_queue, stat)
+        else:
+            # entries of a directory are unchanged if its modification time is the same as last sync
+            unchanged = not full_scan and db_meta is not None and db_meta.mod_time == meta.mod_time
+            dir_queue.enqueue((remote_path, db_path, meta, unchanged))
+
+    def _sync_remote_resumed_file(self, stat: _StatusStatistics, path: str, _, meta: Optional[FileMeta]):
+        # the file may be pulled before interrupted, comparing with database in the same way as an existed file
+        with stat.lock:
+            stat.current_files += 1
+            print('\r[%d/%d] %s' % (stat.current_files + stat.current_dirs,
+                                    stat.total_dirs + stat.total_files, path), end=' ', flush=True)
+        synced = meta is not None
+        if meta is not None:
+            db_meta = self._sql_conn.select(FileMeta, 1, path_id=meta.path_id, file_name=meta.file_name)
+            if db_meta is not None and not self._is_file_modified(db_meta, meta):
+                meta = None
+        self._pull_in_batch(path, meta, synced, _DirectoryBatch(1, 1, 1), stat)
+
     def _sync_remote_parallel_file_callback(self, file_queue: ThreadSafeBufferQueue, stat: _StatusStatistics):
         while True:
             try:
@@ -295,23 +869,29 @@ class BackupManager:
                     with stat.adb_sem:
                         meta = self._adb_stat(remote_path)
                     meta.path_id = path_id
-                    call_fn(remote_path, db_path, meta)
                 except Exception as ex1:
                     warn('exception while syncing remote metadata: %s' % ex1)
                     # traceback.print_exc()
-                    call_fn(remote_path, db_path, None)
+                    meta = None
+                call_fn(remote_path, db_path, meta)
             except QueueClosedException:
                 return
             except Exception as ex:
                 warn('Unexpected exception in slave thread: %s' % str(ex))
 
     def _sync_remote_parallel_dir_callback(self, dir_queue: ThreadSafeBufferQueue, file_queue: ThreadSafeBufferQueue,
-                                           stat: _StatusStatistics):
+                                           stat: _StatusStatistics, full_scan: bool = True, batch_pull: bool = False):
+        sync_dir_meta = functools.partial(self._sync_remote_dir_meta, dir_queue, file_queue, stat, full_scan)
+
         while True:
+            dir_dequeued = False
             try:
-                cur_remote_path, cur_db_path = dir_queue.dequeue()
+                cur_remote_path, cur_db_path, cur_meta, unchanged = dir_queue.dequeue()
+                dir_dequeued = True
+                journal_path = cur_remote_path
                 with stat.lock:
                     stat.current_dirs += 1
+                    stat.active_dirs += 1
                     print('\r[%d/%d] %s' % (stat.current_files + stat.current_dirs,
                                             stat.total_dirs + stat.total_files, cur_remote_path), end=' ', flush=True)
                 try:
@@ -319,6 +899,24 @@ class BackupManager:
                 except AttributeError:
                     warn('Failed to get database directory info: %s' % cur_db_path)
                     continue
+                if unchanged:
+                    # skip listing and stat-ing the entries, only walking into the sub-directories
+                    db_dir_metas = [x for x in self.list_database(cur_db_path) if x.is_dir != 0]
+                    with stat.lock:
+                        stat.total_dirs += len(db_dir_metas)
+                    if cur_db_path == '/':
+                        cur_db_path = ''
+                    if cur_remote_path == '/':
+                        cur_remote_path = ''
+                    self._journal_add(self._JOB_DIR, cur_db_path_id,
+                                      [(cur_remote_path + '/' + x.file_name, cur_db_path + '/' + x.file_name)
+                                       for x in db_dir_metas])
+                    for db_meta in db_dir_metas:
+                        file_queue.enqueue((cur_db_path_id, cur_remote_path + '/' + db_meta.file_name,
+                                            cur_db_path + '/' + db_meta.file_name,
+                                            functools.partial(sync_dir_meta, db_meta=db_meta)))
+                    self._journal_done([journal_path])
+                    continue
                 try:
                     with stat.adb_sem:
                         remote_dirs, remote_files = self._adb_ls(cur_remote_path)
@@ -329,9 +927,12 @@ class BackupManager:
                 with stat.lock:
                     stat.total_dirs += len(remote_dirs)
                     stat.total_files += len(remote_files)
+                # the entries of directory are queried once, files are compared with this snapshot
                 db_metas = self.list_database(cur_db_path)
-                local_dirs = set([x.file_name for x in db_metas if x.is_dir != 0])
-                local_files = set([x.file_name for x in db_metas if x.is_dir == 0])
+                db_dir_metas = dict([(x.file_name, x) for x in db_metas if x.is_dir != 0])
+                db_file_metas = dict([(x.file_name, x) for x in db_metas if x.is_dir == 0])
+                local_dirs = set(db_dir_metas.keys())
+                local_files = set(db_file_metas.keys())
                 if cur_db_path == '/':
                     cur_db_path = ''
                 if cur_remote_path == '/':
@@ -347,77 +948,243 @@ class BackupManager:
                     self._remove_db(cur_db_path + '/' + dir_name)
 
                 # remote -> local (directory, sync meta)
-                def _sync_dir_meta(remote_path, db_path, meta):
-                    if meta is None:
-                        # failed to stat directory info, skipped
-                        with stat.lock:
-                            stat.current_dirs += 1
-                            print('\r[%d/%d] %s' % (stat.current_files + stat.current_dirs,
-                                                    stat.total_dirs + stat.total_files, cur_remote_path),
-                                  end=' ', flush=True)
-                        warn('Failed to fetch directory meta: %s, skipped' % remote_path, RuntimeWarning)
-                    else:
-                        db_meta = self._sql_conn.select(FileMeta, 1, path_id=meta.path_id, file_name=meta.file_name)
-                        if db_meta is None or meta != db_meta:
-                            # changed: not updating db if nothing changed
-                            self._sql_conn.update(meta)
-                        dir_queue.enqueue((remote_path, db_path))
+                self._journal_add(self._JOB_DIR, cur_db_path_id,
+                                  [(cur_remote_path + '/' + x, cur_db_path + '/' + x) for x in remote_dirs])
                 for dirs in remote_dirs:
                     file_queue.enqueue((cur_db_path_id, cur_remote_path + '/' + dirs, cur_db_path + '/' + dirs,
-                                        _sync_dir_meta))
+                                        functools.partial(sync_dir_meta, db_meta=db_dir_metas.get(dirs))))
+
+                # remote -> local (delete file)
+                deleted_db_files = set(local_files).difference(remote_files)
+                self._sql_conn.delete_many(FileMeta, [{'path_id': cur_db_path_id, 'file_name': x}
+                                                      for x in deleted_db_files])
+
+                new_db_files = set(remote_files).difference(local_files)
+                existed_files = set(local_files).intersection(remote_files)
+                dir_batch = _DirectoryBatch(len(new_db_files) + len(existed_files),
+                                            self._BATCH_PULL_MAX_FILES if batch_pull else 1,
+                                            self._SYNC_WRITE_BATCH_SIZE, cur_meta)
+                self._journal_add(self._JOB_FILE, cur_db_path_id,
+                                  [(cur_remote_path + '/' + x, cur_db_path + '/' + x)
+                                   for x in new_db_files.union(existed_files)])
 
                 # remote -> local (new file)
-                def _fetch_new_file(path, _, meta):
+                def _fetch_new_file(path, _, meta, dir_batch=dir_batch):
                     with stat.lock:
                         stat.current_files += 1
                         print('\r[%d/%d] %s' % (stat.current_files + stat.current_dirs,
                                                 stat.total_dirs + stat.total_files, path), end=' ', flush=True)
-                    if meta is not None:
-                        with stat.adb_sem:
-                            self._pull_file(path, meta)
-                new_db_files = set(remote_files).difference(local_files)
+                    self._pull_in_batch(path, meta, meta is not None, dir_batch, stat)
                 for file in new_db_files:
                     file_queue.enqueue((cur_db_path_id, cur_remote_path + '/' + file, cur_db_path + '/' + file,
                                         _fetch_new_file))
 
-                # remote -> local (delete file)
-                deleted_db_files = set(local_files).difference(remote_files)
-                for file_name in deleted_db_files:
-                    self._sql_conn.delete(FileMeta, path_id=cur_db_path_id, file_name=file_name)
-
                 # remote -> local (existed file)
-                def _fetch_exist_file(path, _, meta):
+                def _fetch_exist_file(path, _, meta, dir_batch=dir_batch, db_file_metas=db_file_metas):
                     with stat.lock:
                         stat.current_files += 1
                         print('\r[%d/%d] %s' % (stat.current_files + stat.current_dirs,
                                                 stat.total_dirs + stat.total_files, path), end=' ', flush=True)
-                    if meta is not None:
-                        db_meta = self._sql_conn.select(FileMeta, 1, path_id=meta.path_id, file_name=meta.file_name)
-                        if db_meta is None:
-                            warn('Failed to get database file meta: path_id: %d, file_name: %s'
-                                 % (cur_db_path_id, meta.file_name))
-                            return
-                        if abs(get_datetime_timestamp(db_meta.mod_time) - get_datetime_timestamp(meta.mod_time)) > 1 \
-                                or db_meta.file_size != meta.file_size:
-                            with stat.adb_sem:
-                                self._pull_file(path, meta)
+                    synced = meta is not None
+                    db_meta = db_file_metas.get(self._file_name(path))
+                    if meta is not None and db_meta is not None and not self._is_file_modified(db_meta, meta):
+                        meta = None
+                    self._pull_in_batch(path, meta, synced, dir_batch, stat)
 
-                existed_files = set(local_files).intersection(remote_files)
                 for file in existed_files:
                     file_queue.enqueue((cur_db_path_id, cur_remote_path + '/' + file, cur_db_path + '/' + file,
                                         _fetch_exist_file))
+
+                # directory meta is updated by the last file task after its files are synced (see _pull_in_batch), so
+                # an interrupted or failed sync won't skip it next time
+                if len(new_db_files) + len(existed_files) == 0:
+                    self._save_dir_meta(cur_meta)
+                self._journal_done([journal_path])
             except QueueClosedException:
                 return
             except Exception as ex:
                 warn('Unexpected exception in slave thread: %s' % str(ex))
             finally:
+                if dir_dequeued:
+                    with stat.lock:
+                        stat.active_dirs -= 1
+                self._close_finished_queues(dir_queue, file_queue, stat)
+
+    def _pull_in_batch(self, path: str, meta: Optional[FileMeta], synced: bool, dir_batch: _DirectoryBatch,
+                       stat: _StatusStatistics):
+        # meta is None if the file needs not to be pulled, synced is False if the file is failed to stat
+        files = dir_batch.finish_stat([] if meta is None else [(path, meta)])
+        finished_count = len(files) + (1 if meta is None else 0)
+        synced_files = [(path, None)] if meta is None and synced else []
+        pulled_count = 0
+        try:
+            if len(files) > 0:
+                with stat.adb_sem:
+                    pulled_files = self._pull_files(files)
+                synced_files.extend(pulled_files)
+                pulled_count = len(pulled_files)
+        finally:
+            synced_files, dir_meta = dir_batch.finish_pull(finished_count, synced_files,
+                                                           len(files) - pulled_count + (0 if synced else 1))
+            if len(synced_files) > 0:
+                self._save_synced_files(synced_files)
+            self._save_dir_meta(dir_meta)
+
+    def _save_dir_meta(self, meta: Optional[FileMeta]):
+        # not updating db if nothing changed
+        if meta is not None:
+            db_meta = self._sql_conn.select(FileMeta, 1, path_id=meta.path_id, file_name=meta.file_name)
+            if db_meta is None or meta != db_meta:
+                self._sql_conn.update(meta)
+
+    def _save_synced_files(self, files: List[Tuple[str, Optional[FileMeta]]]):
+        # meta is None for the unchanged files, metas are written before the works are removed from journal
+        self._save_file_metas([x[1] for x in files if x[1] is not None])
+        self._journal_done([x[0] for x in files])
+
+    def _sync_remote_bulk_file_callback(self, file_queue: ThreadSafeBufferQueue, stat: _StatusStatistics):
+        while True:
+            try:
+                files, dir_batch = file_queue.dequeue()
                 with stat.lock:
-                    if not dir_queue.is_closed and stat.current_dirs == stat.total_dirs:
-                        dir_queue.close()
-                        file_queue.close()
+                    stat.current_files += len(files)
+                    print('\r[%d/%d] %s' % (stat.current_files + stat.current_dirs,
+                                            stat.total_dirs + stat.total_files, files[-1][0]), end=' ', flush=True)
+                stored_count = 0
+                try:
+                    with stat.adb_sem:
+                        stored_files = self._pull_files(files)
+                    self._save_file_metas([x[1] for x in stored_files])
+                    stored_count = len(stored_files)
+                finally:
+                    self._save_dir_meta(dir_batch.finish_pull(len(files), [], len(files) - stored_count)[1])
+            except QueueClosedException:
+                return
+            except Exception as ex:
+                warn('Unexpected exception in slave thread: %s' % str(ex))
+
+    def _sync_remote_bulk_dir(self, db_path: str, dir_meta: Optional[FileMeta], entries: List[Tuple[str, FileMeta]],
+                              file_queue: ThreadSafeBufferQueue, stat: _StatusStatistics, batch_pull: bool = False,
+                              complete: bool = True):
+        # diff the direct children of a scanned directory against database, sub-directories are already synced, the
+        # files not listed are only removed from database if the listing is complete, the meta of the directory
+        # (None for the root of the sync) is written after its files are pulled
+        path_id = self._create_db_path(db_path, exist_ok=True)
+        if dir_meta is not None:
+            dir_meta.path_id = self._sql_conn.select(DirectoryMeta, 1, path_id=path_id).parent_id
+        db_metas = dict([(x.file_name, x) for x in self.list_database(db_path)])
+        remote_metas = dict([(x[1].file_name, x) for x in entries])
+        if db_path == '/':
+            db_path = ''
+        with stat.lock:
+            stat.current_dirs += 1
+            stat.total_files += len([x for x in entries if not x[1].is_dir])
+        # remote -> local (deleted file or directory, or file type changed)
+        deleted_files = []
+        for name, db_meta in list(db_metas.items()):
+            if name not in remote_metas and not complete:
+                continue
+            if name not in remote_metas or bool(remote_metas[name][1].is_dir) != bool(db_meta.is_dir):
+                if db_meta.is_dir:
+                    self._remove_db(db_path + '/' + name)
+                else:
+                    deleted_files.append({'path_id': path_id, 'file_name': name})
+                del db_metas[name]
+        self._sql_conn.delete_many(FileMeta, deleted_files)
+        pull_files = []
+        for name, (remote_path, meta) in remote_metas.items():
+            meta.path_id = path_id
+            db_meta = db_metas.get(name)
+            if meta.is_dir:
+                # remote -> local (directory, sync meta), written once the sub-directory is synced
+                continue
+            elif db_meta is None:
+                # remote -> local (new file)
+                pull_files.append((remote_path, meta))
+            elif self._is_file_modified(db_meta, meta):
+                # remote -> local (existed file)
+                pull_files.append((remote_path, meta))
+            else:
+                with stat.lock:
+                    stat.current_files += 1
+        # a directory not completely listed is synced again next time
+        dir_batch = _DirectoryBatch(len(pull_files), 0, 0, dir_meta if complete else None)
+        if len(pull_files) == 0:
+            self._save_dir_meta(dir_batch.dir_meta)
+        batch_size = self._BATCH_PULL_MAX_FILES if batch_pull else 1
+        for i in range(0, len(pull_files), batch_size):
+            file_queue.enqueue((pull_files[i:i + batch_size], dir_batch))
 
-    def sync_remote(self, remote_path: str, db_path: str = '/'):
-        self._backup_db()
+    def _sync_remote_bulk(self, remote_path: str, db_path: str, batch_pull: bool = False):
+        file_queue = ThreadSafeBufferQueue(16384)
+        stat = _StatusStatistics(self._thread_count)
+        thds = []
+        for _ in range(self._thread_count):
+            thd = threading.Thread(target=self._sync_remote_bulk_file_callback, args=(file_queue, stat), daemon=True)
+            thds.append(thd)
+            thd.start()
+
+        def _remote_to_db_path(path):
+            return self._abs_path(db_path + '/' + path[len(remote_path):])
+
+        # paths reported with errors by the scan, None for the errors not attributed to a path, a directory is listed
+        # incompletely if itself has errors or one of its entries with errors is missing
+        error_paths = set()  # type: Set[Optional[str]]
+
+        def _finish_dir(dir_entry, scan_complete=True):
+            entry_paths = set([x[0] for x in dir_entry[1]])
+            complete = scan_complete and not any([x is None or x == dir_entry[0] or (
+                    (x[:x.rfind('/')] or '/') == dir_entry[0] and x not in entry_paths) for x in error_paths])
+            if not complete:
+                warn('Directory %s is not completely listed, the files not listed are kept in database' % dir_entry[0])
+            try:
+                self._sync_remote_bulk_dir(_remote_to_db_path(dir_entry[0]), dir_entry[2], dir_entry[1], file_queue,
+                                           stat, batch_pull, complete)
+            except Exception as ex:
+                warn('exception while syncing directory %s: %s' % (dir_entry[0], str(ex)))
+        # find walks the tree in pre-order, so a directory is complete once the scan leaves it
+        open_dirs = []  # type: List[Tuple[str, List[Tuple[str, FileMeta]], Optional[FileMeta]]]
+        open_dir_paths = set()
+        try:
+            scan_complete = True
+            try:
+                for path, meta in self._adb_bulk_stat(remote_path, error_paths):
+                    if path == remote_path:
+                        open_dirs.append((path, [], None))
+                        open_dir_paths.add(path)
+                        continue
+                    parent_path = path[:path.rfind('/')] or '/'
+                    if parent_path not in open_dir_paths:
+                        warn('Unexpected scan order for path %s, skipped' % path)
+                        continue
+                    while open_dirs[-1][0] != parent_path:
+                        _finish_dir(open_dirs[-1])
+                        open_dir_paths.remove(open_dirs.pop()[0])
+                    open_dirs[-1][1].append((path, meta))
+                    if meta.is_dir:
+                        with stat.lock:
+                            stat.total_dirs += 1
+                            print('\r[%d/%d] %s' % (stat.current_files + stat.current_dirs,
+                                                    stat.total_dirs + stat.total_files, path), end=' ', flush=True)
+                        open_dirs.append((path, [], meta))
+                        open_dir_paths.add(path)
+            except IncompleteScanException as ex:
+                # the directories still open may miss the entries after the cut
+                warn('Scan of %s is incomplete: %s' % (remote_path, str(ex)))
+                scan_complete = False
+            while len(open_dirs) > 0:
+                _finish_dir(open_dirs.pop(), scan_complete)
+        finally:
+            file_queue.close()
+            for thd in thds:
+                thd.join()
+        with stat.lock:
+            print('Directories: %d/%d' % (stat.current_dirs, stat.total_dirs))
+            print('Files: %d/%d' % (stat.current_files, stat.total_files))
+
+    def sync_remote(self, remote_path: str, db_path: str = '/', bulk_scan: bool = False, full_scan: bool = False,
+                    batch_pull: bool = False):
+        self._take_snapshot()
         remote_path = self._abs_path(remote_path)
         db_path = self._abs_path(db_path)
         st_remote = self._adb_stat(remote_path)
@@ -427,172 +1194,408 @@ class BackupManager:
             if st_local == self._ST_NOT_FOUND:
                 local_path_id = self._create_db_path(db_path, exist_ok=True)
             st_remote.path_id = local_path_id
-            self._pull_file(remote_path, st_remote)
+            self._save_file_metas([x[1] for x in self._pull_files([(remote_path, st_remote)])])
+            self._sql_conn.commit()
             return
         self._create_db_path(db_path, exist_ok=True)
+        # starting a new sync discards the journal of the unfinished one, directories may be marked as synced before
+        # their files are pulled, so they are all listed again
+        pending_jobs = len(self._sql_conn.select(SyncJournal, 0))
+        if pending_jobs > 0:
+            warn('Discarding %d unfinished works of last sync, use resume action to continue it instead'
+                 % pending_jobs)
+            self._sql_conn.delete(SyncJournal)
+            full_scan = True
+        if bulk_scan:
+            try:
+                self._sync_remote_bulk(remote_path, db_path, batch_pull)
+                self._validate_objects()
+            finally:
+                self._sql_conn.commit()
+            return
+        self._sql_conn.set_variable('journal_full_scan', str(int(full_scan)))
+        self._sql_conn.set_variable('journal_batch_pull', str(int(batch_pull)))
+        self._journal_add(self._JOB_DIR, None, [(remote_path, db_path)])
         dir_queue = ThreadSafeBufferQueue()
-        dir_queue.enqueue((remote_path, db_path))
+        dir_queue.enqueue((remote_path, db_path, None, False))
         file_queue = ThreadSafeBufferQueue(16384)
         stat = _StatusStatistics(self._thread_count)
         try:
-            thds = []
-            for _ in range(self._thread_count):
-                thd = threading.Thread(target=self._sync_remote_parallel_dir_callback,
-                                       args=(dir_queue, file_queue, stat), daemon=True)
-                thds.append(thd)
-                thd.start()
-                thd = threading.Thread(target=self._sync_remote_parallel_file_callback,
-                                       args=(file_queue, stat), daemon=True)
-                thds.append(thd)
-                thd.start()
-            for thd in thds:
-                while thd.is_alive():
-                    thd.join(300)
-                    print('Auto committing database.')
-                    self._sql_conn.commit()
+            thds = self._start_sync_remote_workers(dir_queue, file_queue, stat, full_scan, batch_pull)
+            self._join_sync_remote_workers(thds)
             self._validate_objects()
-            # debug
-            with stat.lock:
-                print('Directories: %d/%d' % (stat.current_dirs, stat.total_dirs))
-                print('Files: %d/%d' % (stat.current_files, stat.total_files))
+            self._print_sync_remote_result(stat)
+        finally:
+            self._sql_conn.commit()
+
+    def resume_sync_remote(self):
+        jobs = self._sql_conn.select(SyncJournal, 0)
+        if len(jobs) == 0:
+            print('Nothing to resume.')
+            return
+        self._take_snapshot()
+        full_scan = self._sql_conn.get_variable('journal_full_scan', '0') == '1'
+        batch_pull = self._sql_conn.get_variable('journal_batch_pull', '0') == '1'
+        # an unfinished directory is listed again, which journals its entries again
+        pending_dirs = set([x.remote_path for x in jobs if x.job_type == self._JOB_DIR])
+
+        def _in_pending_dir(path):
+            while path != '/':
+                path = path[:path.rfind('/')] or '/'
+                if path in pending_dirs:
+                    return True
+            return False
+        # the works under them are dropped, the entries still existing are journaled again
+        self._journal_done([x.remote_path for x in jobs if _in_pending_dir(x.remote_path)])
+        jobs = [x for x in jobs if not _in_pending_dir(x.remote_path)]
+        dir_queue = ThreadSafeBufferQueue()
+        file_queue = ThreadSafeBufferQueue(16384)
+        stat = _StatusStatistics(self._thread_count)
+        stat.total_dirs = len([x for x in jobs if x.job_type == self._JOB_DIR])
+        stat.total_files = len(jobs) - stat.total_dirs
+        print('Resuming %d directories and %d files.' % (stat.total_dirs, stat.total_files))
+        sync_dir_meta = functools.partial(self._sync_remote_dir_meta, dir_queue, file_queue, stat, full_scan)
+        resumed_file = functools.partial(self._sync_remote_resumed_file, stat)
+        # keeping the queues open until all jobs are enqueued
+        stat.active_dirs += 1
+        try:
+            thds = self._start_sync_remote_workers(dir_queue, file_queue, stat, full_scan, batch_pull)
+            try:
+                for job in jobs:
+                    if job.job_type == self._JOB_FILE:
+                        file_queue.enqueue((job.path_id, job.remote_path, job.db_path, resumed_file))
+                    elif job.path_id is None:
+                        # root directory of the sync
+                        dir_queue.enqueue((job.remote_path, job.db_path, None, False))
+                    else:
+                        db_meta = self._sql_conn.select(FileMeta, 1, path_id=job.path_id,
+                                                        file_name=self._file_name(job.db_path))
+                        file_queue.enqueue((job.path_id, job.remote_path, job.db_path,
+                                            functools.partial(sync_dir_meta, db_meta=db_meta)))
+            finally:
+                with stat.lock:
+                    stat.active_dirs -= 1
+                self._close_finished_queues(dir_queue, file_queue, stat)
+            self._join_sync_remote_workers(thds)
+            self._validate_objects()
+            self._print_sync_remote_result(stat)
         finally:
             self._sql_conn.commit()
 
+    def _start_sync_remote_workers(self, dir_queue: ThreadSafeBufferQueue, file_queue: ThreadSafeBufferQueue,
+                                   stat: _StatusStatistics, full_scan: bool, batch_pull: bool) \
+            -> List[threading.Thread]:
+        thds = []
+        for _ in range(self._thread_count):
+            thd = threading.Thread(target=self._sync_remote_parallel_dir_callback,
+                                   args=(dir_queue, file_queue, stat, full_scan, batch_pull), daemon=True)
+            thds.append(thd)
+            thd.start()
+            thd = threading.Thread(target=self._sync_remote_parallel_file_callback,
+                                   args=(file_queue, stat), daemon=True)
+            thds.append(thd)
+            thd.start()
+        return thds
+
+    @staticmethod
+    def _join_sync_remote_workers(thds: List[threading.Thread]):
+        # database is committed by group commit of accessor while syncing
+        for thd in thds:
+            thd.join()
+
+    def _print_sync_remote_result(self, stat: _StatusStatistics):
+        # debug
+        with stat.lock:
+            print('Directories: %d/%d' % (stat.current_dirs, stat.total_dirs))
+            print('Files: %d/%d' % (stat.current_files, stat.total_files))
+        pending_jobs = len(self._sql_conn.select(SyncJournal, 0))
+        if pending_jobs > 0:
+            print('%d works are not finished, use resume action to retry them.' % pending_jobs)
+
     def _push_file(self, path: str, meta: FileMeta):
-        local_path = os.path.join(self._path, 'objects', '%02x' % meta.sha256[0], meta.sha256.hex())
-        if os.path.exists(local_path):
-            os.utime(local_path, (get_datetime_timestamp(meta.access_time), get_datetime_timestamp(meta.mod_time)))
-            stdout, stderr = spawn_process(['adb', 'push', local_path, path], 'utf8')
+        if self._objects.exists(meta.sha256):
+            # the object is shared by files with different time, holding the lock until it is pushed
+            with self._push_locks[meta.sha256[0] % len(self._push_locks)]:
+                with self._objects.local_file(meta.sha256) as local_path:
+                    os.utime(local_path, (get_datetime_timestamp(meta.access_time),
+                                          get_datetime_timestamp(meta.mod_time)))
+                    stdout, stderr = spawn_process(['adb', 'push', local_path, path], 'utf8')
             if len(stderr) > 0:
                 raise RuntimeError(stderr)
         else:
-            warn("Could not push file %s: object %s not found" % (path, local_path))
+            warn("Could not push file %s: object %s not found" % (path, meta.sha256.hex()))
 
     def _create_remote_dir(self, path: str):
-        args = ['adb', 'shell', 'mkdir', "'%s'" % path.replace("'", "'\"'\"'")]
-        stdout, stderr = spawn_process(args, 'utf8')
+        cmd = "mkdir '%s'" % path.replace("'", "'\"'\"'")
+        stdout, stderr = self._shell.run(cmd)
         if stderr.rstrip('\r\n').endswith('No such file or directory'):
             # recursive mode
             if path == '/':
                 raise RuntimeError(stderr)
             self._create_remote_dir(self._abs_path(path + '/..'))
             # retry after parent dir created
-            stdout, stderr = spawn_process(args, 'utf8')
+            stdout, stderr = self._shell.run(cmd)
             if len(stderr) > 0:
                 raise RuntimeError(stderr)
 
-    @staticmethod
-    def _remove_remote(path: str):
-        stdout, stderr = spawn_process(['adb', 'shell', 'rm', '-rf', "'%s'" % path.replace("'", "'\"'\"'")], 'utf8')
+    def _remove_remote(self, path: str):
+        stdout, stderr = self._shell.run("rm -rf '%s'" % path.replace("'", "'\"'\"'"))
         if len(stderr) > 0:
             raise RuntimeError(stderr)
 
-    def sync_local(self, remote_path: str, db_path: str = '/'):
+    def _sync_local_parallel_file_callback(self, file_queue: ThreadSafeBufferQueue, stat: _StatusStatistics):
+        while True:
+            try:
+                remote_path, db_meta, call_fn = file_queue.dequeue()
+                with stat.lock:
+                    stat.current_files += 1
+                    print('\r[%d/%d] %s' % (stat.current_files + stat.current_dirs,
+                                            stat.total_dirs + stat.total_files, remote_path), end=' ', flush=True)
+                try:
+                    with stat.adb_sem:
+                        call_fn(remote_path, db_meta)
+                except Exception as ex1:
+                    warn('exception while syncing remote file %s: %s' % (remote_path, str(ex1)))
+            except QueueClosedException:
+                return
+            except Exception as ex:
+                warn('Unexpected exception in slave thread: %s' % str(ex))
+
+    def _sync_local_parallel_dir_callback(self, dir_queue: ThreadSafeBufferQueue, file_queue: ThreadSafeBufferQueue,
+                                          stat: _StatusStatistics, snapshot_id: Optional[int]):
+        # local -> remote (new files)
+        def _push_new_file(remote_path, db_meta):
+            self._push_file(remote_path, db_meta)
+
+        # local -> remote (deleted files or directories)
+        def _remove_file(remote_path, _):
+            self._remove_remote(remote_path)
+
+        # local -> remote (existed files)
+        def _push_exist_file(remote_path, db_meta):
+            st_remote = self._adb_stat(remote_path)
+            if abs(get_datetime_timestamp(st_remote.mod_time) - get_datetime_timestamp(db_meta.mod_time)) > 1 or \
+                    st_remote.file_size != db_meta.file_size:
+                self._push_file(remote_path, db_meta)
+
+        while True:
+            dir_dequeued = False
+            try:
+                cur_remote_path, cur_db_path, is_new_dir = dir_queue.dequeue()
+                dir_dequeued = True
+                with stat.lock:
+                    stat.current_dirs += 1
+                    stat.active_dirs += 1
+                    print('\r[%d/%d] %s' % (stat.current_files + stat.current_dirs,
+                                            stat.total_dirs + stat.total_files, cur_remote_path), end=' ', flush=True)
+                try:
+                    if is_new_dir:
+                        # nothing to list for the directory created by this sync
+                        remote_dirs, remote_files = [], []
+                    else:
+                        with stat.adb_sem:
+                            remote_dirs, remote_files = self._adb_ls(cur_remote_path)
+                except Exception as ex:
+                    print('exception while listing path %s: %s' % (cur_remote_path, str(ex)))
+                    continue
+                db_metas = self.list_database(cur_db_path, snapshot_id)
+                db_files = dict([(x.file_name, x) for x in db_metas if not x.is_dir])
+                db_dirs = [x.file_name for x in db_metas if x.is_dir]
+                new_dirs = set(db_dirs).difference(remote_dirs)
+                deleted_dirs = set(remote_dirs).difference(db_dirs)
+                new_files = set(db_files.keys()).difference(remote_files)
+                deleted_files = set(remote_files).difference(db_files.keys())
+                existed_files = set(remote_files).intersection(db_files.keys())
+                with stat.lock:
+                    stat.total_dirs += len(db_dirs)
+                    stat.total_files += len(deleted_dirs) + len(new_files) + len(deleted_files) + len(existed_files)
+
+                if cur_remote_path == '/':
+                    cur_remote_path = ''
+                if cur_db_path == '/':
+                    cur_db_path = ''
+                # local -> remote (new directory), created before walking into it
+                for name in new_dirs:
+                    with stat.adb_sem:
+                        self._create_remote_dir(cur_remote_path + '/' + name)
+                for name in deleted_dirs:
+                    file_queue.enqueue((cur_remote_path + '/' + name, None, _remove_file))
+                for name in new_files:
+                    file_queue.enqueue((cur_remote_path + '/' + name, db_files[name], _push_new_file))
+                for name in deleted_files:
+                    file_queue.enqueue((cur_remote_path + '/' + name, None, _remove_file))
+                for name in existed_files:
+                    file_queue.enqueue((cur_remote_path + '/' + name, db_files[name], _push_exist_file))
+                for name in db_dirs:
+                    dir_queue.enqueue((cur_remote_path + '/' + name, cur_db_path + '/' + name, name in new_dirs))
+            except QueueClosedException:
+                return
+            except Exception as ex:
+                warn('Unexpected exception in slave thread: %s' % str(ex))
+            finally:
+                with stat.lock:
+                    if dir_dequeued:
+                        stat.active_dirs -= 1
+                    if not dir_queue.is_closed and stat.current_dirs == stat.total_dirs and stat.active_dirs == 0:
+                        dir_queue.close()
+                        file_queue.close()
+
+    def sync_local(self, remote_path: str, db_path: str = '/', snapshot_id: Optional[int] = None):
         remote_path = self._abs_path(remote_path)
         db_path = self._abs_path(db_path)
         # create remote if not exists
-        st_local, local_path_id = self._stat_path(db_path)
+        if snapshot_id is not None:
+            st_local = self._stat_snapshot_path(db_path, snapshot_id)[0]
+        else:
+            st_local = self._stat_path(db_path)[0]
         if st_local == self._ST_FILE:
             raise NotImplementedError
         elif st_local == self._ST_NOT_FOUND:
             raise FileNotFoundError
         try:
-            st_remote = self._adb_stat(remote_path)
+            self._adb_stat(remote_path)
         except RuntimeError:
             self._create_remote_dir(remote_path)
-            st_remote = self._adb_stat(remote_path)
-        dirs = [(remote_path, db_path)]
-        total = 1
-        finished = 0
-        while len(dirs) > 0:
-            cur_remote_path, cur_db_path = dirs.pop(0)
-            try:
-                remote_dirs, remote_files = self._adb_ls(cur_remote_path)
-            except Exception as ex:
-                print('exception:', ex)
+            self._adb_stat(remote_path)
+        dir_queue = ThreadSafeBufferQueue()
+        dir_queue.enqueue((remote_path, db_path, False))
+        file_queue = ThreadSafeBufferQueue(16384)
+        stat = _StatusStatistics(self._thread_count)
+        thds = []
+        for _ in range(self._thread_count):
+            thd = threading.Thread(target=self._sync_local_parallel_dir_callback,
+                                   args=(dir_queue, file_queue, stat, snapshot_id), daemon=True)
+            thds.append(thd)
+            thd.start()
+            thd = threading.Thread(target=self._sync_local_parallel_file_callback,
+                                   args=(file_queue, stat), daemon=True)
+            thds.append(thd)
+            thd.start()
+        for thd in thds:
+            thd.join()
+        with stat.lock:
+            print('Directories: %d/%d' % (stat.current_dirs, stat.total_dirs))
+            print('Files: %d/%d' % (stat.current_files, stat.total_files))
+
+    @staticmethod
+    def _open_reference_dbs(db_files: List[str]) -> List[Tuple[sqlite3.Connection, List[str]]]:
+        # attaching the databases to as few connections as possible, returns the connections and the file_meta and
+        # file_meta_history tables of the attached databases
+        connections = []
+        i = 0
+        while i < len(db_files):
+            conn = sqlite3.connect(db_files[i], check_same_thread=False)
+            max_attached = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if hasattr(conn, 'getlimit') else 10
+            schemas = ['main']
+            for j, db_file in enumerate(db_files[i + 1:i + 1 + max_attached]):
+                conn.execute("attach database ? as db%d" % j, (db_file,))
+                schemas.append('db%d' % j)
+            i += len(schemas)
+            # the database copied before the first sync may have no tables, the backups have no history
+            tables = ['%s.%s' % (x, y) for x in schemas for y in ['file_meta', 'file_meta_history']
+                      if conn.execute("select count(1) from %s.sqlite_master where type = 'table' and name = ?" % x,
+                                      (y,)).fetchone()[0] > 0]
+            connections.append((conn, tables))
+        return connections
+
+    @staticmethod
+    def _iter_referenced_sha256(connections: List[Tuple[sqlite3.Connection, List[str]]], shard: int) \
+            -> Iterator[bytes]:
+        # sorted and distinct sha256 of the shard referenced by any database, queried via index_sha256
+        lower = bytes([shard])
+        upper = bytes([shard + 1]) if shard < 255 else b'\xff' * 33
+        streams = []
+        for conn, tables in connections:
+            if len(tables) == 0:
                 continue
-            db_metas = self.list_database(cur_db_path)
-            total += len(db_metas)
-            finished += 1
-            print('[%d/%d] %s' % (finished, total, cur_remote_path))
-
-            db_files = dict([(x.file_name, x) for x in db_metas if not x.is_dir])
-            db_dirs = [x.file_name for x in db_metas if x.is_dir]
-
-            if cur_remote_path == '/':
-                cur_remote_path = ''
-            # local -> remote (new directory)
-            new_dirs = set(db_dirs).difference(remote_dirs)
-            for name in new_dirs:
-                self._create_remote_dir(cur_remote_path + '/' + name)
-            # local -> remote (delete directory)
-            deleted_dirs = set(remote_dirs).difference(db_dirs)
-            for name in deleted_dirs:
-                self._remove_remote(cur_remote_path + '/' + name)
-            # local -> remote (new files)
-            new_files = set(db_files.keys()).difference(remote_files)
-            for name in new_files:
-                finished += 1
-                print('[%d/%d] %s' % (finished, total, cur_remote_path + '/' + name))
-                self._push_file(cur_remote_path + '/' + name, db_files[name])
-            # local -> remote (deleted files)
-            deleted_files = set(remote_files).difference(db_files.keys())
-            for name in deleted_files:
-                self._remove_remote(cur_remote_path + '/' + name)
-            # local -> remote (existed files)
-            existed_files = set(remote_files).intersection(db_files.keys())
-            for name in existed_files:
-                finished += 1
-                print('[%d/%d] %s' % (finished, total, cur_remote_path + '/' + name))
-                st_remote = self._adb_stat(cur_remote_path + '/' + name)
-                st_local = db_files[name]
-                if abs(get_datetime_timestamp(st_remote.mod_time) - get_datetime_timestamp(st_local.mod_time)) > 1 or\
-                        st_remote.file_size != st_local.file_size:
-                    self._push_file(cur_remote_path + '/' + name, st_local)
-            # BFS-recursion
-            if cur_db_path == '/':
-                cur_db_path = ''
-            for name in db_dirs:
-                dirs.append((cur_remote_path + '/' + name, cur_db_path + '/' + name))
+            sql = ' union '.join(['select sha256 from %s where sha256 >= ? and sha256 < ? and is_dir == 0'
+                                  % x for x in tables]) + ' order by 1'
+            streams.append(x[0] for x in conn.execute(sql, (lower, upper) * len(tables)))
+        last_sha256 = None
+        for sha256 in heapq.merge(*streams):
+            if sha256 != last_sha256:
+                yield sha256
+                last_sha256 = sha256
+
+    def _validate_objects_shards(self, db_files: List[str], shard_queue: ThreadSafeBufferQueue,
+                                 remove_unused: bool, results: List[Tuple[int, int]]):
+        connections = self._open_reference_dbs(db_files)
+        missing_count = 0
+        non_reference_count = 0
+        try:
+            while True:
+                try:
+                    shard = shard_queue.dequeue()
+                except QueueClosedException:
+                    break
+                fs_sha256 = self._objects.list_shard(shard)
+                fs_sha256.sort()
+                # merging the two sorted streams
+                non_reference_sha256 = []
+                i = 0
+                for sha256 in self._iter_referenced_sha256(connections, shard):
+                    while i < len(fs_sha256) and fs_sha256[i] < sha256:
+                        non_reference_sha256.append(fs_sha256[i])
+                        i += 1
+                    if i < len(fs_sha256) and fs_sha256[i] == sha256:
+                        i += 1
+                    else:
+                        missing_count += 1
+                non_reference_sha256.extend(fs_sha256[i:])
+                non_reference_count += len(non_reference_sha256)
+                if remove_unused:
+                    for sha256 in non_reference_sha256:
+                        self._objects.remove(sha256)
+            # only reported if all dequeued shards are checked
+            results.append((missing_count, non_reference_count))
+        finally:
+            for conn, _ in connections:
+                conn.close()
 
     def _validate_objects(self, remove_unused: bool = False):
+        # the referenced hashes and stored objects are compared shard by shard (objects/xx) in parallel, both as
+        # sorted streams, so that the memory usage does not grow with the count of objects
         print('Checking database objects.')
-        backup_db_files = self._list_backup_db_file()
-        print('[1/%d] %s' % (len(backup_db_files) + 1, self._sql_file))
-        cursor = self._sql_conn.cursor()
-        cursor.execute("select sha256 from file_meta where is_dir == 0")
-        db_sha256 = set([x[0] for x in cursor.fetchall()])
-        cursor.close()
-        for i, db_file in enumerate(backup_db_files):
-            print('[%d/%d] %s' % (i + 2, len(backup_db_files) + 1, db_file))
-            conn = SqliteAccessor(db_file)
-            cursor = conn.cursor()
-            cursor.execute("select sha256 from file_meta where is_dir == 0")
-            db_sha256.update([x[0] for x in cursor.fetchall()])
-            cursor.close()
-            conn.close()
-        if None in db_sha256:
-            warn('Detected missing sha256 hash in database, re-run sync to solve this problem')
-            db_sha256.remove(None)
+        self._sql_conn.commit()
+        db_files = [self._sql_file] + self._list_backup_db_file()
+        for i, db_file in enumerate(db_files):
+            print('[%d/%d] %s' % (i + 1, len(db_files), db_file))
+        connections = self._open_reference_dbs(db_files)
+        try:
+            for conn, tables in connections:
+                if any([conn.execute('select count(1) from %s where is_dir == 0 and sha256 is null'
+                                     % x).fetchone()[0] > 0 for x in tables]):
+                    warn('Detected missing sha256 hash in database, re-run sync to solve this problem')
+                    break
+        finally:
+            for conn, _ in connections:
+                conn.close()
         print('Checking file system objects.')
-        fs_sha256 = set()
-        for _, _, files in os.walk(os.path.join(self._path, 'objects')):
-            for file in files:
-                fs_sha256.add(bytes.fromhex(file))
+        shard_queue = ThreadSafeBufferQueue()
+        for shard in range(256):
+            shard_queue.enqueue(shard)
+        shard_queue.close()
+        results = []
+        thds = []
+        for _ in range(self._thread_count):
+            thd = threading.Thread(target=self._validate_objects_shards,
+                                   args=(db_files, shard_queue, remove_unused, results), daemon=True)
+            thds.append(thd)
+            thd.start()
+        for thd in thds:
+            thd.join()
         print('Done.')
-        missing_sha256 = db_sha256.difference(fs_sha256)
-        non_reference_sha256 = fs_sha256.difference(db_sha256)
-        if len(missing_sha256) > 0:
-            warn("Detected missing %d objects from file system, re-run sync to solve this problem" %
-                 len(missing_sha256))
-        if len(non_reference_sha256) > 0:
+        if len(results) < len(thds):
+            warn('Failed to check some of the objects')
+        missing_count = sum([x[0] for x in results])
+        non_reference_count = sum([x[1] for x in results])
+        if missing_count > 0:
+            warn("Detected missing %d objects from file system, re-run sync to solve this problem" % missing_count)
+        if non_reference_count > 0:
             if remove_unused:
-                for sha256 in non_reference_sha256:
-                    path = os.path.join(self._path, 'objects', '%02x' % sha256[0], sha256.hex())
-                    os.remove(path)
-                print('Removed %d unused objects' % len(non_reference_sha256))
+                print('Removed %d unused objects' % non_reference_count)
             else:
-                print('Detected %d objects are unreferenced' % len(non_reference_sha256))
+                print('Detected %d objects are unreferenced' % non_reference_count)
 
     def _remove_db(self, db_path: str):
         db_path = self._abs_path(db_path)
@@ -600,45 +1603,378 @@ class BackupManager:
         if db_stat == self._ST_FILE:
             self._sql_conn.delete(FileMeta, path_id=path_id, file_name=self._file_name(db_path))
         elif db_stat == self._ST_DIR:
-            if db_path == '/':
-                db_path = ''
-            to_delete_dir_list = [(db_path, path_id)]
-            while len(to_delete_dir_list) > 0:
-                path, path_id = to_delete_dir_list.pop(0)
-                dir_names = [x.file_name for x in self._sql_conn.select(FileMeta, 0, path_id=path_id) if x.is_dir]
-                for dir_name in dir_names:
-                    dir_id = self._sql_conn.select(DirectoryMeta, 1, path=path + '/' + dir_name).path_id
-                    to_delete_dir_list.append((path + '/' + dir_name, dir_id))
-                self._sql_conn.delete(FileMeta, path_id=path_id)
-                self._sql_conn.delete(DirectoryMeta, path_id=path_id)
+            # the directories of the subtree (including itself) are found via directory_closure, then removed in
+            # batches
+            path_ids = [x[0] for x in self._sql_conn.iter_select(DirectoryClosure, fields=('descendant_id',),
+                                                                  ancestor_id=path_id)]
+            for i in range(0, len(path_ids), self._IN_BATCH_SIZE):
+                self._sql_conn.delete(FileMeta, path_id=In(path_ids[i:i + self._IN_BATCH_SIZE]))
+            for i in range(0, len(path_ids), self._IN_BATCH_SIZE):
+                self._sql_conn.delete(DirectoryMeta, path_id=In(path_ids[i:i + self._IN_BATCH_SIZE]))
             # delete entry
-            if db_path != '':
+            if db_path != '/':
                 parent_path_id = self._sql_conn.select(DirectoryMeta, 1, path=self._abs_path(db_path + '/..')).path_id
                 self._sql_conn.delete(FileMeta, path_id=parent_path_id, file_name=self._file_name(db_path))
 
     def remove_database(self, db_path: str):
         self._remove_db(db_path)
         self._sql_conn.commit()
-        self._validate_objects()
+        garbage_count = self._sql_conn.execute('select count(1) from object_refs where refcount <= 0')[0][0]
+        if garbage_count > 0:
+            print('Detected %d objects are unreferenced' % garbage_count)
+
+    @staticmethod
+    def _link_object(src: str, dst: str, link_mode: str) -> bool:
+        # returns False if the link can't be created (e.g. across file systems), the object is copied instead then
+        try:
+            if link_mode == 'hardlink':
+                os.link(src, dst)
+            elif link_mode == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            elif link_mode == 'reflink':
+                import fcntl
+                with open(src, 'rb') as f_in:
+                    with open(dst, 'wb') as f_out:
+                        fcntl.ioctl(f_out.fileno(), BackupManager._FICLONE, f_in.fileno())
+            else:
+                return False
+            return True
+        except (OSError, ImportError):
+            if os.path.lexists(dst):
+                os.remove(dst)
+            return False
+
+    def _hash_object(self, sha256: bytes, hashers: List[Any]) -> int:
+        # feed the stored content to the hashers, returns the size, hashlib releases GIL while hashing large buffers,
+        # so that the objects are hashed by threads in parallel
+        raw_path = self._objects.raw_path(sha256)
+        if raw_path is not None:
+            with open(raw_path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                # empty file can't be mapped
+                if size > 0:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        for hasher in hashers:
+                            hasher.update(mm)
+            return size
+        size = 0
+        with self._objects.open(sha256) as f:
+            while True:
+                buffer = f.read(self._io_buffer_size)
+                if len(buffer) == 0:
+                    break
+                for hasher in hashers:
+                    hasher.update(buffer)
+                size += len(buffer)
+        return size
+
+    def _verify_objects_shards(self, shard_queue: ThreadSafeBufferQueue, verified_before: Optional[datetime.datetime],
+                               results: List[Tuple[int, int, List[bytes]]], finished: List[bool]):
+        # the objects verified so far are reported even if failed, finished is only appended if all dequeued shards
+        # are verified
+        object_count = 0
+        total_size = 0
+        corrupt_sha256 = []
+        try:
+            while True:
+                try:
+                    shard = shard_queue.dequeue()
+                except QueueClosedException:
+                    break
+                objects = self._objects.list_shard(shard)
+                if verified_before is not None:
+                    skipped = set([x[0] for x in self._sql_conn.iter_select(
+                        ObjectVerification, fields=('sha256',), sha256=Prefix(bytes([shard])),
+                        verify_time=Range(verified_before))])
+                    objects = [x for x in objects if x not in skipped]
+                verified = []
+                corrupt = []
+                for sha256 in objects:
+                    hasher = self._new_hash()
+                    try:
+                        size = self._hash_object(sha256, [hasher])
+                    except Exception as ex:
+                        warn('Failed to read object %s: %s' % (sha256.hex(), str(ex)))
+                        corrupt.append(sha256)
+                        continue
+                    total_size += size
+                    if hasher.digest() != sha256:
+                        warn('Corrupt object %s (%d bytes)' % (sha256.hex(), size))
+                        corrupt.append(sha256)
+                    else:
+                        verified.append(ObjectVerification(sha256=sha256, verify_time=datetime.datetime.now()))
+                object_count += len(objects)
+                corrupt_sha256.extend(corrupt)
+                self._sql_conn.upsert_many(verified)
+                self._sql_conn.delete_many(ObjectVerification, [{'sha256': x} for x in corrupt])
+            finished.append(True)
+        finally:
+            results.append((object_count, total_size, corrupt_sha256))
+
+    def verify_objects(self, full: bool = False, verify_interval: int = 30) -> Tuple[List[bytes], bool]:
+        """
+        Re-hash the stored objects in parallel and report the ones not matching their hashes (corrupt or truncated)
+        :param full: verify all objects, otherwise the objects verified in the last verify_interval days are skipped
+        :param verify_interval: days before an object is verified again
+        :return: hashes of the corrupt objects, and whether all objects are verified (False if some shards failed)
+        """
+        print('Verifying objects.')
+        self._sql_conn.commit()
+        verified_before = None if full else datetime.datetime.now() - datetime.timedelta(days=verify_interval)
+        shard_queue = ThreadSafeBufferQueue()
+        for shard in range(256):
+            shard_queue.enqueue(shard)
+        shard_queue.close()
+        results = []
+        finished = []
+        thds = []
+        start_time = time.monotonic()
+        for _ in range(self._thread_count):
+            thd = threading.Thread(target=self._verify_objects_shards,
+                                   args=(shard_queue, verified_before, results, finished), daemon=True)
+            thds.append(thd)
+            thd.start()
+        for thd in thds:
+            thd.join()
+        elapsed = max(time.monotonic() - start_time, 1e-6)
+        self._sql_conn.commit()
+        complete = len(finished) == len(thds)
+        if not complete:
+            warn('Failed to verify some of the objects')
+        object_count = sum([x[0] for x in results])
+        total_size = sum([x[1] for x in results]) / 1048576
+        corrupt_sha256 = sorted(itertools.chain(*[x[2] for x in results]))
+        print('Verified %d objects (%.1f MB) in %.1f s, %.1f MB/s' % (object_count, total_size, elapsed,
+                                                                    total_size / elapsed))
+        if len(corrupt_sha256) > 0:
+            warn('Detected %d corrupt objects' % len(corrupt_sha256))
+        return corrupt_sha256, complete
+
+    def _rehash_objects_shards(self, shard_queue: ThreadSafeBufferQueue, algorithm: str,
+                               results: List[Tuple[bytes, bytes]], failed: List[bytes], finished: List[bool]):
+        # collect (current hash, new hash) of the intact objects, and the objects failed to read or corrupt
+        while True:
+            try:
+                shard = shard_queue.dequeue()
+            except QueueClosedException:
+                break
+            for sha256 in self._objects.list_shard(shard):
+                current_hasher = self._new_hash()
+                new_hasher = self._new_hash(algorithm)
+                try:
+                    self._hash_object(sha256, [current_hasher, new_hasher])
+                except Exception as ex:
+                    warn('Failed to read object %s: %s' % (sha256.hex(), str(ex)))
+                    failed.append(sha256)
+                    continue
+                if current_hasher.digest() != sha256:
+                    warn('Corrupt object %s' % sha256.hex())
+                    failed.append(sha256)
+                    continue
+                results.append((sha256, new_hasher.digest()))
+        finished.append(True)
+
+    @staticmethod
+    def _replace_hashes_sql(table: str) -> str:
+        # replacing the hashes in table via table hash_migration
+        return 'update %s set sha256 = (select new_sha256 from hash_migration where old_sha256 = %s.sha256) ' \
+               'where sha256 in (select old_sha256 from hash_migration)' % (table, table)
 
-    def _extract_object(self, meta: FileMeta, dst: str):
-        src = os.path.join(self._path, 'objects', '%02x' % meta.sha256[0], meta.sha256.hex())
+    def _migrate_objects(self, algorithm: str):
+        # the objects are stored under the new hashes first, and the database is committed before the backups and
+        # the old objects are migrated, so that an interrupted migration leaves the repository readable with either
+        # the old algorithm or the new one (then the rest is finished next time the repository is opened)
+        print('Hashing objects with %s.' % algorithm)
+        shard_queue = ThreadSafeBufferQueue()
+        for shard in range(256):
+            shard_queue.enqueue(shard)
+        shard_queue.close()
+        results = []
+        failed = []
+        finished = []
+        thds = []
+        for _ in range(self._thread_count):
+            thd = threading.Thread(target=self._rehash_objects_shards,
+                                   args=(shard_queue, algorithm, results, failed, finished), daemon=True)
+            thds.append(thd)
+            thd.start()
+        for thd in thds:
+            thd.join()
+        if len(finished) < len(thds):
+            raise RuntimeError('Failed to hash some of the objects, the repository is not migrated')
+        # the files referencing an object not rehashed would keep the old hash, which is read as a hash of the new
+        # algorithm afterwards, so nothing is migrated until they are fixed
+        hashed = set([x[0] for x in results])
+        failed.extend([x[0] for x in self._sql_conn.iter_select(ObjectRefs, fields=('sha256',),
+                                                                refcount=Range(lower=1)) if x[0] not in hashed])
+        failed = set(failed)
+        if len(failed) > 0:
+            for path, file_name, sha256 in self._sql_conn.execute(
+                    'select d.path, f.file_name, f.sha256 from file_meta f join directory_meta d '
+                    'on d.path_id = f.path_id where f.sha256 is not null'):
+                if sha256 in failed:
+                    warn('File %s references the missing or corrupt object %s'
+                         % (self._abs_path(path + '/' + file_name), sha256.hex()))
+            raise RuntimeError('%d objects are missing or corrupt, the repository is not migrated, re-sync or remove '
+                               'the files referencing them first' % len(failed))
+        mapping = [x for x in results if x[0] != x[1]]
+        print('Storing %d objects.' % len(mapping))
+        tmp_path = os.path.join(self._path, 'tmp_rehash_file')
+        for old_sha256, new_sha256 in mapping:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self._objects.local_file(old_sha256) as local_path:
+                # the content is shared instead of copied if possible
+                try:
+                    os.link(local_path, tmp_path)
+                except OSError:
+                    shutil.copyfile(local_path, tmp_path)
+            self._objects.store(tmp_path, new_sha256)
+        print('Updating database.')
+        # the replaced hashes are neither changes of files nor changes of references
+        for sql in self._SNAPSHOT_TRIGGERS + self._OBJECT_REFS_TRIGGERS:
+            self._sql_conn.execute('drop trigger if exists %s'
+                                   % re.match(r'create trigger if not exists (\w+)', sql).group(1))
+        # the mapping is kept until the backups and the old objects are migrated
+        self._sql_conn.execute('drop table if exists hash_migration')
+        self._sql_conn.execute('create table hash_migration(old_sha256 binary(32) primary key, '
+                               'new_sha256 binary(32) not null)')
+        self._sql_conn.execute_many('insert into hash_migration(old_sha256, new_sha256) values (?, ?)', mapping)
+        for table in ['file_meta', 'file_meta_history', 'object_verification']:
+            self._sql_conn.execute(self._replace_hashes_sql(table))
+        self._sql_conn.set_variable('hash_algorithm', algorithm)
+        self._sql_conn.set_variable('hash_migration_pending', '1')
+        for sql in self._SNAPSHOT_TRIGGERS + self._OBJECT_REFS_TRIGGERS:
+            self._sql_conn.execute(sql)
+        self._sql_conn.commit()
+        self._finish_hash_migration()
+        print('Done.')
+
+    def _finish_hash_migration(self):
+        # replacing the hashes of the backups and removing the objects under the old hashes, after the database is
+        # migrated by _migrate_objects, all steps can be repeated if interrupted
+        mapping = self._sql_conn.execute('select old_sha256, new_sha256 from hash_migration')
+        for db_file in self._list_backup_db_file():
+            conn = sqlite3.connect(db_file)
+            try:
+                if conn.execute("select count(1) from sqlite_master where type = 'table' and name = 'file_meta'") \
+                        .fetchone()[0] > 0:
+                    conn.execute('create temp table hash_migration(old_sha256 binary(32) primary key, '
+                                 'new_sha256 binary(32) not null)')
+                    conn.executemany('insert into hash_migration(old_sha256, new_sha256) values (?, ?)', mapping)
+                    conn.execute(self._replace_hashes_sql('file_meta'))
+                    conn.commit()
+            finally:
+                conn.close()
+        self._rebuild_object_refs()
+        self._sql_conn.commit()
+        for old_sha256, _ in mapping:
+            if self._objects.exists(old_sha256):
+                self._objects.remove(old_sha256)
+        self._sql_conn.execute_many('delete from object_refs where sha256 = ?', [(x[0],) for x in mapping])
+        self._sql_conn.execute('drop table hash_migration')
+        self._sql_conn.set_variable('hash_migration_pending', '0')
+        self._sql_conn.commit()
+
+    def migrate_hash(self, algorithm: Optional[str] = None, md5: bool = False):
+        """
+        Change the hash algorithm of the repository, the objects are re-hashed and stored under the new hashes, and
+        the hashes in the database (with its snapshots and backups) are replaced
+        :param algorithm: the new content hash algorithm, None for keeping the current one
+        :param md5: compute md5 of the files pulled later, otherwise the md5 recorded are cleared
+        """
+        algorithm = algorithm or self._hash_algorithm
+        assert algorithm in self._HASH_ALGORITHMS, 'Invalid hash algorithm %s' % algorithm
+        self._new_hash(algorithm)
+        self._sql_conn.commit()
+        if algorithm != self._hash_algorithm:
+            self._migrate_objects(algorithm)
+        if not md5:
+            self._sql_conn.execute('update file_meta set md5 = null where md5 is not null')
+            self._sql_conn.execute('update file_meta_history set md5 = null where md5 is not null')
+        self._sql_conn.set_variable('hash_md5', str(int(md5)))
+        self._sql_conn.commit()
+        self._init_hash()
+
+    @property
+    def object_store(self) -> ObjectStore:
+        return self._objects
+
+    def _extract_object(self, meta: FileMeta, dst: str, link_mode: str = 'copy'):
+        # objects stored in chunks can't be linked
+        src = self._objects.raw_path(meta.sha256)
         print('Extracting %s' % dst)
-        shutil.copy(src, dst)
-        os.utime(dst, (int(get_datetime_timestamp(meta.access_time)), int(get_datetime_timestamp(meta.mod_time))))
+        if os.path.lexists(dst):
+            # never write through an existing link into the object
+            os.remove(dst)
+        times = (int(get_datetime_timestamp(meta.access_time)), int(get_datetime_timestamp(meta.mod_time)))
+        if link_mode != 'copy' and src is not None and self._link_object(src, dst, link_mode):
+            if link_mode == 'symlink':
+                if os.utime in os.supports_follow_symlinks:
+                    os.utime(dst, times, follow_symlinks=False)
+            else:
+                # the time of hard linked object is shared by all files linked to it
+                os.utime(dst, times)
+            return
+        if link_mode != 'copy' and not self._link_fallback_warned:
+            self._link_fallback_warned = True
+            warn('Could not %s some objects (objects stored in chunks or packs can not be linked), copying them instead'
+                 % link_mode)
+        if src is not None:
+            shutil.copy(src, dst)
+        else:
+            with self._objects.open(meta.sha256) as f_in:
+                with open(dst, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out, self._io_buffer_size)
+        os.utime(dst, times)
 
-    def _map_dir(self, db_path: str, fs_path: str):
+    def _map_file_callback(self, file_queue: ThreadSafeBufferQueue, link_mode: str):
+        while True:
+            try:
+                meta, dst = file_queue.dequeue()
+            except QueueClosedException:
+                return
+            try:
+                self._extract_object(meta, dst, link_mode)
+            except Exception as ex:
+                warn('exception while extracting file %s: %s' % (dst, str(ex)))
+
+    def _map_dir(self, db_path: str, fs_path: str, snapshot_id: Optional[int],
+                 extract_fn: Callable[[FileMeta, str], None]):
         os.makedirs(fs_path, exist_ok=True)
-        path_id = self._sql_conn.select(DirectoryMeta, 1, path=db_path).path_id
+        files = self.list_database(db_path, snapshot_id)
         if db_path == '/':
             db_path = ''
-        files = self._sql_conn.select(FileMeta, 0, path_id=path_id)
         for file in files:
             fs_file_name = self._escape_windows_file_name(file.file_name)
             if file.is_dir:
-                self._map_dir(db_path + '/' + file.file_name, os.path.join(fs_path, fs_file_name))
+                self._map_dir(db_path + '/' + file.file_name, os.path.join(fs_path, fs_file_name), snapshot_id,
+                              extract_fn)
             else:
-                self._extract_object(file, os.path.join(fs_path, fs_file_name))
+                extract_fn(file, os.path.join(fs_path, fs_file_name))
+
+    def _map_tree(self, db_path: str, fs_path: str, extract_fn: Callable[[FileMeta, str], None]):
+        # same as _map_dir for the current database, the directories of the subtree are found via directory_closure,
+        # and their files are selected in batches of path_id, instead of a query per directory
+        dir_meta = self._sql_conn.select(DirectoryMeta, 1, path=db_path)
+        dir_paths = dict(self._sql_conn.execute('select d.path_id, d.path from directory_closure c '
+                                                'join directory_meta d on d.path_id = c.descendant_id '
+                                                'where c.ancestor_id = ?', (dir_meta.path_id,)))
+        if db_path == '/':
+            db_path = ''
+        fs_dirs = {}
+        for path_id, path in dir_paths.items():
+            fs_dirs[path_id] = os.path.join(fs_path, *[self._escape_windows_file_name(x)
+                                                       for x in path[len(db_path):].split('/') if len(x) > 0])
+            os.makedirs(fs_dirs[path_id], exist_ok=True)
+        path_ids = list(dir_paths.keys())
+        for i in range(0, len(path_ids), self._IN_BATCH_SIZE):
+            for meta in self._sql_conn.iter_select(FileMeta, path_id=In(path_ids[i:i + self._IN_BATCH_SIZE])):
+                dst = os.path.join(fs_dirs[meta.path_id], self._escape_windows_file_name(meta.file_name))
+                if meta.is_dir:
+                    os.makedirs(dst, exist_ok=True)
+                else:
+                    extract_fn(meta, dst)
 
     @staticmethod
     def _escape_windows_file_name(s: str):
@@ -647,21 +1983,94 @@ class BackupManager:
             s = s.replace(ch, '_')
         return s
 
-    def map_database_to_fs(self, db_path: str, fs_path: str):
+    def map_database_to_fs(self, db_path: str, fs_path: str, snapshot_id: Optional[int] = None,
+                           link_mode: str = 'copy'):
+        """
+        Extract the files in database to file system
+        :param db_path: file or directory in database
+        :param fs_path: destination in file system
+        :param snapshot_id: snapshot to read, None for the current database
+        :param link_mode: one of _LINK_MODES, files are hard linked, reflinked or symlinked to the objects instead of
+        copied if possible (falling back to copy otherwise), modifying the hard linked or symlinked files corrupts the
+        objects
+        """
+        assert link_mode in self._LINK_MODES, 'Invalid link mode %s' % link_mode
         db_path = self._abs_path(db_path)
-        path_type, path_id = self._stat_path(db_path)
+        self._link_fallback_warned = False
+        if snapshot_id is not None:
+            path_type, meta = self._stat_snapshot_path(db_path, snapshot_id)
+        else:
+            path_type, path_id = self._stat_path(db_path)
+            meta = None
+            if path_type == self._ST_FILE:
+                meta = self._sql_conn.select(FileMeta, 1, path_id=path_id, file_name=self._file_name(db_path))
         if path_type == self._ST_FILE:
-            file_name = self._file_name(db_path)
             if os.path.isdir(fs_path):
                 # if fs path is a directory, create a new file to directory
-                fs_path = os.path.join(fs_path, self._escape_windows_file_name(file_name))
-            meta = self._sql_conn.select(FileMeta, 1, path_id=path_id, file_name=file_name)
-            self._extract_object(meta, fs_path)
+                fs_path = os.path.join(fs_path, self._escape_windows_file_name(meta.file_name))
+            self._extract_object(meta, fs_path, link_mode)
         elif path_type == self._ST_DIR:
             if os.path.isfile(fs_path):
                 raise NotADirectoryError(fs_path)
-            self._map_dir(db_path, fs_path)
-    
+            map_fn = self._map_tree if snapshot_id is None else \
+                functools.partial(self._map_dir, snapshot_id=snapshot_id)
+            if link_mode != 'copy':
+                map_fn(db_path, fs_path, extract_fn=functools.partial(self._extract_object, link_mode=link_mode))
+                return
+            # copying in parallel
+            file_queue = ThreadSafeBufferQueue(16384)
+            thds = []
+            for _ in range(self._thread_count):
+                thd = threading.Thread(target=self._map_file_callback, args=(file_queue, link_mode), daemon=True)
+                thds.append(thd)
+                thd.start()
+            try:
+                map_fn(db_path, fs_path, extract_fn=lambda meta, dst: file_queue.enqueue((meta, dst)))
+            finally:
+                file_queue.close()
+                for thd in thds:
+                    thd.join()
+
+    def _snapshot_changes(self, snapshot_id: int) -> Dict[Tuple[str, str], Tuple]:
+        # (path, file_name) -> earliest recorded state not before the snapshot, for the files changed after it
+        rows = self._sql_conn.execute('select path, file_name, min(snapshot_id), file_size, mod_time, sha256, is_dir '
+                                      'from file_meta_history where snapshot_id >= ? group by path, file_name',
+                                      (snapshot_id,))
+        return dict([((x[0], x[1]), x[3:]) for x in rows])
+
+    def diff_snapshots(self, old_snapshot_id: int, new_snapshot_id: Optional[int] = None) -> List[Tuple[str, str]]:
+        """
+        List the changes between two snapshots, the files not recorded after the old snapshot are unchanged, so only
+        the recorded ones are compared
+        :param old_snapshot_id: the older snapshot
+        :param new_snapshot_id: the newer snapshot, None for the current database
+        :return: sorted (change, path) pairs, change is one of "A" (added), "D" (removed) and "M" (changed)
+        """
+        if new_snapshot_id is not None and new_snapshot_id < old_snapshot_id:
+            old_snapshot_id, new_snapshot_id = new_snapshot_id, old_snapshot_id
+        old_states = self._snapshot_changes(old_snapshot_id)
+        new_states = self._snapshot_changes(new_snapshot_id) if new_snapshot_id is not None else {}
+        changes = []
+        for (path, file_name), old_state in old_states.items():
+            new_state = new_states.get((path, file_name))
+            if new_state is None:
+                # unchanged after the newer snapshot
+                new_state = self._sql_conn.execute('select f.file_size, f.mod_time, f.sha256, f.is_dir '
+                                                   'from file_meta f join directory_meta d on f.path_id = d.path_id '
+                                                   'where d.path = ? and f.file_name = ?', (path, file_name))
+                new_state = new_state[0] if len(new_state) > 0 else (None, None, None, None)
+            full_path = (path if path != '/' else '') + '/' + file_name
+            if old_state[0] is None and new_state[0] is not None:
+                changes.append(('A', full_path))
+            elif old_state[0] is not None and new_state[0] is None:
+                changes.append(('D', full_path))
+            elif old_state[0] is not None and tuple(old_state) != tuple(new_state):
+                changes.append(('M', full_path))
+        changes.sort(key=lambda x: x[1])
+        for change, path in changes:
+            print('%s %s' % (change, path))
+        return changes
+
     def compress_database(self):
         cursor = self._sql_conn.cursor()
         cursor.execute("vacuum")
@@ -681,4 +2090,25 @@ class BackupManager:
     #         warn('Could not find backup database file, operation aborted')
 
     def cleanup_objects(self):
-        self._validate_objects(remove_unused=True)
+        # objects without reference are found via index_refcount, without scanning the databases and objects
+        garbage = self._sql_conn.iter_select(ObjectRefs, fields=('sha256',),
+                                             refcount=Range(upper=0, include_upper=True))
+        removed_count = 0
+        for sha256, in garbage:
+            if self._objects.exists(sha256):
+                self._objects.remove(sha256)
+                removed_count += 1
+        self._sql_conn.execute('delete from object_verification where sha256 in '
+                               '(select sha256 from object_refs where refcount <= 0)')
+        self._sql_conn.delete(ObjectRefs, refcount=Range(upper=0, include_upper=True))
+        self._sql_conn.commit()
+        print('Removed %d unused objects' % removed_count)
+        # also reclaiming the chunks and pack space left by interrupted stores, even if no object is removed now
+        chunk_count = self._objects.collect_garbage()
+        if chunk_count > 0:
+            print('Removed %d unused chunks and packs' % chunk_count)
+
+    def close(self):
+        self._shell.close()
+        self._objects.close()
+        self._sql_conn.close()
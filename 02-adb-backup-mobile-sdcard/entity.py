@@ -2,12 +2,26 @@ from orm_utils import *
 
 
 class DirectoryMeta(Entity):
+    # parent_id is null for the root
     __FIELDS__ = [TableFieldDescriptor('path_id', 'integer', primary_key=True, auto_increment=True),
                   TableFieldDescriptor('path', 'text', not_null=True, unique=True),
+                  TableFieldDescriptor('parent_id', 'integer'),
                   TableIndexDescriptor('index_path', 'path')]
 
 
+class DirectoryClosure(Entity):
+    # every (ancestor, descendant) pair of directories including the directory itself at depth 0, maintained by triggers
+    # on directory_meta
+    __FIELDS__ = [TableFieldDescriptor('ancestor_id', 'integer', not_null=True),
+                  TableFieldDescriptor('descendant_id', 'integer', not_null=True),
+                  TableFieldDescriptor('depth', 'integer', not_null=True),
+                  TableIndexDescriptor('index_closure_descendant', 'descendant_id'),
+                  MultiPrimaryKeyOrderDescriptor('ancestor_id', 'descendant_id')]
+
+
 class FileMeta(Entity):
+    # sha256 is the content hash by the algorithm of the repository (db variable hash_algorithm), naming the stored
+    # object, md5 is null unless enabled by db variable hash_md5
     __FIELDS__ = [TableFieldDescriptor('path_id', 'integer', not_null=True),
                   TableFieldDescriptor('file_name', 'text', not_null=True),
                   TableFieldDescriptor('file_size', 'bigint', not_null=True),
@@ -17,8 +31,62 @@ class FileMeta(Entity):
                   TableFieldDescriptor('md5', 'binary(16)'),
                   TableFieldDescriptor('sha256', 'binary(32)'),
                   TableFieldDescriptor('is_dir', 'tinyint'),
-                  TableIndexDescriptor('index_md5', 'md5'),
                   TableIndexDescriptor('index_sha256', 'sha256'),
                   TableIndexDescriptor('index_file_name', 'path_id', 'file_name'),
                   MultiPrimaryKeyOrderDescriptor('path_id', 'file_name'),
                   ForeignKeyDescriptor('path_id', 'directory_meta')]
+
+
+class SyncJournal(Entity):
+    # pending works of an unfinished sync_remote, rows are removed once the works are done
+    __FIELDS__ = [TableFieldDescriptor('remote_path', 'text', primary_key=True),
+                  TableFieldDescriptor('db_path', 'text', not_null=True),
+                  TableFieldDescriptor('job_type', 'tinyint', not_null=True),
+                  TableFieldDescriptor('path_id', 'integer')]
+
+
+class ObjectRefs(Entity):
+    # references of stored objects from the database, its snapshots and backups, objects with refcount 0 are garbage
+    __FIELDS__ = [TableFieldDescriptor('sha256', 'binary(32)', primary_key=True),
+                  TableFieldDescriptor('refcount', 'integer', not_null=True),
+                  TableFieldDescriptor('size', 'bigint', not_null=True),
+                  TableIndexDescriptor('index_refcount', 'refcount')]
+
+
+class Snapshot(Entity):
+    # generations of the database, taken before each sync
+    __FIELDS__ = [TableFieldDescriptor('snapshot_id', 'integer', primary_key=True, auto_increment=True),
+                  TableFieldDescriptor('create_time', 'timestamp', not_null=True)]
+
+
+class FileMetaHistory(Entity):
+    # the state at snapshot_id of the files changed after that snapshot, file_size is null if the file did not exist,
+    # the state at a snapshot is the row of the earliest snapshot not before it, or file_meta if there is no such row
+    __FIELDS__ = [TableFieldDescriptor('snapshot_id', 'integer', not_null=True),
+                  TableFieldDescriptor('path', 'text', not_null=True),
+                  TableFieldDescriptor('file_name', 'text', not_null=True),
+                  TableFieldDescriptor('file_size', 'bigint'),
+                  TableFieldDescriptor('access_time', 'timestamp'),
+                  TableFieldDescriptor('mod_time', 'timestamp'),
+                  TableFieldDescriptor('create_time', 'timestamp'),
+                  TableFieldDescriptor('md5', 'binary(16)'),
+                  TableFieldDescriptor('sha256', 'binary(32)'),
+                  TableFieldDescriptor('is_dir', 'tinyint'),
+                  TableIndexDescriptor('index_history_sha256', 'sha256'),
+                  TableIndexDescriptor('index_history_snapshot', 'snapshot_id'),
+                  MultiPrimaryKeyOrderDescriptor('path', 'file_name', 'snapshot_id')]
+
+
+class PackIndex(Entity):
+    # location of the small objects appended to pack files
+    __FIELDS__ = [TableFieldDescriptor('sha256', 'binary(32)', primary_key=True),
+                  TableFieldDescriptor('pack_id', 'integer', not_null=True),
+                  TableFieldDescriptor('pack_offset', 'bigint', not_null=True),
+                  TableFieldDescriptor('size', 'bigint', not_null=True),
+                  TableIndexDescriptor('index_pack_id', 'pack_id')]
+
+
+class ObjectVerification(Entity):
+    # the last time the content of a stored object is re-hashed and matches its sha256
+    __FIELDS__ = [TableFieldDescriptor('sha256', 'binary(32)', primary_key=True),
+                  TableFieldDescriptor('verify_time', 'timestamp', not_null=True)]
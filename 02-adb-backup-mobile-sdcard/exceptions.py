@@ -8,3 +8,7 @@ class InvalidPathException(Exception):
 
 class DirectoryExistedException(Exception):
     pass
+
+
+class IncompleteScanException(Exception):
+    pass
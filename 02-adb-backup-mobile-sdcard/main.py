@@ -1,41 +1,136 @@
 from backup_manager import BackupManager
+from backup_fs import BackupFileSystem
 import argparse
+import datetime
+
+
+def _date(s: str) -> datetime.date:
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--action", choices=['sync_local', 'sync_remote', 'map_fs', 'cleanup'],
+    parser.add_argument("--action", choices=['sync_local', 'sync_remote', 'resume', 'map_fs', 'mount', 'diff',
+                                             'du', 'verify', 'rehash', 'export', 'cleanup'],
                         dest='action', required=True,
                         help='choose action, sync_local: sync from local to remote, sync_remote: sync from remote to'
-                             ' local, map_fs: map objects to database, cleanup: reduce databases and clean up'
-                             ' unreferenced objects')
+                             ' local, resume: continue the interrupted sync_remote, map_fs: map objects to database,'
+                             ' mount: mount database as a read-only file system (requires fusepy), diff: list the'
+                             ' changed paths after a snapshot, du: count the directories, files and bytes under a path'
+                             ' in database, verify: re-hash stored objects to detect corruption, rehash: change the'
+                             ' hash algorithm of the repository, export: copy the whole database with its snapshots to'
+                             ' a new file, cleanup: reduce databases and clean up unreferenced objects')
     parser.add_argument("--thread", help='threads for parallel adb pull/push/stat', type=int, default=8,
                         dest='thread_count')
+    parser.add_argument('--bulk-scan', help='list the whole remote tree in one adb call when syncing remote',
+                        action='store_true', dest='bulk_scan')
+    parser.add_argument('--full', help='re-list directories even if their modification time is unchanged when syncing'
+                                       ' remote, re-hash all objects when verifying', action='store_true',
+                        dest='full_scan')
+    parser.add_argument('--verify-interval', help='days before a verified object is re-hashed again when verifying',
+                        type=int, default=30, dest='verify_interval')
+    parser.add_argument('--batch-pull', help='pull small files in batches of tar stream when syncing remote',
+                        action='store_true', dest='batch_pull')
+    parser.add_argument('--buffer', help='buffer size (in KiB) for receiving and hashing files', type=int,
+                        default=1024, dest='buffer_size')
+    parser.add_argument('--device-hash', help='hash files on the device before pulling, only transferring the files'
+                                              ' not stored yet', action='store_true', dest='device_hash')
+    parser.add_argument('--wal', help='open database in WAL mode, selects run concurrently with writes',
+                        action='store_true', dest='wal_mode')
+    parser.add_argument('--synchronous', help='sqlite synchronous pragma', choices=['off', 'normal', 'full'],
+                        dest='synchronous')
+    parser.add_argument('--cache-size', help='sqlite page cache size (in KiB) of each connection', type=int,
+                        dest='cache_size')
+    parser.add_argument('--mmap-size', help='sqlite memory-mapped I/O size (in MiB)', type=int, dest='mmap_size')
+    parser.add_argument('--snapshot', help='date (yyyy-mm-dd) of the snapshot to read for sync_local, map_fs and'
+                                           ' diff, the last snapshot taken on or before the date is used',
+                        type=_date, dest='snapshot')
+    parser.add_argument('--to-snapshot', help='date (yyyy-mm-dd) of the newer snapshot to compare with for diff,'
+                                              ' defaults to the current database', type=_date, dest='to_snapshot')
+    parser.add_argument('--link-mode', help='how map_fs materializes the files, hardlink, reflink and symlink link'
+                                            ' the files to the stored objects (do not modify the hard linked or'
+                                            ' symlinked files), falling back to copy if not supported',
+                        choices=['copy', 'hardlink', 'reflink', 'symlink'], default='copy', dest='link_mode')
+    parser.add_argument('--object-store', help='how new objects are stored, raw: whole files, chunked: content-defined'
+                                               ' chunks deduplicated across objects and compressed (can not be'
+                                               ' switched back), defaults to the one used last time',
+                        choices=['raw', 'chunked'], dest='object_store')
+    parser.add_argument('--compression', help='compression of chunks, zstd requires zstandard package, defaults to'
+                                              ' the one used last time', choices=['none', 'zlib', 'zstd'],
+                        dest='compression')
+    parser.add_argument('--pack-threshold', help='size (KiB) below which new objects are appended to pack files'
+                                                 ' instead of being stored as files, 0 to disable, defaults to the'
+                                                 ' one used last time', type=int, dest='pack_threshold')
+    parser.add_argument('--hash', help='content hash algorithm naming the objects when rehashing, blake3 requires'
+                                       ' blake3 package, defaults to the current one',
+                        choices=['sha256', 'blake2b', 'blake3'], dest='hash_algorithm')
+    parser.add_argument('--md5', help='also compute md5 of the files pulled later when rehashing, otherwise md5 is'
+                                      ' dropped', action='store_true', dest='md5')
     parser.add_argument('base_path', help='path where the backup files stores in the fs', type=str)
     parser.add_argument('db_path', help='path in the database system', type=str, nargs='?')
-    parser.add_argument('fs_or_remote_path', help='remote path when syncing or fs path when mapping',
+    parser.add_argument('fs_or_remote_path', help='remote path when syncing, fs path when mapping, mount point when'
+                                                  ' mounting or destination file when exporting',
                         type=str, nargs='?')
     args = parser.parse_args()
     # print(args)
-    manager = BackupManager(args.base_path, args.thread_count)
-    if args.action == 'sync_local':
-        assert args.fs_or_remote_path is not None, 'Missing required field: fs_or_remote_path'
-        assert args.db_path is not None, 'Missing required field: db_path'
-        manager.sync_local(args.fs_or_remote_path, args.db_path)
-    elif args.action == 'sync_remote':
-        assert args.fs_or_remote_path is not None, 'Missing required field: fs_or_remote_path'
-        assert args.db_path is not None, 'Missing required field: db_path'
-        manager.sync_remote(args.fs_or_remote_path, args.db_path)
-    elif args.action == 'map_fs':
-        assert args.fs_or_remote_path is not None, 'Missing required field: fs_or_remote_path'
-        assert args.db_path is not None, 'Missing required field: db_path'
-        manager.map_database_to_fs(args.db_path, args.fs_or_remote_path)
-    elif args.action == 'cleanup':
-        manager.compress_database()
-        manager.cleanup_objects()
-    else:
-        print("Don't know what to do for action", args.action)
-        exit(1)
+    sqlite_pragmas = {}
+    if args.synchronous is not None:
+        sqlite_pragmas['synchronous'] = args.synchronous
+    if args.cache_size is not None:
+        # negative value is in KiB
+        sqlite_pragmas['cache_size'] = -args.cache_size
+    if args.mmap_size is not None:
+        sqlite_pragmas['mmap_size'] = args.mmap_size * 1048576
+    manager = BackupManager(args.base_path, args.thread_count, io_buffer_size=args.buffer_size * 1024,
+                            device_hash=args.device_hash, wal_mode=args.wal_mode, sqlite_pragmas=sqlite_pragmas,
+                            object_store=args.object_store, compression=args.compression,
+                            pack_threshold=args.pack_threshold * 1024 if args.pack_threshold is not None else None)
+    try:
+        snapshot_id = manager.find_snapshot(args.snapshot) if args.snapshot is not None else None
+        if args.action == 'sync_local':
+            assert args.fs_or_remote_path is not None, 'Missing required field: fs_or_remote_path'
+            assert args.db_path is not None, 'Missing required field: db_path'
+            manager.sync_local(args.fs_or_remote_path, args.db_path, snapshot_id)
+        elif args.action == 'sync_remote':
+            assert args.fs_or_remote_path is not None, 'Missing required field: fs_or_remote_path'
+            assert args.db_path is not None, 'Missing required field: db_path'
+            manager.sync_remote(args.fs_or_remote_path, args.db_path, args.bulk_scan, args.full_scan,
+                                args.batch_pull)
+        elif args.action == 'resume':
+            manager.resume_sync_remote()
+        elif args.action == 'map_fs':
+            assert args.fs_or_remote_path is not None, 'Missing required field: fs_or_remote_path'
+            assert args.db_path is not None, 'Missing required field: db_path'
+            manager.map_database_to_fs(args.db_path, args.fs_or_remote_path, snapshot_id, args.link_mode)
+        elif args.action == 'mount':
+            assert args.fs_or_remote_path is not None, 'Missing required field: fs_or_remote_path'
+            assert args.db_path is not None, 'Missing required field: db_path'
+            BackupFileSystem(manager, args.db_path, snapshot_id).mount(args.fs_or_remote_path)
+        elif args.action == 'diff':
+            assert snapshot_id is not None, 'Missing required field: snapshot'
+            to_snapshot_id = manager.find_snapshot(args.to_snapshot) if args.to_snapshot is not None else None
+            manager.diff_snapshots(snapshot_id, to_snapshot_id)
+        elif args.action == 'du':
+            assert args.db_path is not None, 'Missing required field: db_path'
+            dir_count, file_count, file_size = manager.database_usage(args.db_path)
+            print('%d directories, %d files, %.1f MB' % (dir_count, file_count, file_size / 1048576))
+        elif args.action == 'verify':
+            corrupt_sha256, complete = manager.verify_objects(args.full_scan, args.verify_interval)
+            if len(corrupt_sha256) > 0 or not complete:
+                exit(1)
+        elif args.action == 'rehash':
+            manager.migrate_hash(args.hash_algorithm, args.md5)
+        elif args.action == 'export':
+            assert args.fs_or_remote_path is not None, 'Missing required field: fs_or_remote_path'
+            manager.export_database(args.fs_or_remote_path)
+        elif args.action == 'cleanup':
+            manager.compress_database()
+            manager.cleanup_objects()
+        else:
+            print("Don't know what to do for action", args.action)
+            exit(1)
+    finally:
+        manager.close()
 
 
 if __name__ == '__main__':
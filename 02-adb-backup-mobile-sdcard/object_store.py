@@ -0,0 +1,548 @@
+# Version 1.4
+# CHANGELOG
+# ver 1.4: availability of zstandard is checked without importing it
+# ver 1.3: appending checks the uncommitted pack index for duplicates, which is not visible to WAL read connections
+# ver 1.2: packs are synced before the index rows pointing to them are committed, reading a truncated pack raises
+# ver 1.1: added PackedObjectStore, appending small objects to pack files indexed in the database
+# Storage of the pulled files (objects), named by their sha256 hash. RawObjectStore keeps each object as a whole file at
+# objects/<first byte>/<sha256>. ChunkedObjectStore splits new objects into content-defined chunks, which are
+# deduplicated across objects and compressed at chunks/<first byte>/<sha256 of chunk>, leaving a manifest at
+# objects/<first byte>/<sha256>.chunks. ChunkedObjectStore reads both layouts, so a repository can switch to it at any
+# time. PackedObjectStore wraps either of them, appending the small objects to pack files at packs/<pack id>.pack.
+import bisect
+import contextlib
+import hashlib
+import importlib.util
+import io
+import itertools
+import mmap
+import os
+import re
+import shutil
+import threading
+import zlib
+from typing import *
+from entity import PackIndex, Prefix
+from sql_accessor import GenericSqlAccessor
+
+
+# 256 pseudo-random bits, mapping each byte value to a bit for finding chunk boundaries
+_BOUNDARY_BITS = hashlib.sha256(b'chunk boundary').digest()
+
+
+class ObjectStore:
+    """
+    Interface of object stores, objects are immutable once stored
+    """
+    def exists(self, sha256: bytes) -> bool:
+        raise NotImplementedError
+
+    def size(self, sha256: bytes) -> int:
+        raise NotImplementedError
+
+    def store(self, local_path: str, sha256: bytes):
+        """
+        Move the local file into the store
+        :param local_path: file with the content hashed to sha256, removed after stored
+        :param sha256: hash of the file
+        :exception RuntimeError: the object is stored with different size (hash conflict)
+        """
+        raise NotImplementedError
+
+    def open(self, sha256: bytes) -> BinaryIO:
+        """
+        Open the object for reading, the returned file object is seekable
+        """
+        raise NotImplementedError
+
+    def raw_path(self, sha256: bytes) -> Optional[str]:
+        """
+        Path of the object if it is stored as a whole file (which can be linked, but must not be modified)
+        """
+        raise NotImplementedError
+
+    def local_file(self, sha256: bytes) -> ContextManager[str]:
+        """
+        Context manager providing a local file with the content of the object, for the tools reading files only
+        """
+        raise NotImplementedError
+
+    def remove(self, sha256: bytes):
+        raise NotImplementedError
+
+    def list_shard(self, shard: int) -> List[bytes]:
+        """
+        Hashes of the stored objects starting with byte shard
+        """
+        raise NotImplementedError
+
+    def collect_garbage(self) -> int:
+        """
+        Remove the storage no longer used by any object after objects are removed, returns the count of removed items
+        """
+        return 0
+
+    def close(self):
+        pass
+
+
+class RawObjectStore(ObjectStore):
+    def __init__(self, path: str):
+        self._path = path
+        for i in range(256):
+            os.makedirs(os.path.join(self._path, 'objects', '%02x' % i), exist_ok=True)
+
+    def _object_path(self, sha256: bytes) -> str:
+        return os.path.join(self._path, 'objects', '%02x' % sha256[0], sha256.hex())
+
+    def exists(self, sha256: bytes) -> bool:
+        return os.path.exists(self._object_path(sha256))
+
+    def size(self, sha256: bytes) -> int:
+        return os.path.getsize(self._object_path(sha256))
+
+    def store(self, local_path: str, sha256: bytes):
+        dest_path = self._object_path(sha256)
+        if not os.path.exists(dest_path):
+            shutil.move(local_path, dest_path)
+        elif os.path.getsize(dest_path) == os.path.getsize(local_path):
+            os.remove(local_path)
+        else:
+            raise RuntimeError('Hash conflict for object %s' % sha256.hex())
+
+    def open(self, sha256: bytes) -> BinaryIO:
+        return open(self._object_path(sha256), 'rb')
+
+    def raw_path(self, sha256: bytes) -> Optional[str]:
+        path = self._object_path(sha256)
+        return path if os.path.isfile(path) else None
+
+    @contextlib.contextmanager
+    def local_file(self, sha256: bytes) -> Iterator[str]:
+        yield self._object_path(sha256)
+
+    def remove(self, sha256: bytes):
+        os.remove(self._object_path(sha256))
+
+    def list_shard(self, shard: int) -> List[bytes]:
+        result = []
+        with os.scandir(os.path.join(self._path, 'objects', '%02x' % shard)) as it:
+            for entry in it:
+                try:
+                    result.append(bytes.fromhex(entry.name))
+                except ValueError:
+                    continue
+        return result
+
+
+class _ChunkedObjectReader(io.RawIOBase):
+    # seekable reader over the chunks of an object, the last read chunk is kept decompressed
+    def __init__(self, store: 'ChunkedObjectStore', chunks: List[Tuple[bytes, int]]):
+        super(_ChunkedObjectReader, self).__init__()
+        self._store = store
+        self._chunks = chunks
+        self._offsets = list(itertools.accumulate([0] + [x[1] for x in chunks]))
+        self._pos = 0
+        self._chunk_index = -1
+        self._chunk = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._offsets[-1]
+        if offset < 0:
+            raise ValueError('Negative seek position %d' % offset)
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b) -> int:
+        if self._pos >= self._offsets[-1]:
+            return 0
+        i = bisect.bisect_right(self._offsets, self._pos) - 1
+        if i != self._chunk_index:
+            self._chunk = self._store.read_chunk(self._chunks[i][0])
+            self._chunk_index = i
+        start = self._pos - self._offsets[i]
+        count = min(len(b), len(self._chunk) - start)
+        b[:count] = self._chunk[start:start + count]
+        self._pos += count
+        return count
+
+
+class ChunkedObjectStore(RawObjectStore):
+    """
+    Objects are split at the positions where the 20 bytes before match a pattern (each byte is mapped to a bit by a
+    fixed table), so that the boundaries move along with the content after inserting or removing data, and the
+    unchanged chunks are shared. The matching runs in C via bytes.translate() and bytes.find().
+    """
+    _MIN_CHUNK_SIZE = 262144
+    _MAX_CHUNK_SIZE = 4194304
+    _BOUNDARY_PATTERN = b'01' * 10
+    _BOUNDARY_TABLE = bytes([ord('1') if (_BOUNDARY_BITS[x >> 3] >> (x & 7)) & 1 else ord('0') for x in range(256)])
+    # the first byte of a chunk file is the codec of the rest
+    _CODEC_STORED = b'0'
+    _CODEC_ZLIB = b'z'
+    _CODEC_ZSTD = b's'
+    _COMPRESSIONS = ['none', 'zlib', 'zstd']
+
+    def __init__(self, path: str, compression: str = 'zlib', io_buffer_size: int = 1048576):
+        super(ChunkedObjectStore, self).__init__(path)
+        assert compression in self._COMPRESSIONS, 'Invalid compression %s' % compression
+        # zstandard is only required for zstd compression, checked here instead of failing on the first chunk
+        if compression == 'zstd' and importlib.util.find_spec('zstandard') is None:
+            raise ImportError('zstandard package is required for zstd compression')
+        for i in range(256):
+            os.makedirs(os.path.join(self._path, 'chunks', '%02x' % i), exist_ok=True)
+        self._compression = compression
+        self._io_buffer_size = io_buffer_size
+
+    def _manifest_path(self, sha256: bytes) -> str:
+        return self._object_path(sha256) + '.chunks'
+
+    def _chunk_path(self, sha256: bytes) -> str:
+        return os.path.join(self._path, 'chunks', '%02x' % sha256[0], sha256.hex())
+
+    def _read_manifest(self, sha256: bytes) -> List[Tuple[bytes, int]]:
+        # each line is the hash and size of a chunk
+        with open(self._manifest_path(sha256), 'r') as f:
+            return [(bytes.fromhex(x[0]), int(x[1])) for x in (line.split() for line in f) if len(x) == 2]
+
+    def _split_chunks(self, fp: BinaryIO) -> Iterator[bytes]:
+        buffer = b''
+        eof = False
+        while True:
+            while not eof and len(buffer) < self._MAX_CHUNK_SIZE:
+                data = fp.read(self._io_buffer_size)
+                eof = len(data) == 0
+                buffer += data
+            if len(buffer) == 0:
+                return
+            window = buffer[:self._MAX_CHUNK_SIZE]
+            end = window.translate(self._BOUNDARY_TABLE).find(self._BOUNDARY_PATTERN,
+                                                               self._MIN_CHUNK_SIZE - len(self._BOUNDARY_PATTERN))
+            end = len(window) if end < 0 else end + len(self._BOUNDARY_PATTERN)
+            yield buffer[:end]
+            buffer = buffer[end:]
+
+    def _compress(self, data: bytes) -> bytes:
+        if self._compression == 'zlib':
+            compressed = self._CODEC_ZLIB + zlib.compress(data)
+        elif self._compression == 'zstd':
+            import zstandard
+            compressed = self._CODEC_ZSTD + zstandard.ZstdCompressor().compress(data)
+        else:
+            compressed = None
+        # incompressible data (e.g. photos and videos) is stored as is
+        if compressed is None or len(compressed) >= len(data) + 1:
+            return self._CODEC_STORED + data
+        return compressed
+
+    def read_chunk(self, sha256: bytes) -> bytes:
+        with open(self._chunk_path(sha256), 'rb') as f:
+            data = f.read()
+        codec, data = data[:1], data[1:]
+        if codec == self._CODEC_ZLIB:
+            return zlib.decompress(data)
+        elif codec == self._CODEC_ZSTD:
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(data)
+        return data
+
+    def _write_file(self, path: str, data: bytes):
+        # written to a temporary file first, so that incomplete files are never seen by readers
+        tmp_path = '%s.tmp%d' % (path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def exists(self, sha256: bytes) -> bool:
+        return super(ChunkedObjectStore, self).exists(sha256) or os.path.exists(self._manifest_path(sha256))
+
+    def size(self, sha256: bytes) -> int:
+        if super(ChunkedObjectStore, self).exists(sha256):
+            return super(ChunkedObjectStore, self).size(sha256)
+        return sum([x[1] for x in self._read_manifest(sha256)])
+
+    def store(self, local_path: str, sha256: bytes):
+        if self.exists(sha256):
+            if self.size(sha256) != os.path.getsize(local_path):
+                raise RuntimeError('Hash conflict for object %s' % sha256.hex())
+            os.remove(local_path)
+            return
+        chunks = []
+        with open(local_path, 'rb') as f:
+            for data in self._split_chunks(f):
+                chunk_sha256 = hashlib.sha256(data).digest()
+                chunk_path = self._chunk_path(chunk_sha256)
+                if not os.path.exists(chunk_path):
+                    self._write_file(chunk_path, self._compress(data))
+                chunks.append((chunk_sha256, len(data)))
+        # the manifest is written after all chunks, the object exists once its manifest exists
+        self._write_file(self._manifest_path(sha256),
+                         ''.join(['%s %d\n' % (x[0].hex(), x[1]) for x in chunks]).encode('utf8'))
+        os.remove(local_path)
+
+    def open(self, sha256: bytes) -> BinaryIO:
+        if super(ChunkedObjectStore, self).exists(sha256):
+            return super(ChunkedObjectStore, self).open(sha256)
+        return io.BufferedReader(_ChunkedObjectReader(self, self._read_manifest(sha256)), self._io_buffer_size)
+
+    @contextlib.contextmanager
+    def local_file(self, sha256: bytes) -> Iterator[str]:
+        if super(ChunkedObjectStore, self).exists(sha256):
+            yield self._object_path(sha256)
+            return
+        tmp_path = os.path.join(self._path, 'tmp_object_file_%d' % threading.get_ident())
+        try:
+            with self.open(sha256) as f_in:
+                with open(tmp_path, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out, self._io_buffer_size)
+            yield tmp_path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def remove(self, sha256: bytes):
+        # the chunks are removed by collect_garbage()
+        if super(ChunkedObjectStore, self).exists(sha256):
+            super(ChunkedObjectStore, self).remove(sha256)
+        else:
+            os.remove(self._manifest_path(sha256))
+
+    def list_shard(self, shard: int) -> List[bytes]:
+        result = []
+        with os.scandir(os.path.join(self._path, 'objects', '%02x' % shard)) as it:
+            for entry in it:
+                name = entry.name[:-len('.chunks')] if entry.name.endswith('.chunks') else entry.name
+                try:
+                    result.append(bytes.fromhex(name))
+                except ValueError:
+                    continue
+        return result
+
+    def collect_garbage(self) -> int:
+        # chunks are shared by objects, the ones not in any manifest are removed
+        referenced = set()
+        for shard in range(256):
+            with os.scandir(os.path.join(self._path, 'objects', '%02x' % shard)) as it:
+                for entry in it:
+                    if entry.name.endswith('.chunks') and len(entry.name) == 64 + len('.chunks'):
+                        referenced.update([x[0] for x in self._read_manifest(bytes.fromhex(entry.name[:64]))])
+        removed_count = 0
+        for shard in range(256):
+            shard_path = os.path.join(self._path, 'chunks', '%02x' % shard)
+            with os.scandir(shard_path) as it:
+                for entry in it:
+                    try:
+                        if bytes.fromhex(entry.name) in referenced:
+                            continue
+                    except ValueError:
+                        # temporary file left by interrupted writes
+                        pass
+                    os.remove(os.path.join(shard_path, entry.name))
+                    removed_count += 1
+        return removed_count
+
+
+class PackedObjectStore(ObjectStore):
+    """
+    Objects smaller than pack_threshold are appended to pack files instead of being stored as files of their own, so
+    that many small objects do not cost an inode and a directory entry each. The location (pack, offset and size) of a
+    packed object is kept in table pack_index of the database, in the same transaction as the file entries referencing
+    it. Packed objects are read via mmap, the larger objects are handled by the wrapped store.
+    """
+    _PACK_NAME_PATTERN = re.compile(r'^(\d+)\.pack$')
+    _MAX_PACK_SIZE = 67108864
+    # packs with less data of live objects than this ratio are rewritten by collect_garbage()
+    _MIN_LIVE_RATIO = 0.5
+
+    def __init__(self, store: ObjectStore, path: str, sql_conn: GenericSqlAccessor, pack_threshold: int):
+        """
+        :param store: the store of the objects not smaller than pack_threshold
+        :param path: base path of the repository
+        :param sql_conn: the database keeping the pack index
+        :param pack_threshold: objects smaller than it (in bytes) are packed, 0 for storing new objects unpacked
+        """
+        assert pack_threshold >= 0, 'pack_threshold must not be negative'
+        self._store = store
+        self._packs_path = os.path.join(path, 'packs')
+        os.makedirs(self._packs_path, exist_ok=True)
+        self._sql_conn = sql_conn
+        self._sql_conn.ensure_table(PackIndex)
+        self._pack_threshold = pack_threshold
+        # appends go to the last pack until it is full
+        self._pack_id = max(self._list_packs(), default=1)
+        self._pack_file = None  # type: Optional[BinaryIO]
+        self._write_lock = threading.Lock()
+        self._maps = {}  # type: Dict[int, mmap.mmap]
+        self._map_lock = threading.Lock()
+        # packs appended since last sync, synced by the commit hook, so that an index row never points past the end
+        # of its pack after a crash
+        self._unsynced_packs = set()  # type: Set[int]
+        self._sync_lock = threading.Lock()
+        self._sql_conn.add_commit_hook(self._sync_packs)
+
+    def _pack_path(self, pack_id: int) -> str:
+        return os.path.join(self._packs_path, '%d.pack' % pack_id)
+
+    def _list_packs(self) -> List[int]:
+        matches = [self._PACK_NAME_PATTERN.match(x) for x in os.listdir(self._packs_path)]
+        return sorted([int(x.group(1)) for x in matches if x is not None])
+
+    def _locate(self, sha256: bytes, latest: bool = False) -> Optional[PackIndex]:
+        # latest for seeing the objects packed but not committed yet
+        if latest:
+            return self._sql_conn.select_latest(PackIndex, 1, sha256=sha256)
+        return self._sql_conn.select(PackIndex, 1, sha256=sha256)
+
+    def _append(self, data: bytes) -> Tuple[int, int]:
+        # called with write lock acquired, returns the pack id and offset of the data
+        if self._pack_file is None:
+            self._pack_file = open(self._pack_path(self._pack_id), 'ab')
+            self._pack_file.seek(0, io.SEEK_END)
+        if self._pack_file.tell() >= self._MAX_PACK_SIZE:
+            self._pack_file.close()
+            self._pack_id += 1
+            self._pack_file = open(self._pack_path(self._pack_id), 'ab')
+        offset = self._pack_file.tell()
+        self._pack_file.write(data)
+        # flushed before the index row is written, so that the data is visible to readers once indexed
+        self._pack_file.flush()
+        with self._sync_lock:
+            self._unsynced_packs.add(self._pack_id)
+        return self._pack_id, offset
+
+    def _sync_packs(self):
+        # commit hook, the pack files are reopened instead of using self._pack_file, which is guarded by write lock
+        with self._sync_lock:
+            for pack_id in self._unsynced_packs:
+                with open(self._pack_path(pack_id), 'ab') as f:
+                    os.fsync(f.fileno())
+            self._unsynced_packs.clear()
+
+    def _read(self, entry: PackIndex) -> bytes:
+        if entry.size == 0:
+            return b''
+        end = entry.pack_offset + entry.size
+        with self._map_lock:
+            mm = self._maps.get(entry.pack_id)
+            if mm is None or len(mm) < end:
+                # the last pack grows after it is mapped
+                if mm is not None:
+                    mm.close()
+                with open(self._pack_path(entry.pack_id), 'rb') as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[entry.pack_id] = mm
+                if len(mm) < end:
+                    raise OSError('Pack %d is truncated, object %s ends at %d but the pack has %d bytes' %
+                                  (entry.pack_id, entry.sha256.hex(), end, len(mm)))
+            return mm[entry.pack_offset:end]
+
+    def _unmap(self, pack_id: int):
+        with self._map_lock:
+            mm = self._maps.pop(pack_id, None)
+            if mm is not None:
+                mm.close()
+
+    def exists(self, sha256: bytes) -> bool:
+        return self._locate(sha256) is not None or self._store.exists(sha256)
+
+    def size(self, sha256: bytes) -> int:
+        entry = self._locate(sha256)
+        return entry.size if entry is not None else self._store.size(sha256)
+
+    def store(self, local_path: str, sha256: bytes):
+        size = os.path.getsize(local_path)
+        if size >= self._pack_threshold:
+            self._store.store(local_path, sha256)
+            return
+        with self._write_lock:
+            entry = self._locate(sha256, latest=True)
+            if entry is not None or self._store.exists(sha256):
+                if (entry.size if entry is not None else self._store.size(sha256)) != size:
+                    raise RuntimeError('Hash conflict for object %s' % sha256.hex())
+            else:
+                with open(local_path, 'rb') as f:
+                    pack_id, offset = self._append(f.read())
+                self._sql_conn.insert(PackIndex(sha256=sha256, pack_id=pack_id, pack_offset=offset, size=size))
+        os.remove(local_path)
+
+    def open(self, sha256: bytes) -> BinaryIO:
+        entry = self._locate(sha256)
+        if entry is None:
+            return self._store.open(sha256)
+        return io.BytesIO(self._read(entry))
+
+    def raw_path(self, sha256: bytes) -> Optional[str]:
+        if self._locate(sha256) is not None:
+            return None
+        return self._store.raw_path(sha256)
+
+    @contextlib.contextmanager
+    def local_file(self, sha256: bytes) -> Iterator[str]:
+        entry = self._locate(sha256)
+        if entry is None:
+            with self._store.local_file(sha256) as path:
+                yield path
+            return
+        tmp_path = os.path.join(self._packs_path, 'tmp_object_file_%d' % threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self._read(entry))
+            yield tmp_path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def remove(self, sha256: bytes):
+        # the space in the pack is reclaimed by collect_garbage()
+        if self._locate(sha256) is not None:
+            self._sql_conn.delete(PackIndex, sha256=sha256)
+        else:
+            self._store.remove(sha256)
+
+    def list_shard(self, shard: int) -> List[bytes]:
+        packed = self._sql_conn.iter_select(PackIndex, fields=('sha256',), sha256=Prefix(bytes([shard])))
+        return self._store.list_shard(shard) + [x[0] for x in packed]
+
+    def collect_garbage(self) -> int:
+        # the live objects of sparse packs are appended to the last pack, then the sparse packs are removed
+        removed_count = self._store.collect_garbage()
+        live_sizes = dict(self._sql_conn.execute('select pack_id, sum(size) from pack_index group by pack_id'))
+        with self._write_lock:
+            for pack_id in self._list_packs():
+                if pack_id == self._pack_id or \
+                        live_sizes.get(pack_id, 0) >= os.path.getsize(self._pack_path(pack_id)) * self._MIN_LIVE_RATIO:
+                    continue
+                for entry in self._sql_conn.select(PackIndex, 0, pack_id=pack_id):
+                    new_pack_id, offset = self._append(self._read(entry))
+                    self._sql_conn.execute('update pack_index set pack_id = ?, pack_offset = ? where sha256 = ?',
+                                           (new_pack_id, offset, entry.sha256))
+                # the moved data is synced by the commit hook before the index pointing to it is committed
+                self._sql_conn.commit()
+                self._unmap(pack_id)
+                with self._sync_lock:
+                    self._unsynced_packs.discard(pack_id)
+                os.remove(self._pack_path(pack_id))
+                removed_count += 1
+        return removed_count
+
+    def close(self):
+        with self._write_lock:
+            if self._pack_file is not None:
+                self._pack_file.close()
+                self._pack_file = None
+        with self._map_lock:
+            for mm in self._maps.values():
+                mm.close()
+            self._maps.clear()
@@ -1,8 +1,13 @@
 # Object Relation Mapping for database
-# Version 1.3
+# Version 1.6
 # Providing basic entity class and various table field descriptors, all sql statement can be generated by this mechanism
 # automatically, including CREATE TABLE, SELECT, UPDATE, INSERT, DELETE based on given primary key.
 # CHANGELOG
+# Ver 1.6: added query predicates In, Range and Prefix for the keys of select and delete
+# Ver 1.5: entities are slotted (__slots__ generated from __FIELDS__ by metaclass), comparison and hash are done on the
+#   tuple of field values
+# Ver 1.4: cached not null fields and auto increment field at class initialization stage, added row factory building
+#   entities from fetched rows without validation
 # Ver 1.3: changed default value of TableFieldDescriptor behavior
 # Ver 1.2: Support entity comparison, moved field cache to class initialization stage, minor bug fixed for member
 #   injection
@@ -10,6 +15,7 @@
 #   underline naming rule of database, compatible with python's camel naming rule for classes, which will convert to
 #   underline naming rule automatically.
 from typing import *
+from operator import attrgetter
 from util import camel_to_underline
 
 
@@ -19,6 +25,7 @@ def _member_inject(obj, *args, **kwargs):
     obj_type = type(obj)
     fields = getattr(obj_type, '_member_inject_field_name')
     field_dict = getattr(obj_type, '_member_inject_field_dict')
+    expected_fields = getattr(obj_type, '_member_inject_field_set')
     set_fields = set()
     # check arguments
     if len(args) + len(kwargs) > len(fields):
@@ -27,7 +34,6 @@ def _member_inject(obj, *args, **kwargs):
     for i in range(len(args)):
         set_fields.add(fields[i])
         setattr(obj, fields[i], args[i])
-    expected_fields = set(fields)
     for key in kwargs:
         if key not in expected_fields:
             raise ValueError('Unexpected field %s' % key)
@@ -36,9 +42,7 @@ def _member_inject(obj, *args, **kwargs):
         set_fields.add(key)
         setattr(obj, key, kwargs[key])
     # check not null fields
-    not_null_fields = set([x.field_name for x in obj_type.__FIELDS__ if type(x) == TableFieldDescriptor
-                           and (x.not_null or x.primary_key) and x.default is None and not x.auto_increment])
-    missing_fields = not_null_fields.difference(set_fields)
+    missing_fields = getattr(obj_type, '_member_inject_field_not_null').difference(set_fields)
     if len(missing_fields) > 0:
         raise ValueError('Missing following not null fields: %s' % ', '.join(missing_fields))
     # add null fields
@@ -48,6 +52,19 @@ def _member_inject(obj, *args, **kwargs):
         setattr(obj, field, default_value)
 
 
+def _row_factory(cls: Type['Entity']) -> Callable[[Sequence[Any]], 'Entity']:
+    # build entities from the rows fetched in the order of fields, the values are trusted and not validated, the slots
+    # are assigned by a single unpacking statement generated for the entity class
+    field_names = getattr(cls, '_member_inject_field_name')
+    if len(field_names) == 0:
+        return lambda row: object.__new__(cls)
+    code = 'def from_row(row):\n    obj = new(cls)\n    %s, = row\n    return obj\n' % \
+           ', '.join(['obj.' + x for x in field_names])
+    namespace = {'new': object.__new__, 'cls': cls}
+    exec(code, namespace)
+    return namespace['from_row']
+
+
 class ConstraintError(Exception):
     pass
 
@@ -80,7 +97,16 @@ def _check_constraint(cls: Type['Entity']):
             primary_key_implicitly_described = True
 
 
-class Entity:
+class _EntityMeta(type):
+    # fields are stored in slots instead of instance dict, saving memory of the entities created for each row
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        if '__slots__' not in namespace:
+            namespace['__slots__'] = tuple([x.field_name for x in namespace.get('__FIELDS__', [])
+                                            if type(x) == TableFieldDescriptor])
+        return super(_EntityMeta, mcs).__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class Entity(metaclass=_EntityMeta):
     __FIELDS__ = []
     __TABLE_NAME__ = ''
     EntityClass = []  # tracks all sub-class of Entity
@@ -93,29 +119,46 @@ class Entity:
         field_dict = dict([(x.field_name, x) for x in basic_fields])
         setattr(cls, '_member_inject_field_dict', field_dict)
         setattr(cls, '_member_inject_field_name', [x.field_name for x in basic_fields])
+        setattr(cls, '_member_inject_field_set', frozenset(field_dict.keys()))
+        setattr(cls, '_member_inject_field_not_null',
+                frozenset([x.field_name for x in basic_fields if (x.not_null or x.primary_key) and x.default is None
+                           and not x.auto_increment]))
         pkey = [x.field_name for x in basic_fields if x.primary_key]
         if len(pkey) == 0:
             pkey = [x for x in cls.__FIELDS__ if type(x) == MultiPrimaryKeyOrderDescriptor][0].primary_key_orders
-        setattr(cls, '_member_inject_field_primary', pkey)
+        setattr(cls, '_member_inject_field_primary', list(pkey))
+        setattr(cls, '_member_inject_field_non_primary',
+                [x.field_name for x in basic_fields if x.field_name not in pkey])
+        auto_increment_fields = [x.field_name for x in basic_fields if x.auto_increment]
+        assert len(auto_increment_fields) <= 1, 'More than 1 auto increment fields are unsupported'
+        setattr(cls, '_member_inject_field_auto_increment',
+                auto_increment_fields[0] if len(auto_increment_fields) > 0 else None)
+        setattr(cls, '_member_inject_row_factory', staticmethod(_row_factory(cls)))
+        # values of all fields, a tuple unless there is only one field
+        field_names = cls._member_inject_field_name
+        setattr(cls, '_member_inject_values',
+                staticmethod(attrgetter(*field_names) if len(field_names) > 0 else lambda obj: ()))
 
     def __init__(self, *args, **kwargs):
         _member_inject(self, *args, **kwargs)
 
     def __repr__(self):
-        return '<Entity "%s" for table "%s": %s>' % (type(self).__name__, self.__TABLE_NAME__, str(self.__dict__))
+        fields = getattr(self, '_member_inject_field_name')
+        return '<Entity "%s" for table "%s": %s>' % (type(self).__name__, self.__TABLE_NAME__,
+                                                     str(dict([(x, getattr(self, x, None)) for x in fields])))
 
     def __eq__(self, other):
-        if not type(self) == type(other):
+        if type(self) is not type(other):
             return False
-        fields = getattr(self, '_member_inject_field_name')
-        for field in fields:
-            field_val = getattr(self, field)
-            if not hasattr(field_val, '__ne__'):
-                raise RuntimeError('Field %s (value type: %s) of Entity class %s does not support "!=" operation' %
-                                   (field, type(field_val).__name__, type(self).__name__))
-            if field_val != getattr(other, field):
-                return False
-        return True
+        values = self._member_inject_values
+        return values(self) == values(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        # entities are mutable, do not modify the ones used as keys
+        return hash((type(self), self._member_inject_values(self)))
 
     # disable reference hint for pycharm
     def __getattr__(self, item):
@@ -177,3 +220,84 @@ class TableIndexDescriptor(AbstractTableDescriptor):
 
     def __repr__(self):
         return '<TableIndexDescriptor %s on field %s>' % (self.index_name, ', '.join(self.index_fields))
+
+
+# query predicates, passed as the values of keys to select and delete instead of the values matched by equality, the
+# statement of a predicate only depends on its shape, so that it can be compiled once
+class QueryPredicate:
+    def shape(self) -> Tuple:
+        raise NotImplementedError
+
+    def condition(self, column: str, placeholder: str) -> str:
+        raise NotImplementedError
+
+    def args(self) -> List[Any]:
+        raise NotImplementedError
+
+
+class In(QueryPredicate):
+    def __init__(self, values: Iterable[Any]):
+        self.values = list(values)
+
+    def shape(self) -> Tuple:
+        return 'in', len(self.values)
+
+    def condition(self, column: str, placeholder: str) -> str:
+        if len(self.values) == 0:
+            return '0 = 1'
+        return '%s in (%s)' % (column, ', '.join([placeholder] * len(self.values)))
+
+    def args(self) -> List[Any]:
+        return self.values
+
+    def __repr__(self):
+        return '<In %s>' % repr(self.values)
+
+
+class Range(QueryPredicate):
+    # bounds of None are unlimited
+    def __init__(self, lower: Optional[Any] = None, upper: Optional[Any] = None, include_lower: bool = True,
+                 include_upper: bool = False):
+        self.lower = lower
+        self.upper = upper
+        self.include_lower = include_lower
+        self.include_upper = include_upper
+
+    def shape(self) -> Tuple:
+        return 'range', self.lower is not None and self.include_lower, self.lower is not None and \
+            not self.include_lower, self.upper is not None and self.include_upper, self.upper is not None and \
+            not self.include_upper
+
+    def condition(self, column: str, placeholder: str) -> str:
+        conditions = []
+        if self.lower is not None:
+            conditions.append('%s %s %s' % (column, '>=' if self.include_lower else '>', placeholder))
+        if self.upper is not None:
+            conditions.append('%s %s %s' % (column, '<=' if self.include_upper else '<', placeholder))
+        return ' and '.join(conditions) if len(conditions) > 0 else '1 = 1'
+
+    def args(self) -> List[Any]:
+        return [x for x in [self.lower, self.upper] if x is not None]
+
+    def __repr__(self):
+        return '<Range %s%s, %s%s>' % ('[' if self.include_lower else '(', repr(self.lower), repr(self.upper),
+                                       ']' if self.include_upper else ')')
+
+
+class Prefix(Range):
+    # values (str or bytes) starting with prefix, queried as a range so that the index of the field is used
+    def __init__(self, prefix: Union[str, bytes]):
+        super(Prefix, self).__init__(prefix if len(prefix) > 0 else None, self._upper_bound(prefix))
+        self.prefix = prefix
+
+    @staticmethod
+    def _upper_bound(prefix: Union[str, bytes]) -> Optional[Union[str, bytes]]:
+        # the least value greater than all values starting with prefix, None if there is no such value
+        if isinstance(prefix, bytes):
+            prefix = prefix.rstrip(b'\xff')
+            return prefix[:-1] + bytes([prefix[-1] + 1]) if len(prefix) > 0 else None
+        prefix = prefix.rstrip(chr(0x10ffff))
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1) if len(prefix) > 0 else None
+
+    def __repr__(self):
+        return '<Prefix %s>' % repr(self.prefix)
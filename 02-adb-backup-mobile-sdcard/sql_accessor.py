@@ -1,5 +1,17 @@
-# Version 1.4.2
+# Version 1.14
 # CHANGELOG
+# ver 1.14: selects in WAL mode always run on the read connections, reading the uncommitted writes requires
+#   select_latest()
+# ver 1.13: added add_commit_hook() for making external data durable before the rows referencing it are committed
+# ver 1.12: timestamp adapter and converter are registered once on import
+# ver 1.11: selects in WAL mode are served by the write connection while there are uncommitted writes instead of
+#   committing them, cursor() is no longer counted as a write, removed unused checkpoint()
+# ver 1.10: added iter_select() for streaming rows in batches, with projection of fields
+# ver 1.9: timestamps are converted from and to sqlite by the datetime methods implemented in C
+# ver 1.8: added backup() for sqlite accessor
+# ver 1.7: added execute(), execute_many() for raw sql statements and ensure_table()
+# ver 1.6: added group commit, WAL mode with per-thread read connections and pragmas for sqlite accessor
+# ver 1.5: added insert_many(), upsert_many() and delete_many() methods for batched writes
 # ver 1.4: added mysql support, close() and insert_or_update() method
 # ver 1.3: added future support for generic sql accessor class
 # ver 1.2: providing global lock for multi-threaded access
@@ -8,8 +20,10 @@ import os
 import re
 import orm_utils
 import sql_autogenerator
-from typing import Type, Optional, Any
+from typing import Type, Optional, Any, List, Dict, Iterable, Iterator, Sequence, Callable, Union, Tuple
 import threading
+import datetime
+import sqlite3
 
 create_table_stmt = re.compile(r'create\s+table\s+`?(?P<table_name>[a-zA-Z0-9_]+)`?\s*', re.IGNORECASE)
 
@@ -22,6 +36,38 @@ def _create_table_not_exists(sql_stmt, cursor, check_table_fn):
         cursor.execute(sql_stmt)
 
 
+def _adapt_timestamp(value: datetime.datetime) -> str:
+    return value.isoformat(' ')
+
+
+def _convert_timestamp(value: bytes) -> datetime.datetime:
+    # the format written by _adapt_timestamp (same as the default of sqlite3 module), parsing it dominates the cost of
+    # fetching rows with timestamp columns if done in python
+    return datetime.datetime.fromisoformat(value.decode())
+
+
+# process-wide, also used by the connections opened with sqlite3 directly
+sqlite3.register_adapter(datetime.datetime, _adapt_timestamp)
+sqlite3.register_converter('timestamp', _convert_timestamp)
+
+
+def _iter_cursor(cursor: Any, batch_size: int, from_row: Optional[Callable[[Sequence[Any]], Any]], lock: Any) \
+        -> Iterator[Any]:
+    # the lock is only held while fetching a batch, the cursor is closed once exhausted or the iterator is closed
+    try:
+        while True:
+            with lock:
+                rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                return
+            if from_row is not None:
+                yield from map(from_row, rows)
+            else:
+                yield from rows
+    finally:
+        cursor.close()
+
+
 class _FakeLock:
     def __enter__(self):
         pass
@@ -38,11 +84,33 @@ class _FakeLock:
 
 class GenericSqlAccessor:
     def __init__(self, sql_generator: sql_autogenerator.AbstractSqlStatementGenerator, connection: Any,
-                 ensure_thread_safe: bool = True):
+                 ensure_thread_safe: bool = True, group_commit_size: int = 0):
         self._generator = sql_generator
         self._connection = connection
         self._global_lock = threading.RLock() if ensure_thread_safe else _FakeLock()
         self._checked_existed_tables = set()
+        # commit automatically once group_commit_size rows are written, 0 for committing by caller only
+        self._group_commit_size = group_commit_size
+        self._pending_writes = 0
+        self._commit_hooks = []  # type: List[Callable[[], None]]
+
+    def _written(self, count: int = 1):
+        # called with global lock acquired
+        self._pending_writes += count
+        if 0 < self._group_commit_size <= self._pending_writes:
+            self._commit()
+
+    def _commit(self):
+        for hook in self._commit_hooks:
+            hook()
+        self._connection.commit()
+        self._pending_writes = 0
+
+    def add_commit_hook(self, hook: Callable[[], None]):
+        # the hook is called with global lock acquired before each commit (including group commits), it must not
+        # access the accessor
+        with self._global_lock:
+            self._commit_hooks.append(hook)
 
     def _table_exists(self, cursor: Any, table_name: str) -> bool:
         raise NotImplementedError
@@ -60,12 +128,20 @@ class GenericSqlAccessor:
             self._generator.create_table(entity_class, cursor)
         self._checked_existed_tables.add(entity_class)
 
+    def ensure_table(self, entity: Type[orm_utils.Entity]):
+        # create the table (and the tables it depends on) if not exists, tables are created on first access otherwise
+        with self._global_lock:
+            cursor = self._connection.cursor()
+            self._create_table_dependency_order(cursor, entity)
+            cursor.close()
+
     def insert(self, entity: orm_utils.Entity):
         with self._global_lock:
             cursor = self._connection.cursor()
             self._create_table_dependency_order(cursor, type(entity))
             self._generator.insert(entity, cursor)
             cursor.close()
+            self._written()
 
     def update(self, entity: orm_utils.Entity):
         with self._global_lock:
@@ -73,6 +149,7 @@ class GenericSqlAccessor:
             self._create_table_dependency_order(cursor, type(entity))
             self._generator.update(entity, cursor)
             cursor.close()
+            self._written()
 
     def insert_or_update(self, entity: orm_utils.Entity):
         with self._global_lock:
@@ -80,6 +157,37 @@ class GenericSqlAccessor:
             self._create_table_dependency_order(cursor, type(entity))
             self._generator.insert_or_update(entity, cursor)
             cursor.close()
+            self._written()
+
+    def insert_many(self, entities: List[orm_utils.Entity]):
+        if len(entities) == 0:
+            return
+        with self._global_lock:
+            cursor = self._connection.cursor()
+            self._create_table_dependency_order(cursor, type(entities[0]))
+            self._generator.insert_many(entities, cursor)
+            cursor.close()
+            self._written(len(entities))
+
+    def upsert_many(self, entities: List[orm_utils.Entity]):
+        if len(entities) == 0:
+            return
+        with self._global_lock:
+            cursor = self._connection.cursor()
+            self._create_table_dependency_order(cursor, type(entities[0]))
+            self._generator.upsert_many(entities, cursor)
+            cursor.close()
+            self._written(len(entities))
+
+    def delete_many(self, entity: Type[orm_utils.Entity], keys: List[Dict[str, Any]]):
+        if len(keys) == 0:
+            return
+        with self._global_lock:
+            cursor = self._connection.cursor()
+            self._create_table_dependency_order(cursor, entity)
+            self._generator.delete_many(entity, cursor, keys)
+            cursor.close()
+            self._written(len(keys))
 
     def select(self, entity: Type[orm_utils.Entity], fetch_count: int, **keys):
         with self._global_lock:
@@ -89,22 +197,62 @@ class GenericSqlAccessor:
             cursor.close()
             return result
 
+    def select_latest(self, entity: Type[orm_utils.Entity], fetch_count: int, **keys):
+        # same as select(), including the uncommitted writes even if selects are served by other connections
+        return GenericSqlAccessor.select(self, entity, fetch_count, **keys)
+
+    def iter_select(self, entity: Type[orm_utils.Entity], batch_size: int = 1024,
+                    fields: Optional[Sequence[str]] = None, **keys) -> Iterator[Union[orm_utils.Entity, Tuple]]:
+        """
+        Select the rows lazily in batches via fetchmany(), so that large results are read in constant memory
+        :param entity: entity class of the table
+        :param batch_size: count of rows fetched at once
+        :param fields: yield tuples of the values of these fields instead of entities
+        :param keys: equality conditions of fields
+        """
+        assert batch_size > 0, 'batch_size must be positive'
+        with self._global_lock:
+            cursor = self._connection.cursor()
+            self._create_table_dependency_order(cursor, entity)
+            self._generator.execute_select(entity, cursor, fields, **keys)
+        return _iter_cursor(cursor, batch_size, None if fields is not None else
+                            getattr(entity, '_member_inject_row_factory'), self._global_lock)
+
     def delete(self, entity: Type[orm_utils.Entity], **keys):
         with self._global_lock:
             cursor = self._connection.cursor()
             self._create_table_dependency_order(cursor, entity)
             self._generator.delete(entity, cursor, **keys)
             cursor.close()
+            self._written()
 
     def commit(self):
         with self._global_lock:
-            self._connection.commit()
+            self._commit()
 
     def close(self):
         with self._global_lock:
             self._connection.close()
 
+    def execute(self, sql: str, args: Iterable[Any] = ()) -> List[Any]:
+        # raw sql statement in the dialect of the accessor, treated as a write, returns the fetched rows
+        with self._global_lock:
+            cursor = self._connection.cursor()
+            cursor.execute(sql, args)
+            result = cursor.fetchall()
+            cursor.close()
+            self._written()
+            return result
+
+    def execute_many(self, sql: str, args: Iterable[Iterable[Any]]):
+        with self._global_lock:
+            cursor = self._connection.cursor()
+            cursor.executemany(sql, args)
+            cursor.close()
+            self._written()
+
     def cursor(self):
+        # raw cursor of the write connection, the statements executed by it should be committed by the caller
         return self._connection.cursor()
 
     def get_variable(self, key: str, default: Optional[str] = None) -> str:
@@ -118,19 +266,103 @@ class GenericSqlAccessor:
 
 
 class SqliteAccessor(GenericSqlAccessor):
-    def __init__(self, sqlite_path: str, ensure_thread_safe: bool = True):
-        import sqlite3
+    """
+    Sqlite accessor, in WAL mode all writes go through the single connection behind global lock, while selects run
+    concurrently on per-thread read connections, which only see the committed writes. The lookups depending on the
+    uncommitted writes should use select_latest(), which is served by the write connection under lock
+    """
+    def __init__(self, sqlite_path: str, ensure_thread_safe: bool = True, wal_mode: bool = False,
+                 pragmas: Optional[Dict[str, Any]] = None, group_commit_size: int = 0):
         if os.path.exists(sqlite_path):
             assert os.path.isfile(sqlite_path)
-        connection = sqlite3.connect(sqlite_path, check_same_thread=False,
-                                     detect_types=sqlite3.PARSE_COLNAMES | sqlite3.PARSE_DECLTYPES)
+        # pragmas (e.g. synchronous, cache_size, mmap_size) are applied to all connections
+        pragmas = pragmas or {}
+        assert all([re.match(r'^[a-z_]+$', x) is not None for x in pragmas]), 'Invalid pragma name'
+        self._sqlite_path = sqlite_path
+        self._wal_mode = wal_mode
+        self._pragmas = pragmas
+        self._thread_local = threading.local()
+        self._read_connections = []
+        self._readable_tables = set()
+        connection = self._connect()
         generator = sql_autogenerator.SqliteSqlStatementGenerator()
-        super(SqliteAccessor, self).__init__(generator, connection, ensure_thread_safe)
+        super(SqliteAccessor, self).__init__(generator, connection, ensure_thread_safe, group_commit_size)
         self._check_tables()
 
+    def _connect(self) -> Any:
+        connection = sqlite3.connect(self._sqlite_path, check_same_thread=False,
+                                     detect_types=sqlite3.PARSE_COLNAMES | sqlite3.PARSE_DECLTYPES)
+        cursor = connection.cursor()
+        for key, value in self._pragmas.items():
+            cursor.execute('pragma %s = %s' % (key, value))
+        cursor.close()
+        return connection
+
+    def _read_connection(self) -> Any:
+        connection = getattr(self._thread_local, 'connection', None)
+        if connection is None:
+            connection = self._connect()
+            connection.execute('pragma query_only = on')
+            self._thread_local.connection = connection
+            with self._global_lock:
+                self._read_connections.append(connection)
+        return connection
+
+    def _ensure_readable_table(self, entity: Type[orm_utils.Entity]):
+        # the tables created on first access (including the ones created by writes) are committed once, otherwise
+        # they do not exist for the read connections
+        if entity in self._readable_tables:
+            return
+        with self._global_lock:
+            cursor = self._connection.cursor()
+            self._create_table_dependency_order(cursor, entity)
+            cursor.close()
+            self._commit()
+            self._readable_tables.add(entity)
+
+    def select(self, entity: Type[orm_utils.Entity], fetch_count: int, **keys):
+        if not self._wal_mode:
+            return super(SqliteAccessor, self).select(entity, fetch_count, **keys)
+        self._ensure_readable_table(entity)
+        cursor = self._read_connection().cursor()
+        result = self._generator.select(entity, cursor, fetch_count, **keys)
+        cursor.close()
+        return result
+
+    def iter_select(self, entity: Type[orm_utils.Entity], batch_size: int = 1024,
+                    fields: Optional[Sequence[str]] = None, **keys) -> Iterator[Union[orm_utils.Entity, Tuple]]:
+        if not self._wal_mode:
+            return super(SqliteAccessor, self).iter_select(entity, batch_size, fields, **keys)
+        assert batch_size > 0, 'batch_size must be positive'
+        self._ensure_readable_table(entity)
+        # the read connection belongs to the calling thread, so the rows are fetched without lock
+        cursor = self._read_connection().cursor()
+        self._generator.execute_select(entity, cursor, fields, **keys)
+        return _iter_cursor(cursor, batch_size, None if fields is not None else
+                            getattr(entity, '_member_inject_row_factory'), _FakeLock())
+
+    def backup(self, dst_path: str):
+        # copy the database page by page with sqlite online backup api, pending writes are committed before copying
+        with self._global_lock:
+            self._commit()
+            dst_connection = sqlite3.connect(dst_path)
+            try:
+                self._connection.backup(dst_connection)
+            finally:
+                dst_connection.close()
+
+    def close(self):
+        with self._global_lock:
+            for connection in self._read_connections:
+                connection.close()
+            self._read_connections = []
+            self._connection.close()
+
     def _check_tables(self):
         cursor = self._connection.cursor()
         cursor.execute('pragma foreign_keys = on')
+        if self._wal_mode:
+            cursor.execute('pragma journal_mode = wal')
         _create_table_not_exists("create table db_vars(key varchar(255) primary key not null unique, "
                                  "value text)", cursor, self._table_exists)
         cursor.close()
@@ -164,21 +396,23 @@ class SqliteAccessor(GenericSqlAccessor):
             else:
                 cursor.execute("update db_vars set value = ? where key = ?", (value, key))
             cursor.close()
+            self._written()
 
     def delete_variable(self, key: str):
         with self._global_lock:
             cursor = self._connection.cursor()
             cursor.execute("delete from db_vars where key = ?", (key,))
             cursor.close()
+            self._written()
 
 
 class MysqlAccessor(GenericSqlAccessor):
     def __init__(self, host: str, user: str, password: str, database: Optional[str] = None,
-                 ensure_thread_safe: bool = True, **kwargs):
+                 ensure_thread_safe: bool = True, group_commit_size: int = 0, **kwargs):
         import mysql.connector
         connection = mysql.connector.connect(host=host, user=user, password=password, database=database, **kwargs)
         generator = sql_autogenerator.MysqlSqlStatementGenerator()
-        super(MysqlAccessor, self).__init__(generator, connection, ensure_thread_safe)
+        super(MysqlAccessor, self).__init__(generator, connection, ensure_thread_safe, group_commit_size)
 
         cursor = self._connection.cursor()
         _create_table_not_exists("create table `db_vars`(`key` varchar(255) primary key not null unique, "
@@ -214,9 +448,11 @@ class MysqlAccessor(GenericSqlAccessor):
             else:
                 cursor.execute("update `db_vars` set `value` = %s where `key` = %s", (value, key))
             cursor.close()
+            self._written()
 
     def delete_variable(self, key: str):
         with self._global_lock:
             cursor = self._connection.cursor()
             cursor.execute("delete from `db_vars` where `key` = %s", (key,))
             cursor.close()
+            self._written()
@@ -1,5 +1,10 @@
-# Version 1.3
+# Version 1.7
 # CHANGELOG
+# Ver 1.7 Keys of select and delete accept query predicates (In, Range and Prefix) besides values
+# Ver 1.6 Added execute_select() for selecting rows without fetching them, with projection of fields
+# Ver 1.5 Statements are compiled once per entity class, operation and key fields, rows are built by the row factory of
+#   entity class
+# Ver 1.4 Added insert_many(), upsert_many() and delete_many() methods for batched writes
 # Ver 1.3 Added insert_or_update() method, introduced entity field cache to improve speed
 # Ver 1.2 Added mysql support
 # Ver 1.1 Bug fixed and type hint changed for abstract sql statement generator
@@ -47,10 +52,33 @@ class AbstractSqlStatementGenerator:
     def select(entity: Type[orm_utils.Entity], cursor: Any, fetch_count: int = 1, **keys: Any):
         raise NotImplementedError()
 
+    @staticmethod
+    def execute_select(entity: Type[orm_utils.Entity], cursor: Any, fields: Optional[Sequence[str]] = None,
+                       **keys: Any):
+        # execute the select statement only, the rows are left in cursor, containing the values of fields (all fields
+        # of entity if not specified) in order
+        raise NotImplementedError()
+
     @staticmethod
     def delete(entity: Type[orm_utils.Entity], cursor: Any, **keys: Any):
         raise NotImplementedError()
 
+    # batched writes, entities must be the same type, dialects override them with executemany()
+    @classmethod
+    def insert_many(cls, entities: List[orm_utils.Entity], cursor: Any):
+        for entity in entities:
+            cls.insert(entity, cursor)
+
+    @classmethod
+    def upsert_many(cls, entities: List[orm_utils.Entity], cursor: Any):
+        for entity in entities:
+            cls.insert_or_update(entity, cursor)
+
+    @classmethod
+    def delete_many(cls, entity: Type[orm_utils.Entity], cursor: Any, keys: List[Dict[str, Any]]):
+        for key in keys:
+            cls.delete(entity, cursor, **key)
+
     @classmethod
     def get_dialect_generator(cls, dialect: str) -> 'AbstractSqlStatementGenerator':
         return cls._dialect_impl[dialect]
@@ -65,30 +93,82 @@ def _validate_select_query_fields(entity: Type[orm_utils.Entity], args: Iterable
     return field_names, unexpected_fields
 
 
-def _fetch_result(entity: Type[orm_utils.Entity], field_names: Iterable[str], cursor: Any, fetch_count: int) \
+def _many_args(entities: List[orm_utils.Entity], field_names: Iterable[str]) -> List[List[Any]]:
+    assert all([type(x) == type(entities[0]) for x in entities]), 'Entities must be the same type'
+    return [[getattr(x, name) for name in field_names] for x in entities]
+
+
+def _delete_many_keys(keys: List[Dict[str, Any]]) -> Tuple[List[str], List[List[Any]]]:
+    # returns the key field names and arguments of each key, all keys must have the same fields
+    key_fields = list(keys[0].keys())
+    assert all([set(x.keys()) == set(key_fields) for x in keys]), 'Keys must have the same fields'
+    return key_fields, [[x[name] for name in key_fields] for x in keys]
+
+
+def _key_conditions(keys: Dict[str, Any], column_format: str, placeholder: str) -> str:
+    return ' and '.join([keys[x].condition(column_format % x, placeholder)
+                         if isinstance(keys[x], orm_utils.QueryPredicate) else
+                         '%s = %s' % (column_format % x, placeholder) for x in keys])
+
+
+def _key_args(keys: Dict[str, Any]) -> List[Any]:
+    args = []
+    for value in keys.values():
+        if isinstance(value, orm_utils.QueryPredicate):
+            args.extend(value.args())
+        else:
+            args.append(value)
+    return args
+
+
+def _key_shape(keys: Dict[str, Any]) -> Tuple:
+    # compiled statements of keys with the same shape are the same
+    return tuple([(x, keys[x].shape() if isinstance(keys[x], orm_utils.QueryPredicate) else None) for x in keys])
+
+
+def _compiled(statements: Dict[Tuple, Any], key: Tuple, build: Callable[[], Any]) -> Any:
+    # statements are built on first use of (entity class, operation, key fields) and looked up afterwards
+    statement = statements.get(key)
+    if statement is None:
+        statement = build()
+        statements[key] = statement
+    return statement
+
+
+def _select_keys(entity: Type[orm_utils.Entity], keys: Iterable[str]) -> Tuple[str, ...]:
+    _, unexpected_fields = _validate_select_query_fields(entity, keys)
+    if len(unexpected_fields):
+        raise ValueError('Unexpected fields: %s' % ', '.join(unexpected_fields))
+    return tuple(keys)
+
+
+def _projection_fields(entity: Type[orm_utils.Entity], fields: Optional[Sequence[str]]) -> List[str]:
+    if fields is None:
+        return getattr(entity, '_member_inject_field_name')
+    _, unexpected_fields = _validate_select_query_fields(entity, fields)
+    if len(unexpected_fields):
+        raise ValueError('Unexpected fields: %s' % ', '.join(unexpected_fields))
+    return list(fields)
+
+
+def _fetch_result(entity: Type[orm_utils.Entity], cursor: Any, fetch_count: int) \
         -> Optional[Union[orm_utils.Entity, List[orm_utils.Entity]]]:
     # fetch result from sql cursor (must support fetchone(), fetchmany() and fetchall(), and returns the entity(s)
+    from_row = getattr(entity, '_member_inject_row_factory')
     if fetch_count == 1:
         fetch_result = cursor.fetchone()
-        if fetch_result is None:
-            return None
-        entity_obj = object.__new__(entity)
-        entity_obj.__init__(**dict([x for x in zip(field_names, fetch_result)]))
+        return None if fetch_result is None else from_row(fetch_result)
+    if fetch_count > 1:
+        fetch_results = cursor.fetchmany(fetch_count)
     else:
-        if fetch_count > 1:
-            fetch_results = cursor.fetchmany(fetch_count)
-        else:
-            fetch_results = cursor.fetchall()
-        entity_obj_list = []
-        for fetch_result in fetch_results:
-            entity_obj = object.__new__(entity)
-            entity_obj.__init__(**dict([x for x in zip(field_names, fetch_result)]))
-            entity_obj_list.append(entity_obj)
-        entity_obj = entity_obj_list
-    return entity_obj
+        fetch_results = cursor.fetchall()
+    return list(map(from_row, fetch_results))
 
 
 class SqliteSqlStatementGenerator(AbstractSqlStatementGenerator, dialect='sqlite'):
+    # compiled statements keyed by (entity class, operation, key fields)
+    _statements = {}  # type: Dict[Tuple, str]
+
     @staticmethod
     def create_table(entity: Type[orm_utils.Entity], cursor: Any):
         def _handle_basic_table_field(f: orm_utils.TableFieldDescriptor):
@@ -126,59 +206,109 @@ class SqliteSqlStatementGenerator(AbstractSqlStatementGenerator, dialect='sqlite
             if type(index_field) == orm_utils.TableIndexDescriptor:
                 cursor.execute(_handle_field(index_field))
 
-    @staticmethod
-    def insert(entity: orm_utils.Entity, cursor: Any):
-        field_names = getattr(entity, '_member_inject_field_name')
-        sql = 'insert into %s(%s) values (%s)' % (entity.__TABLE_NAME__, ', '.join(field_names),
-                                                  ', '.join(['?'] * len(field_names)))
-        args = [getattr(entity, x) for x in field_names]
-        cursor.execute(sql, args)
-        auto_increment_fields = [x for x in getattr(entity, '_member_inject_field_dict').values() if x.auto_increment]
-        if len(auto_increment_fields) > 0:
-            assert len(auto_increment_fields) == 1, 'More than 1 auto increment fields are unsupported'
-            if getattr(entity, auto_increment_fields[0].field_name) is None:
-                # retrieve the inserted id
-                cursor.execute("select last_insert_rowid()")
-                auto_increment_id = cursor.fetchone()[0]
-                setattr(entity, auto_increment_fields[0].field_name, auto_increment_id)
+    @classmethod
+    def insert(cls, entity: orm_utils.Entity, cursor: Any):
+        entity_type = type(entity)
+        field_names = getattr(entity_type, '_member_inject_field_name')
+        sql = _compiled(cls._statements, (entity_type, 'insert'),
+                        lambda: 'insert into %s(%s) values (%s)' % (entity_type.__TABLE_NAME__, ', '.join(field_names),
+                                                                    ', '.join(['?'] * len(field_names))))
+        cursor.execute(sql, [getattr(entity, x) for x in field_names])
+        auto_increment_field = getattr(entity_type, '_member_inject_field_auto_increment')
+        if auto_increment_field is not None and getattr(entity, auto_increment_field) is None:
+            # retrieve the inserted id
+            cursor.execute("select last_insert_rowid()")
+            setattr(entity, auto_increment_field, cursor.fetchone()[0])
 
-    @staticmethod
-    def update(entity: orm_utils.Entity, cursor: Any):
-        field_names = set(getattr(entity, '_member_inject_field_name'))
-        primary_key_field_names = getattr(entity, '_member_inject_field_primary')
-        updated_fields = field_names.difference(primary_key_field_names)
-        sql = "update %s set %s where %s" % (entity.__TABLE_NAME__, ', '.join([x + ' = ?' for x in updated_fields]),
-                                             ' and '.join([x + ' = ?' for x in primary_key_field_names]))
-        args = [getattr(entity, x) for x in updated_fields]
-        args.extend([getattr(entity, x) for x in primary_key_field_names])
-        cursor.execute(sql, args)
+    @classmethod
+    def update(cls, entity: orm_utils.Entity, cursor: Any):
+        entity_type = type(entity)
+        updated_fields = getattr(entity_type, '_member_inject_field_non_primary')
+        primary_key_field_names = getattr(entity_type, '_member_inject_field_primary')
+        sql = _compiled(cls._statements, (entity_type, 'update'),
+                        lambda: 'update %s set %s where %s' % (entity_type.__TABLE_NAME__,
+                                                               ', '.join([x + ' = ?' for x in updated_fields]),
+                                                               ' and '.join([x + ' = ?' for x in
+                                                                             primary_key_field_names])))
+        cursor.execute(sql, [getattr(entity, x) for x in updated_fields] +
+                       [getattr(entity, x) for x in primary_key_field_names])
 
-    @staticmethod
-    def select(entity: Type[orm_utils.Entity], cursor: Any, fetch_count: int = 1, **keys: Any):
-        field_names, unexpected_fields = _validate_select_query_fields(entity, keys.keys())
-        if len(unexpected_fields):
-            raise ValueError('Unexpected fields: %s' % ', '.join(unexpected_fields))
-        sql = 'select %s from %s' % (', '.join(field_names), entity.__TABLE_NAME__)
-        args = ()
-        if len(keys) > 0:
-            sql += ' where %s' % ' and '.join([x + ' = ?' for x in keys])
-            args = [keys[x] for x in keys]
-        cursor.execute(sql, args)
-        return _fetch_result(entity, field_names, cursor, fetch_count)
+    @classmethod
+    def select(cls, entity: Type[orm_utils.Entity], cursor: Any, fetch_count: int = 1, **keys: Any):
+        cls.execute_select(entity, cursor, **keys)
+        return _fetch_result(entity, cursor, fetch_count)
 
-    @staticmethod
-    def delete(entity: Type[orm_utils.Entity], cursor: Any, **keys: Any):
-        # noinspection SqlWithoutWhere
-        sql = 'delete from %s' % entity.__TABLE_NAME__
-        args = ()
-        if len(keys) > 0:
-            sql += ' where %s' % ' and '.join([x + ' = ?' for x in keys])
-            args = [keys[x] for x in keys]
-        cursor.execute(sql, args)
+    @classmethod
+    def execute_select(cls, entity: Type[orm_utils.Entity], cursor: Any, fields: Optional[Sequence[str]] = None,
+                       **keys: Any):
+        def _build():
+            key_fields = _select_keys(entity, keys)
+            sql = 'select %s from %s' % (', '.join(_projection_fields(entity, fields)), entity.__TABLE_NAME__)
+            if len(key_fields) > 0:
+                sql += ' where %s' % _key_conditions(keys, '%s', '?')
+            return sql
+        statement_key = (entity, 'select', _key_shape(keys), tuple(fields) if fields is not None else None)
+        cursor.execute(_compiled(cls._statements, statement_key, _build), _key_args(keys))
+
+    @classmethod
+    def delete(cls, entity: Type[orm_utils.Entity], cursor: Any, **keys: Any):
+        def _build():
+            # noinspection SqlWithoutWhere
+            sql = 'delete from %s' % entity.__TABLE_NAME__
+            if len(keys) > 0:
+                sql += ' where %s' % _key_conditions(keys, '%s', '?')
+            return sql
+        cursor.execute(_compiled(cls._statements, (entity, 'delete', _key_shape(keys)), _build), _key_args(keys))
+
+    @classmethod
+    def insert_many(cls, entities: List[orm_utils.Entity], cursor: Any):
+        # auto increment fields are not retrieved
+        if len(entities) == 0:
+            return
+        entity_type = type(entities[0])
+        field_names = getattr(entity_type, '_member_inject_field_name')
+        sql = _compiled(cls._statements, (entity_type, 'insert'),
+                        lambda: 'insert into %s(%s) values (%s)' % (entity_type.__TABLE_NAME__, ', '.join(field_names),
+                                                                    ', '.join(['?'] * len(field_names))))
+        cursor.executemany(sql, _many_args(entities, field_names))
+
+    @classmethod
+    def upsert_many(cls, entities: List[orm_utils.Entity], cursor: Any):
+        if len(entities) == 0:
+            return
+        entity_type = type(entities[0])
+        field_names = getattr(entity_type, '_member_inject_field_name')
+
+        def _build():
+            primary_key_field_names = getattr(entity_type, '_member_inject_field_primary')
+            updated_fields = getattr(entity_type, '_member_inject_field_non_primary')
+            sql = 'insert into %s(%s) values (%s) on conflict(%s) do ' % \
+                  (entity_type.__TABLE_NAME__, ', '.join(field_names), ', '.join(['?'] * len(field_names)),
+                   ', '.join(primary_key_field_names))
+            if len(updated_fields) > 0:
+                sql += 'update set %s' % ', '.join(['%s = excluded.%s' % (x, x) for x in updated_fields])
+            else:
+                sql += 'nothing'
+            return sql
+        cursor.executemany(_compiled(cls._statements, (entity_type, 'upsert'), _build),
+                           _many_args(entities, field_names))
+
+    @classmethod
+    def delete_many(cls, entity: Type[orm_utils.Entity], cursor: Any, keys: List[Dict[str, Any]]):
+        if len(keys) == 0:
+            return
+        key_fields, args = _delete_many_keys(keys)
+        sql = _compiled(cls._statements, (entity, 'delete', tuple([(x, None) for x in key_fields])),
+                        lambda: 'delete from %s where %s' % (entity.__TABLE_NAME__,
+                                                             ' and '.join([x + ' = ?' for x in key_fields])))
+        cursor.executemany(sql, args)
 
 
 # noinspection SqlResolve
 class MysqlSqlStatementGenerator(AbstractSqlStatementGenerator, dialect='mysql'):
+    # compiled statements keyed by (entity class, operation, key fields)
+    _statements = {}  # type: Dict[Tuple, str]
+
     @staticmethod
     def create_table(entity: Type[orm_utils.Entity], cursor: Any):
         def _handle_basic_table_field(f: orm_utils.TableFieldDescriptor):
@@ -216,52 +346,96 @@ class MysqlSqlStatementGenerator(AbstractSqlStatementGenerator, dialect='mysql')
             if type(index_field) == orm_utils.TableIndexDescriptor:
                 cursor.execute(_handle_field(index_field))
 
-    @staticmethod
-    def insert(entity: orm_utils.Entity, cursor: Any):
-        field_names = getattr(entity, '_member_inject_field_name')
-        sql = 'insert into `%s`(`%s`) values (%s)' % (entity.__TABLE_NAME__, '`, `'.join(field_names),
-                                                      ', '.join(['%s'] * len(field_names)))
-        args = [getattr(entity, x) for x in field_names]
-        cursor.execute(sql, args)
-        auto_increment_fields = [x for x in getattr(entity, '_member_inject_field_dict').values() if x.auto_increment]
-        if len(auto_increment_fields) > 0:
-            assert len(auto_increment_fields) == 1, 'More than 1 auto increment fields are unsupported'
-            if getattr(entity, auto_increment_fields[0].field_name) is None:
-                # retrieve the inserted id
-                auto_increment_id = cursor.lastrowid
-                setattr(entity, auto_increment_fields[0].field_name, auto_increment_id)
+    @classmethod
+    def insert(cls, entity: orm_utils.Entity, cursor: Any):
+        entity_type = type(entity)
+        field_names = getattr(entity_type, '_member_inject_field_name')
+        sql = _compiled(cls._statements, (entity_type, 'insert'),
+                        lambda: 'insert into `%s`(`%s`) values (%s)' % (entity_type.__TABLE_NAME__,
+                                                                        '`, `'.join(field_names),
+                                                                        ', '.join(['%s'] * len(field_names))))
+        cursor.execute(sql, [getattr(entity, x) for x in field_names])
+        auto_increment_field = getattr(entity_type, '_member_inject_field_auto_increment')
+        if auto_increment_field is not None and getattr(entity, auto_increment_field) is None:
+            # retrieve the inserted id
+            setattr(entity, auto_increment_field, cursor.lastrowid)
 
-    @staticmethod
-    def update(entity: orm_utils.Entity, cursor: Any):
-        field_names = set(getattr(entity, '_member_inject_field_name'))
-        primary_key_field_names = getattr(entity, '_member_inject_field_primary')
-        updated_fields = field_names.difference(primary_key_field_names)
-        sql = "update `%s` set %s where %s" % (entity.__TABLE_NAME__,
-                                               ', '.join(['`'+x+'` = %s' for x in updated_fields]),
-                                               ' and '.join(['`'+x+'` = %s' for x in primary_key_field_names]))
-        args = [getattr(entity, x) for x in updated_fields]
-        args.extend([getattr(entity, x) for x in primary_key_field_names])
-        cursor.execute(sql, args)
+    @classmethod
+    def update(cls, entity: orm_utils.Entity, cursor: Any):
+        entity_type = type(entity)
+        updated_fields = getattr(entity_type, '_member_inject_field_non_primary')
+        primary_key_field_names = getattr(entity_type, '_member_inject_field_primary')
+        sql = _compiled(cls._statements, (entity_type, 'update'),
+                        lambda: "update `%s` set %s where %s" % (entity_type.__TABLE_NAME__,
+                                                                 ', '.join(['`'+x+'` = %s' for x in updated_fields]),
+                                                                 ' and '.join(['`'+x+'` = %s' for x in
+                                                                               primary_key_field_names])))
+        cursor.execute(sql, [getattr(entity, x) for x in updated_fields] +
+                       [getattr(entity, x) for x in primary_key_field_names])
 
-    @staticmethod
-    def select(entity: Type[orm_utils.Entity], cursor: Any, fetch_count: int = 1, **keys: Any):
-        field_names, unexpected_fields = _validate_select_query_fields(entity, keys.keys())
-        if len(unexpected_fields):
-            raise ValueError('Unexpected fields: %s' % ', '.join(unexpected_fields))
-        sql = 'select `%s` from `%s`' % ('`, `'.join(field_names), entity.__TABLE_NAME__)
-        args = ()
-        if len(keys) > 0:
-            sql += ' where %s' % ' and '.join(['`' + x + '` = %s' for x in keys])
-            args = [keys[x] for x in keys]
-        cursor.execute(sql, args)
-        return _fetch_result(entity, field_names, cursor, fetch_count)
+    @classmethod
+    def select(cls, entity: Type[orm_utils.Entity], cursor: Any, fetch_count: int = 1, **keys: Any):
+        cls.execute_select(entity, cursor, **keys)
+        return _fetch_result(entity, cursor, fetch_count)
 
-    @staticmethod
-    def delete(entity: Type[orm_utils.Entity], cursor: Any, **keys: Any):
-        # noinspection SqlWithoutWhere
-        sql = 'delete from `%s`' % entity.__TABLE_NAME__
-        args = ()
-        if len(keys) > 0:
-            sql += ' where %s' % ' and '.join(['`'+x+'` = %s' for x in keys])
-            args = [keys[x] for x in keys]
-        cursor.execute(sql, args)
+    @classmethod
+    def execute_select(cls, entity: Type[orm_utils.Entity], cursor: Any, fields: Optional[Sequence[str]] = None,
+                       **keys: Any):
+        def _build():
+            key_fields = _select_keys(entity, keys)
+            sql = 'select `%s` from `%s`' % ('`, `'.join(_projection_fields(entity, fields)), entity.__TABLE_NAME__)
+            if len(key_fields) > 0:
+                sql += ' where %s' % _key_conditions(keys, '`%s`', '%s')
+            return sql
+        statement_key = (entity, 'select', _key_shape(keys), tuple(fields) if fields is not None else None)
+        cursor.execute(_compiled(cls._statements, statement_key, _build), _key_args(keys))
+
+    @classmethod
+    def delete(cls, entity: Type[orm_utils.Entity], cursor: Any, **keys: Any):
+        def _build():
+            # noinspection SqlWithoutWhere
+            sql = 'delete from `%s`' % entity.__TABLE_NAME__
+            if len(keys) > 0:
+                sql += ' where %s' % _key_conditions(keys, '`%s`', '%s')
+            return sql
+        cursor.execute(_compiled(cls._statements, (entity, 'delete', _key_shape(keys)), _build), _key_args(keys))
+
+    @classmethod
+    def insert_many(cls, entities: List[orm_utils.Entity], cursor: Any):
+        # auto increment fields are not retrieved
+        if len(entities) == 0:
+            return
+        entity_type = type(entities[0])
+        field_names = getattr(entity_type, '_member_inject_field_name')
+        sql = _compiled(cls._statements, (entity_type, 'insert'),
+                        lambda: 'insert into `%s`(`%s`) values (%s)' % (entity_type.__TABLE_NAME__,
+                                                                        '`, `'.join(field_names),
+                                                                        ', '.join(['%s'] * len(field_names))))
+        cursor.executemany(sql, _many_args(entities, field_names))
+
+    @classmethod
+    def upsert_many(cls, entities: List[orm_utils.Entity], cursor: Any):
+        if len(entities) == 0:
+            return
+        entity_type = type(entities[0])
+        field_names = getattr(entity_type, '_member_inject_field_name')
+
+        def _build():
+            # updating primary key to itself does nothing if all fields are primary keys
+            updated_fields = getattr(entity_type, '_member_inject_field_non_primary') or \
+                getattr(entity_type, '_member_inject_field_primary')
+            return 'insert into `%s`(`%s`) values (%s) on duplicate key update %s' % \
+                   (entity_type.__TABLE_NAME__, '`, `'.join(field_names), ', '.join(['%s'] * len(field_names)),
+                    ', '.join(['`%s` = values(`%s`)' % (x, x) for x in updated_fields]))
+        cursor.executemany(_compiled(cls._statements, (entity_type, 'upsert'), _build),
+                           _many_args(entities, field_names))
+
+    @classmethod
+    def delete_many(cls, entity: Type[orm_utils.Entity], cursor: Any, keys: List[Dict[str, Any]]):
+        if len(keys) == 0:
+            return
+        key_fields, args = _delete_many_keys(keys)
+        sql = _compiled(cls._statements, (entity, 'delete', tuple([(x, None) for x in key_fields])),
+                        lambda: 'delete from `%s` where %s' % (entity.__TABLE_NAME__,
+                                                               ' and '.join(['`' + x + '` = %s' for x in key_fields])))
+        cursor.executemany(sql, args)
@@ -111,6 +111,30 @@ def spawn_process(cmd: Union[str, List[str]], encoding: str) -> Tuple[str, str]:
     return stdout, stderr
 
 
+def iter_process_lines(cmd: Union[str, List[str]], encoding: str) -> Iterator[str]:
+    # streaming version of spawn_process, stdout is yielded line by line and stderr is reported as warnings, raises
+    # CalledProcessError after the output if the process exits with non-zero status
+    from warnings import warn
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def _read_stderr():
+        for err_line in p.stderr:
+            warn(err_line.decode(encoding, errors='replace').rstrip('\r\n'))
+    thd = threading.Thread(target=_read_stderr, daemon=True)
+    thd.start()
+    try:
+        for line in p.stdout:
+            yield line.decode(encoding)
+        p.wait()
+    finally:
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+        thd.join()
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
 # fix a strange behavior that datetime.fromtimestamp(0).timestamp() will raise OSError [Errno 22] Invalid argument
 def get_datetime_timestamp(dt: datetime) -> float:
     import sys